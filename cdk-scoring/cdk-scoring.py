@@ -70,8 +70,13 @@ FORMATIONS = [
 
 API_TOKENS = os.environ.get('API_TOKENS', 'Good,Better,Best')
 PLANSCORE_SECRET = os.environ.get('PLANSCORE_SECRET', 'fake-fake')
+AGGREGATION_ENGINE = os.environ.get('AGGREGATION_ENGINE', 'athena')
 ATHENA_BUCKET, ATHENA_PREFIX = 'planscore-stuff-logs', 'athena-output'
 
+# Polygonize /tmp size and the share kept for cached county graphs, in MiB;
+# the rest holds graphs while they download before joining the cache
+POLYGONIZE_EPHEMERAL_MB, POLYGONIZE_GRAPH_DISK_MB = 1024, 384
+
 def concat_strings(*things):
     return functools.reduce(
         lambda a, b: cdk.StringConcat().join(left=a, right=b),
@@ -421,6 +426,8 @@ class PlanScoreScoring(cdk.Stack):
                     (aws_glue.Schema.DOUBLE, "Hispanic Citizen Voting-Age Population 2020 ACS, Margin"),
                     (aws_glue.Schema.BIG_INT, "Voting-Age Population 2020"),
                     (aws_glue.Schema.STRING, "Point"),
+                    (aws_glue.Schema.DOUBLE, "Lon"),
+                    (aws_glue.Schema.DOUBLE, "Lat"),
                 ]
             ],
             partition_keys=[
@@ -450,14 +457,18 @@ class PlanScoreScoring(cdk.Stack):
                 aws_glue.Column(name=n, type=t)
                 for (n, t) in [
                     ('Number', aws_glue.Schema.INTEGER),
-                    ('Polygon', aws_glue.Schema.STRING),
+                    ('Polygon', aws_glue.Schema.BINARY),
+                    ('XMin', aws_glue.Schema.DOUBLE),
+                    ('YMin', aws_glue.Schema.DOUBLE),
+                    ('XMax', aws_glue.Schema.DOUBLE),
+                    ('YMax', aws_glue.Schema.DOUBLE),
                     ('GEOID20', aws_glue.Schema.STRING),
                 ]
             ],
             partition_keys=[
                 aws_glue.Column(name='upload', type=aws_glue.Schema.STRING),
             ],
-            data_format=aws_glue.DataFormat.CSV,
+            data_format=aws_glue.DataFormat.PARQUET,
         )
 
         # Partition projection hack
@@ -519,6 +530,7 @@ class PlanScoreScoring(cdk.Stack):
                 'GIT_COMMIT_SHA': git_commit_sha,
                 'S3_BUCKET': data_bucket.bucket_name,
                 'ATHENA_DB': athena_db.database_name,
+                'AGGREGATION_ENGINE': AGGREGATION_ENGINE,
                 'PLANSCORE_SECRET': PLANSCORE_SECRET,
                 'WEBSITE_BASE': website_base,
                 'LD_LIBRARY_PATH': '/var/task/lib',
@@ -590,6 +602,10 @@ class PlanScoreScoring(cdk.Stack):
             **function_kwargs,
         )
 
+        # Room in /tmp for cached county graphs plus downloads in progress
+        polygonize.add_environment('GRAPH_CACHE_DISK_BYTES', str(POLYGONIZE_GRAPH_DISK_MB * 1024**2))
+        polygonize.node.default_child.add_property_override('EphemeralStorage.Size', POLYGONIZE_EPHEMERAL_MB)
+
         grant_data_bucket_access(data_bucket, polygonize)
 
         postread_calculate = aws_lambda.DockerImageFunction(
@@ -0,0 +1,449 @@
+''' In-process alternative to Athena for adding up block data by district.
+
+Reads a per-state block index prepared from the same block Parquet files that
+back the Athena "blocks" table, and the districts partition Parquet that backs the
+"districts" table. Returns district totals in the same form as
+postread_calculate.resultset_to_district_totals(). Choose it with
+AGGREGATION_ENGINE=local in the environment.
+'''
+import io, re, collections
+import botocore.exceptions, numpy, pyarrow, pyarrow.parquet
+import shapely.wkb
+from . import data, score
+
+# Same location as the Athena "blocks" table for a model key_prefix
+BLOCKS_KEY_PREFIX = '{prefix}/blocks/'
+
+# Precomputed block index for a model key_prefix, outside the "blocks" table
+BLOCK_INDEX_KEY = '{prefix}/block-index.npz'
+
+POINT_PATTERN = re.compile(r'^\s*POINT\s*\(\s*(\S+)\s+(\S+)\s*\)\s*$', re.I)
+
+# District rows with an optional (xmin, ymin, xmax, ymax) bbox around each polygon
+PartitionRow = collections.namedtuple('PartitionRow', ('number', 'polygon', 'geoid20', 'bbox'), defaults=(None, ))
+
+# Sorted block GEOID keys with row-aligned point coordinates and a matrix of BLOCK_TABLE_FIELDS columns
+BlockIndex = collections.namedtuple('BlockIndex', ('keys', 'xs', 'ys', 'values', 'names'))
+
+# Uniform grid of square cells over block points, with point indexes ordered by cell
+PointGrid = collections.namedtuple('PointGrid', ('order', 'starts', 'xmin', 'ymin', 'size', 'columns', 'rows'))
+
+# Whole-state block indexes and point grids are large, so keep only a few
+STATE_CACHE_SIZE = 2
+
+class StateCache:
+    ''' Small LRU cache of per-state data by (bucket, prefix)
+
+        Lambda handlers make a new S3 client for each invocation, so clients
+        are left out of cache keys for warm invocations to find earlier loads.
+    '''
+    def __init__(self, maxsize=STATE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.items = collections.OrderedDict()
+
+    def clear(self):
+        self.items.clear()
+
+    def load(self, bucket, prefix, read):
+        ''' Return cached data for bucket and prefix, calling read() on a miss
+        '''
+        key = (bucket, prefix)
+
+        if key in self.items:
+            self.items.move_to_end(key)
+            return self.items[key]
+
+        value = self.items[key] = read()
+
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+        return value
+
+BLOCK_INDEXES, POINT_GRIDS = StateCache(), StateCache()
+
+def list_block_keys(storage, prefix):
+    ''' List all Parquet block files for a model key_prefix
+    '''
+    paginator = storage.s3.get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=storage.bucket, Prefix=BLOCKS_KEY_PREFIX.format(prefix=prefix))
+
+    return [
+        object['Key']
+        for page in pages
+        for object in page.get('Contents', [])
+        if object['Key'].endswith('.parquet')
+    ]
+
+def read_block_columns(file, names):
+    ''' Read named columns from one Parquet file into a dictionary of arrays.
+
+        Column names are matched without regard to case like Athena does,
+        and columns absent from the file are left out.
+    '''
+    parquet = pyarrow.parquet.ParquetFile(file)
+    file_names = {name.lower(): name for name in parquet.schema_arrow.names}
+    present = {name: file_names[name.lower()] for name in names if name.lower() in file_names}
+    table = parquet.read(columns=list(present.values()))
+    columns = {}
+
+    for (name, file_name) in present.items():
+        column = table.column(file_name)
+
+        if pyarrow.types.is_string(column.type) or pyarrow.types.is_large_string(column.type):
+            columns[name] = column.to_numpy(zero_copy_only=False)
+        else:
+            columns[name] = column.cast(pyarrow.float64()).to_numpy(zero_copy_only=False)
+
+    return table.num_rows, columns
+
+def load_blocks(storage, prefix, names):
+    ''' Load named block columns from every Parquet file for a model key_prefix
+
+        Returns a row count and a dictionary of arrays. Values missing from
+        some files are NaN or None like nulls in Athena.
+    '''
+    files = []
+
+    for key in list_block_keys(storage, prefix):
+        object = storage.s3.get_object(Bucket=storage.bucket, Key=key)
+        files.append(read_block_columns(io.BytesIO(object['Body'].read()), names))
+
+    found_names = [name for name in names if any(name in columns for (_, columns) in files)]
+    blocks = {}
+
+    for name in found_names:
+        is_string = any(columns[name].dtype.kind == 'O' for (_, columns) in files if name in columns)
+        blocks[name] = numpy.concatenate([
+            columns[name] if name in columns
+            else numpy.full(row_count, None if is_string else numpy.nan, dtype='O' if is_string else float)
+            for (row_count, columns) in files
+        ])
+
+    return sum([row_count for (row_count, _) in files]), blocks
+
+def load_partition(storage, upload):
+    ''' Load district rows for an upload from its districts partition Parquet
+    '''
+    object = storage.s3.get_object(
+        Bucket=storage.bucket,
+        Key=data.UPLOAD_DISTRICTS_PARTITION_KEY.format(id=upload.id),
+    )
+
+    table = pyarrow.parquet.read_table(io.BytesIO(object['Body'].read()),
+        columns=['Number', 'Polygon', 'GEOID20', 'XMin', 'YMin', 'XMax', 'YMax'])
+
+    return [
+        PartitionRow(number, polygon, geoid20, None if None in bbox else tuple(bbox))
+        for (number, polygon, geoid20, *bbox) in zip(*[column.to_pylist() for column in table.columns])
+    ]
+
+def read_points(point_wkts):
+    ''' Convert an array of WKT points to arrays of x and y, NaN where invalid
+    '''
+    xs, ys = numpy.full(len(point_wkts), numpy.nan), numpy.full(len(point_wkts), numpy.nan)
+
+    for (i, point_wkt) in enumerate(point_wkts):
+        match = POINT_PATTERN.match(point_wkt or '')
+        if match:
+            xs[i], ys[i] = float(match.group(1)), float(match.group(2))
+
+    return xs, ys
+
+def block_points(blocks, count):
+    ''' Return arrays of x and y for blocks from "Lon" and "Lat" columns
+
+        Blocks prepared before those columns have their "Point" WKT read instead.
+    '''
+    xs = numpy.array(blocks.get('Lon', numpy.full(count, numpy.nan)), dtype=float)
+    ys = numpy.array(blocks.get('Lat', numpy.full(count, numpy.nan)), dtype=float)
+    missing = numpy.flatnonzero(~(numpy.isfinite(xs) & numpy.isfinite(ys)))
+
+    if len(missing) and 'Point' in blocks:
+        xs[missing], ys[missing] = read_points(blocks['Point'][missing])
+
+    return xs, ys
+
+def build_point_grid(xs, ys, per_cell=16):
+    ''' Build a PointGrid with about per_cell points in each cell
+    
+        Points with NaN coordinates are left out.
+    '''
+    valid = numpy.flatnonzero(numpy.isfinite(xs) & numpy.isfinite(ys))
+    
+    if len(valid) == 0:
+        return PointGrid(valid, numpy.zeros(2, dtype=int), 0., 0., 1., 1, 1)
+    
+    xmin, ymin = xs[valid].min(), ys[valid].min()
+    width, height = xs[valid].max() - xmin, ys[valid].max() - ymin
+    
+    # Keep cell count bounded for points that are nearly all in a line
+    size = max(numpy.sqrt(width * height * per_cell / len(valid)), max(width, height) / 1024, 1e-9)
+    columns, rows = int(width // size) + 1, int(height // size) + 1
+
+    cells = (((ys[valid] - ymin) // size).astype(int) * columns
+        + ((xs[valid] - xmin) // size).astype(int))
+    cell_order = numpy.argsort(cells, kind='stable')
+    starts = numpy.searchsorted(cells[cell_order], numpy.arange(columns * rows + 1))
+
+    return PointGrid(valid[cell_order], starts, xmin, ymin, size, columns, rows)
+
+def grid_candidates(grid, bounds):
+    ''' Return indexes of points in grid cells overlapping a bounding box
+    '''
+    xmin, ymin, xmax, ymax = bounds
+    col1 = max(int((xmin - grid.xmin) // grid.size), 0)
+    col2 = min(int((xmax - grid.xmin) // grid.size), grid.columns - 1)
+    row1 = max(int((ymin - grid.ymin) // grid.size), 0)
+    row2 = min(int((ymax - grid.ymin) // grid.size), grid.rows - 1)
+    
+    if col1 > col2 or row1 > row2:
+        return numpy.array([], dtype=int)
+    
+    # Cells in each grid row are consecutive, so each row is one slice
+    row_cells = numpy.arange(row1, row2 + 1) * grid.columns
+    
+    return numpy.concatenate([
+        grid.order[start:stop] for (start, stop)
+        in zip(grid.starts[row_cells + col1], grid.starts[row_cells + col2 + 1])
+    ])
+
+def polygon_edges(geometry):
+    ''' Return x1, y1, x2, y2 arrays for every ring edge of a polygonal geometry
+    '''
+    rings = [
+        numpy.asarray(ring.coords)[:,:2]
+        for polygon in getattr(geometry, 'geoms', [geometry])
+        if polygon.geom_type == 'Polygon' and not polygon.is_empty
+        for ring in [polygon.exterior] + list(polygon.interiors)
+    ]
+    
+    if not rings:
+        return tuple(numpy.array([]) for _ in range(4))
+    
+    starts = numpy.concatenate([ring[:-1] for ring in rings])
+    ends = numpy.concatenate([ring[1:] for ring in rings])
+
+    return starts[:,0], starts[:,1], ends[:,0], ends[:,1]
+
+def contains_points(geometry, xs, ys):
+    ''' Return a boolean array for points inside a polygonal geometry
+    
+        Casts a ray toward +x from every point and counts edge crossings,
+        checking each edge only against points within its y-range. Points
+        exactly on a boundary may land on either side.
+    '''
+    x1, y1, x2, y2 = polygon_edges(geometry)
+    
+    order = numpy.argsort(ys, kind='stable')
+    sorted_xs, sorted_ys = xs[order], ys[order]
+    
+    # Edges cross a ray at py when min(y1, y2) <= py < max(y1, y2)
+    starts = numpy.searchsorted(sorted_ys, numpy.minimum(y1, y2), 'left')
+    stops = numpy.searchsorted(sorted_ys, numpy.maximum(y1, y2), 'left')
+    counts = stops - starts
+
+    # One row for each pair of edge and point within the edge's y-range
+    edge_ids = numpy.repeat(numpy.arange(len(x1)), counts)
+    positions = numpy.arange(counts.sum()) + numpy.repeat(starts - (numpy.cumsum(counts) - counts), counts)
+    px, py = sorted_xs[positions], sorted_ys[positions]
+    
+    ex1, ey1, ex2, ey2 = x1[edge_ids], y1[edge_ids], x2[edge_ids], y2[edge_ids]
+    cross_xs = ex1 + (py - ey1) * (ex2 - ex1) / (ey2 - ey1)
+    crossings = numpy.bincount(positions[cross_xs > px], minlength=len(xs))
+
+    is_inside = numpy.zeros(len(xs), dtype=bool)
+    is_inside[order] = (crossings % 2 == 1)
+    
+    return is_inside
+
+def match_points(index, grid, partition):
+    ''' Return arrays of block indexes and district numbers for blocks within districts
+    '''
+    block_indexes, numbers = [], []
+
+    for row in partition:
+        if row.polygon is None:
+            continue
+
+        geometry = shapely.wkb.loads(row.polygon) if row.bbox is None else None
+        xmin, ymin, xmax, ymax = geometry.bounds if row.bbox is None else row.bbox
+        candidates = grid_candidates(grid, (xmin, ymin, xmax, ymax))
+
+        # Only points inside the bbox need a point-in-polygon test
+        xs, ys = index.xs[candidates], index.ys[candidates]
+        candidates = candidates[(xs >= xmin) & (xs <= xmax) & (ys >= ymin) & (ys <= ymax)]
+
+        if len(candidates) == 0:
+            continue
+
+        if geometry is None:
+            # Polygons are read only for bboxes with blocks
+            geometry = shapely.wkb.loads(row.polygon)
+
+        is_inside = contains_points(geometry, index.xs[candidates], index.ys[candidates])
+        block_indexes.append(candidates[is_inside])
+        numbers.append(numpy.full(is_inside.sum(), row.number, dtype=int))
+    
+    if not block_indexes:
+        return numpy.array([], dtype=int), numpy.array([], dtype=int)
+
+    block_indexes, numbers = numpy.concatenate(block_indexes), numpy.concatenate(numbers)
+    order = numpy.argsort(block_indexes, kind='stable')
+
+    return block_indexes[order], numbers[order]
+
+def geoid_keys(geoids):
+    ''' Convert GEOID strings to an array of integer keys, -1 for non-GEOIDs.
+
+        A leading "1" digit keeps GEOIDs like "01" and "001" apart.
+    '''
+    return numpy.array([
+        int('1' + geoid) if geoid and len(geoid) <= 17 and geoid.isascii() and geoid.isdigit() else -1
+        for geoid in geoids
+    ], dtype=numpy.int64)
+
+def build_block_index(blocks):
+    ''' Build a BlockIndex from a dictionary of block column arrays
+
+        Expects a "GEOID20" array, "Lon" and "Lat" or "Point" centroids, and
+        any of the BLOCK_TABLE_FIELDS columns. Blocks without a GEOID are left out,
+        and blocks without a point get NaN coordinates.
+    '''
+    keys = geoid_keys(blocks.get('GEOID20', []))
+    order = numpy.argsort(keys, kind='stable')
+    order = order[keys[order] != -1]
+
+    names = [name for (name, _, _) in score.BLOCK_TABLE_FIELDS if name in blocks]
+    values = numpy.empty((len(order), len(names)), dtype=float, order='F')
+
+    for (i, name) in enumerate(names):
+        values[:,i] = blocks[name][order]
+    
+    xs, ys = block_points(blocks, len(keys))
+
+    return BlockIndex(keys[order], xs[order], ys[order], values, names)
+
+def write_block_index(index, file):
+    ''' Write a BlockIndex to a file as uncompressed .npz
+    '''
+    numpy.savez(file, keys=index.keys, xs=index.xs, ys=index.ys, values=index.values,
+        names=numpy.array(index.names, dtype=str))
+
+def read_block_index(file):
+    ''' Read a BlockIndex from an .npz file
+    '''
+    with numpy.load(file) as arrays:
+        return BlockIndex(arrays['keys'], arrays['xs'], arrays['ys'],
+            arrays['values'], arrays['names'].tolist())
+
+def load_block_index(s3, bucket, prefix):
+    ''' Load a BlockIndex for a model key_prefix, once per process
+    
+        Falls back to building one from the block Parquet files if no
+        precomputed index has been uploaded by prepare_state.
+    '''
+    return BLOCK_INDEXES.load(bucket, prefix, lambda: read_state_block_index(s3, bucket, prefix))
+
+def read_state_block_index(s3, bucket, prefix):
+    ''' Read a BlockIndex for a model key_prefix from S3
+    '''
+    try:
+        object = s3.get_object(Bucket=bucket, Key=BLOCK_INDEX_KEY.format(prefix=prefix))
+    except botocore.exceptions.ClientError:
+        print(f'Building block index from s3://{bucket}/{BLOCKS_KEY_PREFIX.format(prefix=prefix)}')
+        names = [name for (name, _, _) in score.BLOCK_TABLE_FIELDS] + ['GEOID20', 'Point', 'Lon', 'Lat']
+        _, blocks = load_blocks(data.Storage(s3, bucket, prefix), prefix, names)
+        return build_block_index(blocks)
+    else:
+        return read_block_index(io.BytesIO(object['Body'].read()))
+
+def load_point_grid(s3, bucket, prefix):
+    ''' Load a PointGrid of block points for a model key_prefix, once per process
+    '''
+    def read():
+        index = load_block_index(s3, bucket, prefix)
+        return build_point_grid(index.xs, index.ys)
+    
+    return POINT_GRIDS.load(bucket, prefix, read)
+
+def match_geoids(keys, partition):
+    ''' Return arrays of block indexes and district numbers for assigned block GEOIDs
+
+        Block keys must be sorted and unique, as in a BlockIndex.
+    '''
+    rows = [row for row in partition if row.geoid20 is not None]
+    row_keys = geoid_keys([row.geoid20 for row in rows])
+    numbers = numpy.array([row.number for row in rows], dtype=int)
+
+    if len(keys) == 0:
+        return numpy.array([], dtype=int), numpy.array([], dtype=int)
+
+    block_indexes = numpy.minimum(numpy.searchsorted(keys, row_keys), len(keys) - 1)
+    is_found = (keys[block_indexes] == row_keys) & (row_keys != -1)
+
+    # Return blocks in index order so that reading their values is sequential
+    order = numpy.argsort(block_indexes[is_found], kind='stable')
+
+    return block_indexes[is_found][order], numbers[is_found][order]
+
+def aggregate_blocks(blocks, block_indexes, numbers):
+    ''' Add up block columns by district number like the Athena query.
+
+        Returns a list of district totals dictionaries, one for each district
+        number with at least one block, ordered by district number. Nulls are
+        skipped, and a total with no values is left out. Medians are exact
+        where Athena uses APPROX_PERCENTILE().
+    '''
+    district_numbers, district_indexes = numpy.unique(numbers, return_inverse=True)
+    district_totals = [{'district_number': int(number)} for number in district_numbers]
+    district_sizes = numpy.bincount(district_indexes, minlength=len(district_numbers))
+    order = numpy.argsort(district_indexes, kind='stable')
+
+    for (name, type, aggregator) in score.BLOCK_TABLE_FIELDS:
+        if name not in blocks:
+            continue
+
+        values = blocks[name][block_indexes]
+        has_value = ~numpy.isnan(values)
+
+        if has_value.all():
+            # Skip masking for the common case of complete block data
+            counts = district_sizes
+        else:
+            counts = numpy.bincount(district_indexes[has_value], minlength=len(district_numbers))
+
+        if aggregator == score.Aggregator.Sum:
+            sums = numpy.bincount(district_indexes,
+                weights=numpy.where(has_value, values, 0.), minlength=len(district_numbers))
+
+            for (totals, count, total) in zip(district_totals, counts, sums):
+                if count > 0:
+                    totals[name] = int(round(float(total))) if type is int else float(total)
+
+        elif aggregator == score.Aggregator.Median:
+            groups = numpy.split(values[order], numpy.cumsum(district_sizes)[:-1])
+
+            for (totals, count, group) in zip(district_totals, counts, groups):
+                if count > 0:
+                    totals[name] = float(numpy.median(group[~numpy.isnan(group)]))
+
+    return district_totals
+
+def accumulate_district_totals(storage, upload, is_spatial):
+    ''' Add up block data by district for an upload.
+
+        Yields a single ("SUCCEEDED", totals) pair, to stand in for the Athena
+        query status sequence from postread_calculate.accumulate_district_totals().
+    '''
+    index = load_block_index(storage.s3, storage.bucket, upload.model.key_prefix)
+    blocks = {name: index.values[:,i] for (i, name) in enumerate(index.names)}
+    partition = load_partition(storage, upload)
+
+    if is_spatial:
+        grid = load_point_grid(storage.s3, storage.bucket, upload.model.key_prefix)
+        block_indexes, numbers = match_points(index, grid, partition)
+    else:
+        block_indexes, numbers = match_geoids(index.keys, partition)
+
+    yield ('SUCCEEDED', aggregate_blocks(blocks, block_indexes, numbers))
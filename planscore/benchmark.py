@@ -0,0 +1,276 @@
+''' Offline timing of the scoring pipeline's hot paths with synthetic plans.
+
+Generates random plans from 2 to 400 districts, with and without incumbents,
+for each model version, and times model loading, vote modeling, each stage of
+score.calculate_everything(), compactness, block assignment parsing, and
+geometry partitioning. Save results as JSON with --output, and compare a later
+run against them with --baseline to see regressions before deploying.
+'''
+import io, sys, json, time, argparse, platform, collections
+import numpy
+import osgeo.ogr
+from . import data, matrix, score, util, compactness, postread_calculate
+
+DISTRICT_COUNTS = (2, 14, 52, 120, 400)
+MODEL_VERSIONS = ('2025A', '2025B')
+
+# Ratio over baseline timing that counts as a regression
+REGRESSION_THRESHOLD = 1.25
+
+# Differences smaller than this are timer noise, in seconds
+REGRESSION_MINIMUM = .005
+
+Case = collections.namedtuple('Case', ('version', 'district_count', 'has_incumbents'))
+
+def case_name(case):
+    '''
+    '''
+    incumbency = 'incumbents' if case.has_incumbents else 'open'
+    return f'{case.version}-{case.district_count:03d}-{incumbency}'
+
+def case_house(case):
+    ''' Use state legislative models where a version has them
+    '''
+    params = data.VERSION_PARAMETERS[case.version]
+
+    if matrix.has_matrices(params.path_suffix, '-openseat-statelege'):
+        return data.House.statehouse
+
+    return data.House.ushouse
+
+def make_upload(case, seed=0):
+    ''' Return a synthetic Upload with random presidential and senate votes,
+        and "DEM000"-style simulated votes from the case's own model
+    '''
+    random = numpy.random.default_rng(seed)
+    totals = random.uniform(100000, 300000, case.district_count)
+    blue_shares = random.beta(4, 4, case.district_count)
+
+    # Always include 2020 votes, which calculate_district_biases() looks for
+    years = sorted({2020} | set(data.VERSION_PARAMETERS[case.version].pvotes))
+    districts = []
+
+    for (total, blue_share) in zip(totals, blue_shares):
+        district_totals = {
+            'Population 2020': int(total * 2.5),
+            'US Senate 2020 - DEM': round(total * blue_share * .95, 1),
+            'US Senate 2020 - REP': round(total * (1 - blue_share) * .95, 1),
+        }
+
+        for year in years:
+            district_totals[f'US President {year} - DEM'] = round(total * blue_share, 1)
+            district_totals[f'US President {year} - REP'] = round(total * (1 - blue_share), 1)
+
+        districts.append(dict(totals=district_totals, compactness={}))
+
+    if case.has_incumbents:
+        incumbents = random.choice(['D', 'R', 'O'], case.district_count).tolist()
+    else:
+        incumbents = ['O'] * case.district_count
+
+    model = data.Model(data.State.NC, case_house(case), case.district_count,
+        case.has_incumbents, [case.version], 'data/NC/benchmark')
+
+    upload = data.Upload(id=case_name(case), key=None, model=model, districts=districts,
+        incumbents=incumbents, model_version=case.version)
+
+    return add_simulations(upload)
+
+def add_simulations(upload):
+    ''' Return a copy of an Upload with simulated votes for every incumbency condition
+
+        Unprefixed fields are read by score.calculate_open_biases() and
+        prefixed ones by score.calculate_biases(), so both stages get timed.
+    '''
+    district_data = matrix.filter_district_data(matrix.prepare_district_data(upload))
+    districts = [dict(district, totals=dict(district['totals'])) for district in upload.districts]
+
+    for condition in score.SIM_CONDITIONS:
+        incumbency = condition or data.Incumbency.Open.value
+        condition_data = [(blue, red, incumbency) for (blue, red, _) in district_data]
+
+        # DxSx2 array of Democratic and Republican votes
+        votes = matrix.model_votes(upload.model_version, upload.model.state,
+            upload.model.house, condition_data)
+
+        for (district, district_votes) in zip(districts, votes):
+            for (sim, (blue_votes, red_votes)) in enumerate(district_votes.tolist()):
+                for (party, value) in (('DEM', blue_votes), ('REP', red_votes)):
+                    field = score.FIELD_TMPL.format(incumbent=condition, party=party, sim=sim)
+                    district['totals'][field.lstrip(':')] = value
+
+    return upload.clone(districts=districts)
+
+def make_geometry_wkts(district_count, vertex_count=2000, seed=0):
+    ''' Return WKT for side-by-side districts with wiggly edges
+    '''
+    random = numpy.random.default_rng(seed)
+    ys = numpy.linspace(34., 36., vertex_count // 2)
+    phases = random.uniform(0, numpy.pi, district_count + 1)
+    width = 8. / district_count
+
+    edges = [
+        -84. + i * width + width / 4 * numpy.sin(ys * 40 + phase)
+        for (i, phase) in enumerate(phases)
+    ]
+
+    wkts = []
+
+    for (left, right) in zip(edges[:-1], edges[1:]):
+        xs = numpy.concatenate([left, right[::-1], left[:1]])
+        ring_ys = numpy.concatenate([ys, ys[::-1], ys[:1]])
+        coords = ', '.join(f'{x:.6f} {y:.6f}' for (x, y) in zip(xs, ring_ys))
+        wkts.append(f'POLYGON (({coords}))')
+
+    return wkts
+
+def make_baf_text(district_count, block_count, seed=0):
+    ''' Return block assignment file text with a header row
+    '''
+    random = numpy.random.default_rng(seed)
+    districts = random.integers(1, district_count + 1, block_count)
+    lines = [f'37{i:013d},{district}' for (i, district) in enumerate(districts)]
+
+    return 'GEOID20,DISTRICT\n' + '\n'.join(lines) + '\n'
+
+def time_stage(function, repeat):
+    ''' Return best elapsed seconds over repeated calls, and the last result
+    '''
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+
+    return min(times), result
+
+def run_case(case, repeat=3, block_count=100000):
+    ''' Return a dictionary of stage names and best elapsed seconds for one case
+    '''
+    timings = {}
+    upload1 = make_upload(case)
+    params = data.VERSION_PARAMETERS[case.version]
+    is_congress = bool(upload1.model.house == data.House.ushouse)
+    state = matrix.STATE[upload1.model.state]
+
+    def load_model_cold():
+        matrix.load_matrices.cache_clear()
+        return matrix.load_model(params.path_suffix, state, params.year, case.has_incumbents, is_congress)
+
+    def load_model():
+        return matrix.load_model(params.path_suffix, state, params.year, case.has_incumbents, is_congress)
+
+    district_data = matrix.filter_district_data(matrix.prepare_district_data(upload1))
+
+    def model_votes():
+        return matrix.model_votes(case.version, upload1.model.state, upload1.model.house, district_data)
+
+    timings['matrix.load_model (cold)'], _ = time_stage(load_model_cold, 1)
+    timings['matrix.load_model'], _ = time_stage(load_model, repeat)
+    timings['matrix.model_votes'], _ = time_stage(model_votes, repeat)
+
+    # Stages of score.calculate_everything(), in order
+    timings['score.calculate_bias'], upload2 = time_stage(lambda: score.calculate_bias(upload1), repeat)
+    timings['score.load_simulations'], simulations = \
+        time_stage(lambda: score.load_simulations(upload2.districts), repeat)
+    timings['score.calculate_open_biases'], upload3 = \
+        time_stage(lambda: score.calculate_open_biases(upload2, simulations), repeat)
+    timings['score.calculate_biases'], upload4 = \
+        time_stage(lambda: score.calculate_biases(upload3, simulations), repeat)
+    timings['score.calculate_district_biases'], upload5 = \
+        time_stage(lambda: score.calculate_district_biases(upload4), repeat)
+    timings['score.calculate_fva_biases'], _ = time_stage(lambda: score.calculate_fva_biases(upload5), repeat)
+    timings['score.calculate_everything'], _ = time_stage(lambda: score.calculate_everything(upload1), repeat)
+
+    geometries = [osgeo.ogr.CreateGeometryFromWkt(wkt) for wkt in make_geometry_wkts(case.district_count)]
+
+    timings['compactness.get_scores'], _ = \
+        time_stage(lambda: [compactness.get_scores(geometry) for geometry in geometries], repeat)
+    timings['postread_calculate.partition_large_geometries'], _ = time_stage(lambda: [
+        postread_calculate.partition_large_geometries(geometry) for geometry in geometries
+    ], repeat)
+
+    baf_text = make_baf_text(case.district_count, block_count)
+
+    timings['util.baf_stream_to_pairs'], _ = \
+        time_stage(lambda: util.baf_stream_to_pairs(io.StringIO(baf_text)), repeat)
+    timings['util.read_baf'], _ = time_stage(lambda: util.read_baf(io.StringIO(baf_text)), repeat)
+
+    return timings
+
+def run_cases(cases, repeat=3, block_count=100000):
+    ''' Return benchmark results for a list of cases, suitable for JSON
+    '''
+    return {
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'machine': platform.machine(),
+        'cases': {
+            case_name(case): run_case(case, repeat, block_count)
+            for case in cases
+        },
+    }
+
+def compare_results(baseline, results, threshold=REGRESSION_THRESHOLD, minimum=REGRESSION_MINIMUM):
+    ''' Return a list of (case, stage, baseline seconds, seconds) for regressions
+    '''
+    regressions = []
+
+    for (name, timings) in sorted(results['cases'].items()):
+        for (stage, elapsed) in timings.items():
+            before = baseline['cases'].get(name, {}).get(stage)
+
+            if before is None:
+                continue
+
+            if elapsed > before * threshold and elapsed - before > minimum:
+                regressions.append((name, stage, before, elapsed))
+
+    return regressions
+
+parser = argparse.ArgumentParser(description='Time the scoring pipeline with synthetic plans')
+
+parser.add_argument('--districts', type=int, nargs='+', default=DISTRICT_COUNTS,
+    help='District counts to try. Default {}.'.format(' '.join(map(str, DISTRICT_COUNTS))))
+parser.add_argument('--versions', nargs='+', default=MODEL_VERSIONS, choices=list(data.VERSION_PARAMETERS),
+    help='Model versions to try. Default {}.'.format(' '.join(MODEL_VERSIONS)))
+parser.add_argument('--repeat', type=int, default=3,
+    help='Number of times to repeat each stage. Default 3.')
+parser.add_argument('--blocks', type=int, default=100000,
+    help='Number of rows in synthetic block assignment files. Default 100000.')
+parser.add_argument('--output', help='Path to save JSON results')
+parser.add_argument('--baseline', help='Path to JSON results to compare against')
+parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+    help='Ratio over baseline that counts as a regression. Default {}.'.format(REGRESSION_THRESHOLD))
+
+def main():
+    args = parser.parse_args()
+
+    cases = [
+        Case(version, district_count, has_incumbents)
+        for version in args.versions
+        for district_count in args.districts
+        for has_incumbents in (False, True)
+    ]
+
+    results = run_cases(cases, args.repeat, args.blocks)
+
+    for (name, timings) in results['cases'].items():
+        for (stage, elapsed) in timings.items():
+            print(f'{name:24} {stage:48} {elapsed * 1000:10.1f} msec')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare_results(json.load(file), results, args.threshold)
+
+        for (name, stage, before, elapsed) in regressions:
+            print(f'Slower: {name} {stage} from {before * 1000:.1f} to {elapsed * 1000:.1f} msec',
+                file=sys.stderr)
+
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,203 @@
+''' Compact, memory-mappable county block graphs for polygonize.
+
+Replaces gzipped NetworkX pickles, whose per-edge dictionaries of Shapely
+lines are slow to load and large in memory. A converted graph is a set of
+flat arrays in an uncompressed .npz file:
+
+    node_ids       sorted block GEOID bytes, including "outside" and neighbors
+    pos            representative point for each node, NaN where missing
+    indptr         CSR offsets of each node's outgoing edges into targets
+    targets        node index at the far end of each edge
+    line_offsets   offsets of each edge's boundary line into line_wkb
+    line_wkb       concatenated WKB boundary lines
+
+Convert existing pickles with planscore-graph-convert, and pass --s3 to
+convert pickles in the PlanScore bucket and upload each graph beside its
+pickle under polygonize.BLOCK_GRAPH_KEY.
+
+Polygonize reads these files fully into memory with mmap=False, because its
+disk cache deletes files that a memory map would keep holding onto. Memory
+mapping remains the default for local tools that read graphs in place.
+'''
+import io, os, gzip, pickle, struct, zipfile, argparse, tempfile, collections
+import boto3, numpy
+import shapely.wkb
+from . import constants
+
+BlockGraph = collections.namedtuple('BlockGraph',
+    ('node_ids', 'pos', 'indptr', 'targets', 'line_offsets', 'line_wkb'))
+
+def read_pickle_graph(path):
+    ''' Read a NetworkX graph pickle, gzipped if the path ends in .gz
+    '''
+    opener = gzip.open if path.endswith('.gz') else open
+
+    with opener(path, 'rb') as file:
+        return pickle.load(file)
+
+def from_digraph(graph):
+    ''' Return a BlockGraph for a NetworkX DiGraph with node "pos" and edge "line"
+    '''
+    node_ids = sorted(graph.nodes)
+    node_index = {node_id: i for (i, node_id) in enumerate(node_ids)}
+    indptr, targets, wkbs = [0], [], []
+
+    for node_id in node_ids:
+        for target_id in sorted(graph.successors(node_id)):
+            targets.append(node_index[target_id])
+            wkbs.append(shapely.wkb.dumps(graph.edges[(node_id, target_id)]['line']))
+
+        indptr.append(len(targets))
+
+    pos = [graph.nodes[node_id].get('pos', (numpy.nan, numpy.nan)) for node_id in node_ids]
+
+    return BlockGraph(
+        numpy.array([node_id.encode('ascii') for node_id in node_ids], dtype=bytes),
+        numpy.array(pos, dtype=float).reshape((len(node_ids), 2)),
+        numpy.array(indptr, dtype=numpy.int64),
+        numpy.array(targets, dtype=numpy.int64),
+        numpy.cumsum([0] + [len(wkb) for wkb in wkbs], dtype=numpy.int64),
+        numpy.frombuffer(b''.join(wkbs), dtype=numpy.uint8),
+    )
+
+def write_block_graph(graph, file):
+    ''' Write a BlockGraph to an uncompressed .npz file so it can be memory-mapped
+    '''
+    numpy.savez(file, **graph._asdict())
+
+def _npz_member_offsets(path):
+    ''' Generate (name, data offset) for each array stored in an uncompressed .npz
+    '''
+    with zipfile.ZipFile(path) as archive:
+        infos = archive.infolist()
+
+    with open(path, 'rb') as file:
+        for info in infos:
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f'Compressed {info.filename} cannot be memory-mapped')
+
+            # Skip the local file header, whose extra field can differ from the central directory
+            file.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', file.read(4))
+            file.seek(info.header_offset + 30 + name_length + extra_length)
+
+            yield os.path.splitext(info.filename)[0], file.tell()
+
+def read_block_graph(path, mmap=True):
+    ''' Return a BlockGraph with arrays memory-mapped or read from a .npz file
+
+        Mapped files keep their disk space until the arrays are released,
+        even after being deleted, so read them with mmap=False to keep disk
+        use apart from memory use.
+    '''
+    if not mmap:
+        with numpy.load(path) as npz:
+            return BlockGraph(**{name: npz[name] for name in BlockGraph._fields})
+
+    arrays = {}
+
+    with open(path, 'rb') as file:
+        for (name, offset) in _npz_member_offsets(path):
+            file.seek(offset)
+            version = numpy.lib.format.read_magic(file)
+
+            if version == (1, 0):
+                shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(file)
+
+            if 0 in shape:
+                # Zero-length files cannot be mapped
+                arrays[name] = numpy.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = numpy.memmap(path, dtype=dtype, mode='r', offset=file.tell(),
+                    shape=shape, order='F' if fortran_order else 'C')
+
+    return BlockGraph(**arrays)
+
+def find_nodes(node_ids, wanted_ids):
+    ''' Return indexes into sorted node_ids for wanted_ids, and a mask of those found
+    '''
+    if len(node_ids) == 0:
+        return numpy.zeros(len(wanted_ids), dtype=int), numpy.zeros(len(wanted_ids), dtype=bool)
+
+    indexes = numpy.minimum(numpy.searchsorted(node_ids, wanted_ids), len(node_ids) - 1)
+
+    return indexes, node_ids[indexes] == wanted_ids
+
+def district_boundary(graphs, block_ids):
+    ''' Return block points and WKB boundary lines for a district over BlockGraphs
+
+        Like networkx.algorithms.boundary.edge_boundary(), finds each edge
+        leading from a district block to a block outside it. Where graphs
+        share a node or an edge, later graphs win as in merge_digraphs().
+    '''
+    district_ids = numpy.unique(numpy.array([id.encode('ascii') for id in block_ids], dtype=bytes))
+    points, lines = {}, {}
+
+    for graph in graphs:
+        rows, found = find_nodes(graph.node_ids, district_ids)
+        rows = rows[found]
+
+        for (node_id, xy) in zip(district_ids[found], graph.pos[rows]):
+            if not numpy.isnan(xy).any():
+                points[node_id] = tuple(xy)
+
+        # Expand each node's CSR range into a flat list of edge indexes
+        starts, counts = graph.indptr[rows], graph.indptr[rows + 1] - graph.indptr[rows]
+        firsts = numpy.cumsum(counts) - counts
+        edges = numpy.arange(counts.sum()) - numpy.repeat(firsts - starts, counts)
+        sources = numpy.repeat(rows, counts)
+
+        target_ids = graph.node_ids[graph.targets[edges]]
+        _, inside = find_nodes(district_ids, target_ids)
+
+        for (edge, source, target_id) in zip(edges[~inside], sources[~inside], target_ids[~inside]):
+            start, stop = graph.line_offsets[edge], graph.line_offsets[edge + 1]
+            lines[(graph.node_ids[source], target_id)] = bytes(graph.line_wkb[start:stop])
+
+    return list(points.values()), list(lines.values())
+
+def npz_path(path):
+    ''' Return a .npz path or S3 key next to a *-tabblock.pickle or *.pickle.gz one
+    '''
+    base = path[:-len('.gz')] if path.endswith('.gz') else path
+    return os.path.splitext(base)[0] + '.npz'
+
+def convert_s3_graph(s3, bucket, key):
+    ''' Convert a NetworkX pickle in S3 and upload its compact graph, returning the new key
+    '''
+    npz_key = npz_path(key)
+
+    with tempfile.TemporaryDirectory() as dirname:
+        path = os.path.join(dirname, os.path.basename(key))
+        s3.download_file(Bucket=bucket, Key=key, Filename=path)
+        buffer = io.BytesIO()
+        write_block_graph(from_digraph(read_pickle_graph(path)), buffer)
+
+    s3.put_object(Bucket=bucket, Key=npz_key, Body=buffer.getvalue(),
+        ContentType='application/octet-stream')
+
+    return npz_key
+
+parser = argparse.ArgumentParser(description='Convert NetworkX county graph pickles to compact .npz files')
+parser.add_argument('paths', nargs='+', help='Paths to *-tabblock.pickle or *-tabblock.pickle.gz files')
+parser.add_argument('--s3', action='store_true',
+    help='Treat paths as S3 keys and upload graphs to S3 instead of local directory')
+
+def main():
+    ''' Write a compact .npz graph next to each NetworkX pickle
+    '''
+    args = parser.parse_args()
+    s3 = boto3.client('s3') if args.s3 else None
+
+    for path in args.paths:
+        if s3 is not None:
+            key = convert_s3_graph(s3, constants.S3_BUCKET, path)
+            print(f's3://{constants.S3_BUCKET}/{key}')
+            continue
+
+        with open(npz_path(path), 'wb') as file:
+            write_block_graph(from_digraph(read_pickle_graph(path)), file)
+
+        print(npz_path(path))
@@ -1,6 +1,7 @@
-import math, itertools
+import os, math, collections, multiprocessing
 from osgeo import ogr, osr
-from . import smallestenclosingcircle
+import numpy
+from . import minimumcircle
 from .. import constants
 
 # Spherical mercator should work at typical district sizes
@@ -13,59 +14,160 @@ EPSG3857.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
 
 projection = osr.CoordinateTransformation(EPSG4326, EPSG3857)
 
-def get_scores(geometry):
-    ''' Return dictionary of compactness scores for a geographic area.
-    '''
-    scores = dict()
-    
-    try:
-        scores['Reock'] = get_reock_score(geometry)
-    except Exception:
-        scores['Reock'] = None
-    
-    try:
-        scores['Polsby-Popper'] = get_polsbypopper_score(geometry)
-    except Exception:
-        scores['Polsby-Popper'] = None
-    
-    return scores
+# Plans with at least this many districts are scored in parallel processes
+PARALLEL_MIN_COUNT = 32
 
-def get_reock_score(geometry):
-    ''' Return area ratio of geometry to minimum bounding circle
-        
-        More on Reock score:
-        https://github.com/cicero-data/compactness-stats/wiki#reock
+# District shape in EPSG:3857 with an (n, 2) array of boundary points, shared by every metric below
+ProjectedShape = collections.namedtuple('ProjectedShape', ('geometry', 'area', 'perimeter', 'points'))
+
+def project_geometry(geometry):
+    ''' Return ProjectedShape with one reprojection and boundary for a geographic area.
     '''
     projected = geometry.Clone()
     projected.Transform(projection)
     boundary = projected.GetBoundary()
-    geom_area = projected.GetArea()
     
     if boundary.GetGeometryType() in (ogr.wkbMultiLineString, ogr.wkbMultiLineString25D):
         geoms = [boundary.GetGeometryRef(i) for i in range(boundary.GetGeometryCount())]
-        points = itertools.chain(*[[geom.GetPoint(i)[:2]
-            for i in range(1, geom.GetPointCount())] for geom in geoms])
     else:
-        points = [boundary.GetPoint(i)[:2] for i in range(1, boundary.GetPointCount())]
+        geoms = [boundary]
+    
+    # Skip the first point of each ring, which repeats the last
+    points = numpy.concatenate([numpy.empty((0, 2))] + [numpy.array(geom.GetPoints(), dtype=float)[1:,:2]
+        for geom in geoms if geom.GetPointCount() > 1])
+    
+    return ProjectedShape(projected, projected.GetArea(), sum([geom.Length() for geom in geoms]), points)
 
-    _, _, radius = smallestenclosingcircle.make_circle(points)
-    return round(geom_area / (math.pi * radius * radius), constants.ROUND_FLOAT)
+def reock_score(shape):
+    ''' Return area ratio of ProjectedShape to minimum bounding circle
+        
+        More on Reock score:
+        https://github.com/cicero-data/compactness-stats/wiki#reock
+    '''
+    # Only convex hull vertices can touch the bounding circle
+    _, _, radius = minimumcircle.make_circle(minimumcircle.convex_hull(shape.points))
+    return round(shape.area / (math.pi * radius * radius), constants.ROUND_FLOAT)
 
-def get_polsbypopper_score(geometry):
-    ''' Return area ratio of geometry to equal-perimeter circle
+def polsbypopper_score(shape):
+    ''' Return area ratio of ProjectedShape to equal-perimeter circle
     
         More on Polsby-Popper score:
         https://github.com/cicero-data/compactness-stats/wiki#polsby-popper
     '''
-    projected = geometry.Clone()
-    projected.Transform(projection)
-    boundary = projected.GetBoundary()
-    geom_area = projected.GetArea()
+    return round(4 * math.pi * shape.area / shape.perimeter**2, constants.ROUND_FLOAT)
+
+def schwartzberg_score(shape):
+    ''' Return perimeter ratio of equal-area circle to ProjectedShape
     
-    if boundary.GetGeometryType() in (ogr.wkbMultiLineString, ogr.wkbMultiLineString25D):
-        geoms = [boundary.GetGeometryRef(i) for i in range(boundary.GetGeometryCount())]
-        length = sum([geom.Length() for geom in geoms])
-    else:
-        length = boundary.Length()
+        More on Schwartzberg score:
+        https://github.com/cicero-data/compactness-stats/wiki#schwartzberg
+    '''
+    return round(2 * math.sqrt(math.pi * shape.area) / shape.perimeter, constants.ROUND_FLOAT)
+
+def convexhull_score(shape):
+    ''' Return area ratio of ProjectedShape to its convex hull
+    
+        More on Convex Hull score:
+        https://github.com/cicero-data/compactness-stats/wiki#convex-hull
+    '''
+    return round(shape.area / shape.geometry.ConvexHull().GetArea(), constants.ROUND_FLOAT)
 
-    return round(4 * math.pi * geom_area / length**2, constants.ROUND_FLOAT)
+# Every known metric by score name, each a function of one ProjectedShape
+METRICS = {
+    'Reock': reock_score,
+    'Polsby-Popper': polsbypopper_score,
+    'Schwartzberg': schwartzberg_score,
+    'Convex Hull': convexhull_score,
+}
+
+# Metrics included with each district's scores
+DEFAULT_METRICS = ('Reock', 'Polsby-Popper')
+
+def get_scores(geometry, metrics=DEFAULT_METRICS):
+    ''' Return dictionary of compactness scores for a geographic area.
+    '''
+    try:
+        shape = project_geometry(geometry)
+    except Exception:
+        return {name: None for name in metrics}
+    
+    scores = dict()
+    
+    for name in metrics:
+        try:
+            scores[name] = METRICS[name](shape)
+        except Exception:
+            scores[name] = None
+    
+    return scores
+
+def _scores_worker(connection, geometries, indexes, metrics):
+    ''' Send (index, scores) pairs for geometries back through a pipe
+    '''
+    try:
+        connection.send([(index, get_scores(geometries[index], metrics)) for index in indexes])
+    except Exception as error:
+        connection.send(error)
+    finally:
+        connection.close()
+
+def get_plan_scores(geometries, metrics=DEFAULT_METRICS, processes=None):
+    ''' Return a list of compactness score dictionaries for all districts in a plan
+    
+        Large plans are spread over forked processes that share geometries
+        without copying them. Pipes are used instead of multiprocessing.Pool,
+        which needs /dev/shm and is not available in Lambda.
+    '''
+    if processes is None:
+        processes = (os.cpu_count() or 1) if len(geometries) >= PARALLEL_MIN_COUNT else 1
+    
+    processes = min(processes, len(geometries))
+    
+    if processes <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        return [get_scores(geometry, metrics) for geometry in geometries]
+    
+    context = multiprocessing.get_context('fork')
+    workers, scores = [], [None] * len(geometries)
+    
+    for offset in range(processes):
+        receiver, sender = context.Pipe(duplex=False)
+        indexes = list(range(offset, len(geometries), processes))
+        process = context.Process(target=_scores_worker, args=(sender, geometries, indexes, metrics))
+        process.start()
+        sender.close()
+        workers.append((process, receiver))
+    
+    errors = []
+    
+    # Drain and join every worker before raising any one error
+    for (process, receiver) in workers:
+        try:
+            results = receiver.recv()
+        except EOFError:
+            results = None
+        finally:
+            receiver.close()
+            process.join()
+        
+        if results is None:
+            errors.append(RuntimeError(f'Compactness process exited with code {process.exitcode}'))
+        elif isinstance(results, Exception):
+            errors.append(results)
+        else:
+            for (index, district_scores) in results:
+                scores[index] = district_scores
+    
+    if errors:
+        raise errors[0]
+    
+    return scores
+
+def get_reock_score(geometry):
+    ''' Return area ratio of geometry to minimum bounding circle
+    '''
+    return reock_score(project_geometry(geometry))
+
+def get_polsbypopper_score(geometry):
+    ''' Return area ratio of geometry to equal-perimeter circle
+    '''
+    return polsbypopper_score(project_geometry(geometry))
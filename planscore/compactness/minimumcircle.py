@@ -0,0 +1,184 @@
+''' Minimum enclosing circles for large point sets, using NumPy.
+
+Follows the structure of Welzl's algorithm in smallestenclosingcircle.py,
+but each search for a point outside the current circle and each batch of
+candidate circumcircles is a single array operation. Only convex hull
+vertices can touch the smallest enclosing circle, so callers should reduce
+boundary points with convex_hull() first.
+
+Points are shuffled with a fixed seed so results are reproducible.
+'''
+import numpy
+
+SEED = 0
+
+# Matches smallestenclosingcircle.is_in_circle()
+_MULTIPLICATIVE_EPSILON = 1 + 1e-14
+
+def _cross(o, a, b):
+    ''' Return twice the signed areas of triangles o, a, b along the last axis
+    '''
+    return (a[...,0] - o[...,0]) * (b[...,1] - o[...,1]) - (a[...,1] - o[...,1]) * (b[...,0] - o[...,0])
+
+def _hull_side(xy, a, b):
+    ''' Return hull vertices from a to b among points right of the line from a to b
+
+        Quickhull with an explicit stack, so every step is an array operation
+        on the points left to consider and long hulls cannot recurse too deep.
+    '''
+    vertices, stack = [], [(xy, a, b)]
+
+    while stack:
+        item = stack.pop()
+
+        if len(item) == 1:
+            vertices.append(item[0])
+            continue
+
+        points, start, end = item
+        if len(points) == 0:
+            continue
+
+        # Furthest point from the line joins the hull
+        far = points[numpy.argmin(_cross(start, end, points))]
+        stack.append((points[_cross(far, end, points) < 0], far, end))
+        stack.append((far, ))
+        stack.append((points[_cross(start, far, points) < 0], start, far))
+
+    return vertices
+
+def convex_hull(points):
+    ''' Return an (n, 2) array of convex hull vertices in counter-clockwise order
+
+        Points inside the polygon of extreme x, y, x+y, and x-y points are
+        dropped first, then remaining points are searched with quickhull.
+    '''
+    xy = numpy.array(points, dtype=float).reshape((-1, 2))
+
+    if len(xy) < 3:
+        return numpy.unique(xy, axis=0)
+
+    # Akl-Toussaint heuristic, with corners in counter-clockwise order
+    corners = xy[[
+        numpy.argmin(xy[:,0]), numpy.argmin(xy[:,0] + xy[:,1]),
+        numpy.argmin(xy[:,1]), numpy.argmax(xy[:,0] - xy[:,1]),
+        numpy.argmax(xy[:,0]), numpy.argmax(xy[:,0] + xy[:,1]),
+        numpy.argmax(xy[:,1]), numpy.argmin(xy[:,0] - xy[:,1]),
+    ]]
+    corners = corners[numpy.any(corners != numpy.roll(corners, 1, axis=0), axis=1)]
+
+    if len(corners) >= 3:
+        inside = numpy.ones(len(xy), dtype=bool)
+        for (a, b) in zip(corners, numpy.roll(corners, -1, axis=0)):
+            inside &= _cross(a, b, xy) > 0
+        xy = xy[~inside]
+
+    # Lowest and highest points by x, then y, are always on the hull
+    order = numpy.lexsort((xy[:,1], xy[:,0]))
+    a, b = xy[order[0]], xy[order[-1]]
+
+    if (a == b).all():
+        return xy[:1]
+
+    side = _cross(a, b, xy)
+    vertices = [a] + _hull_side(xy[side < 0], a, b) + [b] + _hull_side(xy[side > 0], b, a)
+
+    return numpy.array(vertices)
+
+def _in_circle(circle, xy):
+    ''' Return a boolean array of points inside or on a circle
+    '''
+    cx, cy, radius = circle
+    return numpy.hypot(xy[:,0] - cx, xy[:,1] - cy) <= radius * _MULTIPLICATIVE_EPSILON
+
+def _first_outside(circle, xy, start):
+    ''' Return index of the first point at or after start outside a circle, or None
+    '''
+    outside = numpy.flatnonzero(~_in_circle(circle, xy[start:]))
+    return start + outside[0] if len(outside) else None
+
+def _diameter(p, q):
+    cx, cy = (p[0] + q[0]) / 2, (p[1] + q[1]) / 2
+    return (cx, cy, max(numpy.hypot(cx - p[0], cy - p[1]), numpy.hypot(cx - q[0], cy - q[1])))
+
+def _circumcircles(p, q, rs):
+    ''' Return centers, radii, and a validity mask for circles through p, q, and each of rs
+    '''
+    xs = numpy.stack([numpy.full(len(rs), p[0]), numpy.full(len(rs), q[0]), rs[:,0]])
+    ys = numpy.stack([numpy.full(len(rs), p[1]), numpy.full(len(rs), q[1]), rs[:,1]])
+    ox, oy = (xs.min(axis=0) + xs.max(axis=0)) / 2, (ys.min(axis=0) + ys.max(axis=0)) / 2
+    (ax, bx, cx), (ay, by, cy) = xs - ox, ys - oy
+
+    d = (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by)) * 2
+    valid = d != 0
+    d = numpy.where(valid, d, 1)
+
+    x = ox + ((ax * ax + ay * ay) * (by - cy) + (bx * bx + by * by) * (cy - ay) + (cx * cx + cy * cy) * (ay - by)) / d
+    y = oy + ((ax * ax + ay * ay) * (cx - bx) + (bx * bx + by * by) * (ax - cx) + (cx * cx + cy * cy) * (bx - ax)) / d
+    radii = numpy.hypot(x - xs, y - ys).max(axis=0)
+
+    return numpy.stack([x, y], axis=1), radii, valid
+
+def _circle_two_points(xy, p, q):
+    circle = _diameter(p, q)
+    rs = xy[~_in_circle(circle, xy)]
+
+    if len(rs) == 0:
+        return circle
+
+    centers, radii, valid = _circumcircles(p, q, rs)
+    cross = _cross(p, q, rs)
+    center_cross = _cross(p, q, centers)
+
+    # Keep the circumcircle furthest to each side of the line through p and q
+    left, right = None, None
+    is_left, is_right = valid & (cross > 0), valid & (cross < 0)
+
+    if is_left.any():
+        i = numpy.flatnonzero(is_left)[numpy.argmax(center_cross[is_left])]
+        left = (centers[i,0], centers[i,1], radii[i])
+
+    if is_right.any():
+        i = numpy.flatnonzero(is_right)[numpy.argmin(center_cross[is_right])]
+        right = (centers[i,0], centers[i,1], radii[i])
+
+    if left is None and right is None:
+        return circle
+    elif left is None:
+        return right
+    elif right is None:
+        return left
+    else:
+        return left if (left[2] <= right[2]) else right
+
+def _circle_one_point(xy, p):
+    circle = (p[0], p[1], 0.)
+    i = _first_outside(circle, xy, 0)
+
+    while i is not None:
+        if circle[2] == 0:
+            circle = _diameter(p, xy[i])
+        else:
+            circle = _circle_two_points(xy[:i + 1], p, xy[i])
+        i = _first_outside(circle, xy, i + 1)
+
+    return circle
+
+def make_circle(points, seed=SEED):
+    ''' Return (x, y, radius) of the smallest circle enclosing points, or None if there are none
+    '''
+    xy = numpy.array(points, dtype=float).reshape((-1, 2))
+
+    if len(xy) == 0:
+        return None
+
+    xy = xy[numpy.random.default_rng(seed).permutation(len(xy))]
+    circle = None
+    i = 0
+
+    while i is not None:
+        circle = _circle_one_point(xy[:i + 1], xy[i])
+        i = _first_outside(circle, xy, i + 1)
+
+    x, y, radius = circle
+    return (float(x), float(y), float(radius))
@@ -34,6 +34,30 @@ API_BASE = os.environ.get('API_BASE')
 
 UPLOAD_TIME_LIMIT = 30 * 60
 
+# Engine for adding up block data by district, "athena" or "local"
+# to use planscore.aggregate in-process instead of an Athena query
+
+AGGREGATION_ENGINE = os.environ.get('AGGREGATION_ENGINE', 'athena')
+
+# Memory budget in bytes for county graphs cached by planscore.polygonize,
+# and a directory with its own budget to keep graphs between invocations
+
+GRAPH_CACHE_BYTES = int(os.environ.get('GRAPH_CACHE_BYTES', 3 * 1024**3))
+GRAPH_CACHE_DIR = os.environ.get('GRAPH_CACHE_DIR', '/tmp/planscore-graphs')
+GRAPH_CACHE_DISK_BYTES = int(os.environ.get('GRAPH_CACHE_DISK_BYTES', 384 * 1024**2))
+
+# Most blocks polygonized by one Polygonize invocation for a block assignment
+# plan, and memory in bytes that its forked processes may fill with graphs
+
+POLYGONIZE_BATCH_BLOCKS = int(os.environ.get('POLYGONIZE_BATCH_BLOCKS', 100000))
+POLYGONIZE_MEMORY_BYTES = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 10240)) * 1024**2
+
+# Largest WKB size in bytes of a district piece in the districts partition,
+# and an optional fixed grid cell size in degrees for splitting larger ones
+
+PARTITION_PIECE_BYTES = int(os.environ.get('PARTITION_PIECE_BYTES', 0x4000))
+PARTITION_CELL_SIZE = float(os.environ.get('PARTITION_CELL_SIZE', 0)) or None
+
 # Amount to round different kinds of values
 
 ROUND_COUNT = 2
@@ -7,9 +7,10 @@ UPLOAD_PLAINTEXT_KEY = 'uploads/{id}/index.txt'
 UPLOAD_GEOMETRY_KEY = 'uploads/{id}/geometry.json'
 UPLOAD_DISTRICTS_KEY = 'uploads/{id}/districts/{index}.json'
 UPLOAD_GEOMETRIES_KEY = 'uploads/{id}/geometries/{index}.wkt'
+UPLOAD_GEOMETRIES_BUNDLE_KEY = 'uploads/{id}/geometries.wkb'
 UPLOAD_GEOMETRY_BBOXES_KEY = 'uploads/{id}/geometry-bboxes.geojson'
 UPLOAD_ASSIGNMENTS_KEY = 'uploads/{id}/assignments/{index}.txt'
-UPLOAD_DISTRICTS_PARTITION_KEY = 'uploads/{id}/districts/partition.csv.gz'
+UPLOAD_DISTRICTS_PARTITION_KEY = 'uploads/{id}/districts/partition.parquet'
 UPLOAD_TILE_INDEX_KEY = 'uploads/{id}/tiles.json'
 UPLOAD_ASSIGNMENT_INDEX_KEY = 'uploads/{id}/assignments.json'
 UPLOAD_TIMING_KEY = 'logs/timing/ds={ds}/{id}.txt'
@@ -0,0 +1,176 @@
+''' Size-bounded cache of county graphs for warm Polygonize invocations.
+
+Graphs are kept in memory by (bucket, key) until their estimated sizes add
+up past a byte budget, then dropped least-recently-used first. Downloaded
+files can also be kept in a local directory such as /tmp with its own byte
+budget, so a graph dropped from memory or lost to a new boto3 client is read
+back from disk instead of S3. Graphs must be read fully into memory, since a
+memory-mapped file would keep its disk space outside the disk budget.
+'''
+import os, time, tempfile, threading, collections
+
+# Partial downloads untouched for this long were left by a failed or killed invocation
+STALE_PARTIAL_SECONDS = 60
+
+CacheStats = collections.namedtuple('CacheStats',
+    ('hits', 'misses', 'disk_hits', 'evictions', 'disk_evictions', 'count', 'bytes'))
+
+def touch(path):
+    ''' Mark a file as recently used, with a finer clock than file writes get
+    '''
+    # Modification time orders disk evictions
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+class GraphCache:
+    ''' In-memory LRU cache of graphs with an optional on-disk tier
+    '''
+    def __init__(self, max_bytes, directory=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.graphs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        ''' Forget all in-memory graphs and reset counters
+        '''
+        with self.lock:
+            self.graphs.clear()
+            self.bytes = 0
+            self.hits, self.misses, self.disk_hits = 0, 0, 0
+            self.evictions, self.disk_evictions = 0, 0
+
+    def stats(self):
+        ''' Return CacheStats with counters so far
+        '''
+        with self.lock:
+            return CacheStats(self.hits, self.misses, self.disk_hits,
+                self.evictions, self.disk_evictions, len(self.graphs), self.bytes)
+
+    def load(self, s3, bucket, key, read, estimate_size):
+        ''' Return a graph, calling read(path) and estimate_size(graph, path) on a miss
+        '''
+        cache_key = (bucket, key)
+
+        with self.lock:
+            if cache_key in self.graphs:
+                self.hits += 1
+                self.graphs.move_to_end(cache_key)
+                return self.graphs[cache_key][0]
+
+            self.misses += 1
+
+        path, is_temporary = self._fetch(s3, bucket, key)
+
+        try:
+            graph = read(path)
+            size = estimate_size(graph, path)
+        finally:
+            if is_temporary:
+                os.unlink(path)
+
+        with self.lock:
+            if cache_key not in self.graphs:
+                self.graphs[cache_key] = (graph, size)
+                self.bytes += size
+
+            # Always keep the newest graph, even if it alone is over budget
+            while self.bytes > self.max_bytes and len(self.graphs) > 1:
+                _, (_, old_size) = self.graphs.popitem(last=False)
+                self.bytes -= old_size
+                self.evictions += 1
+
+        return graph
+
+    def _fetch(self, s3, bucket, key):
+        ''' Return a local path for an S3 object and whether it should be deleted after reading
+        '''
+        if self.directory is None:
+            _, ext = os.path.splitext(key)
+            handle, tmp_path = tempfile.mkstemp(prefix='graph-', suffix=ext)
+            os.close(handle)
+
+            print(f'Downloading s3://{bucket}/{key} to {tmp_path}')
+
+            try:
+                s3.download_file(Bucket=bucket, Key=key, Filename=tmp_path)
+            except:
+                os.unlink(tmp_path)
+                raise
+
+            return tmp_path, True
+
+        disk_path = os.path.join(self.directory, bucket, key)
+
+        if os.path.exists(disk_path):
+            with self.lock:
+                self.disk_hits += 1
+
+            touch(disk_path)
+
+            return disk_path, False
+
+        dirname = os.path.dirname(disk_path)
+        os.makedirs(dirname, exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(prefix='partial-', dir=dirname)
+        os.close(handle)
+
+        print(f'Downloading s3://{bucket}/{key} to {disk_path}')
+
+        try:
+            s3.download_file(Bucket=bucket, Key=key, Filename=tmp_path)
+            os.replace(tmp_path, disk_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        touch(disk_path)
+        self._evict_disk(disk_path)
+
+        return disk_path, False
+
+    def _evict_disk(self, keep_path):
+        ''' Delete least-recently-used files until the directory fits its budget
+        '''
+        files, partial_total = [], 0
+        stale_before = time.time() - STALE_PARTIAL_SECONDS
+
+        for (dirname, _, filenames) in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirname, filename)
+
+                try:
+                    status = os.stat(path)
+                except FileNotFoundError:
+                    # Another download finished or gave up meanwhile
+                    continue
+
+                if not filename.startswith('partial-'):
+                    files.append((status.st_mtime, status.st_size, path))
+                elif status.st_mtime < stale_before:
+                    # Left behind by a killed download
+                    os.unlink(path)
+
+                    with self.lock:
+                        self.disk_evictions += 1
+                else:
+                    # Another download still in progress takes space too
+                    partial_total += status.st_size
+
+        total = partial_total + sum(size for (_, size, _) in files)
+
+        for (_, size, path) in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+
+            if path == keep_path:
+                continue
+
+            # Graphs are read fully into memory, so deleting a file frees its space
+            os.unlink(path)
+            total -= size
+
+            with self.lock:
+                self.disk_evictions += 1
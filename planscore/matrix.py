@@ -2,6 +2,7 @@ import os
 import csv
 import gzip
 import itertools
+import functools
 import collections
 import argparse
 import statistics
@@ -9,7 +10,7 @@ import urllib.request
 
 import numpy
 
-from . import data
+from . import data, timing
 
 INCUMBENCY = {
     data.Incumbency.Open.value: 0,
@@ -35,75 +36,52 @@ Model = collections.namedtuple('Model', (
 def dropna(a):
     return a[~numpy.isnan(a)]
 
-def load_model(path_suffix, state, year, has_incumbents, is_congress):
+# Model matrix file variants, see load_model()
+VARIANTS = (
+    '-incumbency-congress',
+    '-incumbency-statelege',
+    '-openseat-congress',
+    '-openseat-statelege',
+    '',
+    )
 
-    # TODO: accept year = None
+Matrices = collections.namedtuple('Matrices', ('c_index', 'c_matrix', 'e_matrix'))
 
+def matrix_paths(path_suffix, variant):
+    ''' Return paths to gzipped C and E matrix CSVs and their converted .npz file
+    '''
     matrix_dir = os.path.join(os.path.dirname(__file__), 'model')
-    c_path___ = os.path.join(matrix_dir, f'C_matrix_full{path_suffix}.csv.gz')
-    e_path___ = os.path.join(matrix_dir, f'E_matrix_full{path_suffix}.csv.gz')
-    c_path_oc = os.path.join(matrix_dir, f'C_matrix_full{path_suffix}-openseat-congress.csv.gz')
-    e_path_oc = os.path.join(matrix_dir, f'E_matrix_full{path_suffix}-openseat-congress.csv.gz')
-    c_path_ic = os.path.join(matrix_dir, f'C_matrix_full{path_suffix}-incumbency-congress.csv.gz')
-    e_path_ic = os.path.join(matrix_dir, f'E_matrix_full{path_suffix}-incumbency-congress.csv.gz')
-    c_path_os = os.path.join(matrix_dir, f'C_matrix_full{path_suffix}-openseat-statelege.csv.gz')
-    e_path_os = os.path.join(matrix_dir, f'E_matrix_full{path_suffix}-openseat-statelege.csv.gz')
-    c_path_is = os.path.join(matrix_dir, f'C_matrix_full{path_suffix}-incumbency-statelege.csv.gz')
-    e_path_is = os.path.join(matrix_dir, f'E_matrix_full{path_suffix}-incumbency-statelege.csv.gz')
-    
-    c_keys = (
-        'b_Intercept',
-        'b_dpres_mn',
-        'b_incumb',
-        f'r_stateabrev[{state},Intercept]',
-        f'r_stateabrev[{state},dpres_mn]',
-        f'r_stateabrev[{state},incumb]',
-        f'r_cycle[{year},Intercept]',
-        f'r_cycle[{year},dpres_mn]',
-        f'r_cycle[{year},incumb]',
+
+    return (
+        os.path.join(matrix_dir, f'C_matrix_full{path_suffix}{variant}.csv.gz'),
+        os.path.join(matrix_dir, f'E_matrix_full{path_suffix}{variant}.csv.gz'),
+        os.path.join(matrix_dir, f'CE_matrix_full{path_suffix}{variant}.npz'),
     )
+
+def has_matrices(path_suffix, variant):
+    '''
+    '''
+    c_path, e_path, npz_path = matrix_paths(path_suffix, variant)
     
-    if has_incumbents and is_congress and os.path.exists(c_path_ic) and os.path.exists(e_path_ic):
-        c_path, e_path = c_path_ic, e_path_ic
-    elif has_incumbents and os.path.exists(c_path_is) and os.path.exists(e_path_is):
-        c_path, e_path = c_path_is, e_path_is
-    elif is_congress and os.path.exists(c_path_oc) and os.path.exists(e_path_oc):
-        c_path, e_path = c_path_oc, e_path_oc
-    elif os.path.exists(c_path_os) and os.path.exists(e_path_os):
-        c_path, e_path = c_path_os, e_path_os
-    
-    elif False and has_incumbents and os.path.exists(c_path_i) and os.path.exists(e_path_i):
-        c_path, e_path = c_path_i, e_path_i
-    elif False and not has_incumbents and os.path.exists(c_path_o) and os.path.exists(e_path_o):
-        c_path, e_path = c_path_o, e_path_o
-
-        # Open seat matrix file is missing "incumb" rows
-        c_keys = (
-            'b_Intercept',
-            'b_dpres_mn',
-            f'r_stateabrev[{state},Intercept]',
-            f'r_stateabrev[{state},dpres_mn]',
-            f'r_congress[{str(is_congress).upper()},Intercept]',
-            f'r_congress[{str(is_congress).upper()},dpres_mn]',
-            f'r_congress:cycle[{str(is_congress).upper()}_{year},Intercept]',
-            f'r_congress:cycle[{str(is_congress).upper()}_{year},dpres_mn]',
-        )
-    else:
-        c_path, e_path = c_path___, e_path___
+    return os.path.exists(npz_path) or (os.path.exists(c_path) and os.path.exists(e_path))
 
+def read_matrices(c_path, e_path):
+    ''' Parse gzipped C and E matrix CSVs into C row keys and two arrays
+    '''
     with gzip.open(c_path, 'rt') as c_file:
-        c_rows = {
-            c_row['']: [
+        c_rows = csv.DictReader(c_file)
+        c_keys, c_values = [], []
+        
+        for c_row in c_rows:
+            c_keys.append(c_row[''])
+            c_values.append([
                 float(c_value)
                 for (c_col, c_value) in c_row.items()
                 if c_col.startswith('V')
-            ]
-            for c_row in csv.DictReader(c_file)
-            if c_row[''] in c_keys
-        }
+            ])
     
     with gzip.open(e_path, 'rt') as e_file:
-        e_rows = [
+        e_values = [
             [
                 float(e_value)
                 for (e_col, e_value) in e_row.items()
@@ -112,8 +90,73 @@ def load_model(path_suffix, state, year, has_incumbents, is_congress):
             for e_row in csv.DictReader(e_file)
         ]
     
-    c_values = [c_rows[c_key] for c_key in c_keys if c_key in c_rows]
-    zeros = [0.] * len(c_values[0])
+    return c_keys, numpy.array(c_values), numpy.array(e_values)
+
+def convert_matrices(path_suffix, variant):
+    ''' Write C and E matrix CSVs to a single .npz file for load_matrices()
+    '''
+    c_path, e_path, npz_path = matrix_paths(path_suffix, variant)
+    c_keys, c_matrix, e_matrix = read_matrices(c_path, e_path)
+    
+    with open(npz_path, 'wb') as file:
+        numpy.savez(file, c_keys=numpy.array(c_keys), c_matrix=c_matrix, e_matrix=e_matrix)
+    
+    return npz_path
+
+@functools.lru_cache()
+def load_matrices(path_suffix, variant):
+    ''' Load C and E matrices for one model variant, just once per process.
+    
+        Reads a converted .npz file if one is present and falls back to CSVs.
+        Returned arrays are read-only because they are shared between calls.
+    '''
+    c_path, e_path, npz_path = matrix_paths(path_suffix, variant)
+    
+    if os.path.exists(npz_path):
+        with numpy.load(npz_path) as npz:
+            c_keys, c_matrix, e_matrix = npz['c_keys'].tolist(), npz['c_matrix'], npz['e_matrix']
+    else:
+        c_keys, c_matrix, e_matrix = read_matrices(c_path, e_path)
+    
+    c_matrix.flags.writeable = False
+    e_matrix.flags.writeable = False
+    
+    return Matrices({c_key: i for (i, c_key) in enumerate(c_keys)}, c_matrix, e_matrix)
+
+def load_model(path_suffix, state, year, has_incumbents, is_congress):
+
+    # TODO: accept year = None
+
+    c_keys = (
+        'b_Intercept',
+        'b_dpres_mn',
+        'b_incumb',
+        f'r_stateabrev[{state},Intercept]',
+        f'r_stateabrev[{state},dpres_mn]',
+        f'r_stateabrev[{state},incumb]',
+        f'r_cycle[{year},Intercept]',
+        f'r_cycle[{year},dpres_mn]',
+        f'r_cycle[{year},incumb]',
+    )
+    
+    if has_incumbents and is_congress and has_matrices(path_suffix, '-incumbency-congress'):
+        variant = '-incumbency-congress'
+    elif has_incumbents and has_matrices(path_suffix, '-incumbency-statelege'):
+        variant = '-incumbency-statelege'
+    elif is_congress and has_matrices(path_suffix, '-openseat-congress'):
+        variant = '-openseat-congress'
+    elif has_matrices(path_suffix, '-openseat-statelege'):
+        variant = '-openseat-statelege'
+    else:
+        variant = ''
+
+    matrices = load_matrices(path_suffix, variant)
+    
+    c_values = [
+        matrices.c_matrix[matrices.c_index[c_key]]
+        for c_key in c_keys if c_key in matrices.c_index
+    ]
+    zeros = numpy.zeros(matrices.c_matrix.shape[1])
     
     if len(c_values) == 6 and has_incumbents:
         # If necessary, add missing state series for e.g. 2022F state lege
@@ -137,7 +180,7 @@ def load_model(path_suffix, state, year, has_incumbents, is_congress):
     elif len(c_values) != 9:
         raise RuntimeError(f'Unexpectedly seeing {len(c_values)} c_values')
     
-    args = c_values + [numpy.array(c_values), numpy.array(e_rows), is_congress]
+    args = c_values + [numpy.array(c_values), matrices.e_matrix, is_congress]
 
     return Model(*args)
 
@@ -174,7 +217,7 @@ def apply_model(districts, model, params):
     assert (ADC + E).shape == (len(districts), sim_count)
     return ADC + E
 
-def model_votes(model_version, state, house, districts):
+def model_votes(model_version, state, house, districts, timer=None):
     ''' Convert presidential votes to range of possible modeled chamber votes.
         
         model_version is a string like '2021D' from data.VERSION_PARAMETERS.
@@ -185,8 +228,12 @@ def model_votes(model_version, state, house, districts):
         - Input Republican vote count
         - Incumbency: "O" for open, "R", or "D"
         
+        timer is an optional timing.Timer for "model load" and "simulation" stages.
+        
         Return is a DxSx2 matrix for D districts, S simulations, and Dem/Rep parties.
     '''
+    timer = timer or timing.Timer()
+
     if model_version is None:
         params = data.VERSION_PARAMETERS[data.DEFAULT_VERSION]
     else:
@@ -195,15 +242,19 @@ def model_votes(model_version, state, house, districts):
     has_incumbents = bool({inc for (_, _, inc) in districts} != {'O'})
     is_congress = bool(house == data.House.ushouse)
     
+    with timer.stage('model load'):
+        model = load_model(params.path_suffix, STATE[state], params.year, has_incumbents, is_congress)
+    
     # Get DxS array from apply_model() with modeled vote fractions
-    fractions = apply_model(
-        [
-            (dem / ((dem + rep) or numpy.nan), INCUMBENCY[inc])
-            for (dem, rep, inc) in districts
-        ],
-        load_model(params.path_suffix, STATE[state], params.year, has_incumbents, is_congress),
-        params,
-    )
+    with timer.stage('simulation'):
+        fractions = apply_model(
+            [
+                (dem / ((dem + rep) or numpy.nan), INCUMBENCY[inc])
+                for (dem, rep, inc) in districts
+            ],
+            model,
+            params,
+        )
     
     # Make DxS array with total vote counts for each district and simulation
     total_votes = sum([dem + rep for (dem, rep, _) in districts])
@@ -291,6 +342,19 @@ parser = argparse.ArgumentParser()
 parser.add_argument('upload_url')
 parser.add_argument('matrix_path')
 
+convert_parser = argparse.ArgumentParser(description='Convert model matrix CSVs to .npz files')
+
+def convert_main():
+    ''' Convert every model matrix variant to a .npz file for load_matrices()
+    '''
+    convert_parser.parse_args()
+    
+    for params in data.VERSION_PARAMETERS.values():
+        for variant in VARIANTS:
+            c_path, e_path, _ = matrix_paths(params.path_suffix, variant)
+            if os.path.exists(c_path) and os.path.exists(e_path):
+                print(convert_matrices(params.path_suffix, variant))
+
 def main():
     ''' Write all district vote simulations to single CSV file
     '''
@@ -0,0 +1,182 @@
+''' Batched partisan metrics over many simulated elections at once.
+
+Each function accepts two DxS arrays of red and blue district vote counts for
+D districts and S simulations, and returns an array of S scores. Districts
+with NaN or zero total votes are ignored, just as matrix.dropna() and the
+(R + B) > 0 checks do in the scalar score.calculate_*() functions, which
+remain the reference implementation. Scores agree with those functions to
+within floating point rounding; a simulation where a score is undefined
+gets NaN instead of None.
+'''
+import numpy
+
+def _prepare_votes(red_votes, blue_votes):
+    ''' Return red, blue, and total vote arrays with a mask of usable districts.
+
+        Unusable district votes are replaced with zeros so that sums work.
+    '''
+    reds = numpy.asarray(red_votes, dtype=float)
+    blues = numpy.asarray(blue_votes, dtype=float)
+    totals = reds + blues
+
+    with numpy.errstate(invalid='ignore'):
+        mask = numpy.isfinite(totals) & (totals > 0)
+
+    return (
+        numpy.ascontiguousarray(numpy.where(mask, reds, 0.)),
+        numpy.ascontiguousarray(numpy.where(mask, blues, 0.)),
+        numpy.where(mask, totals, 1.),
+        mask,
+    )
+
+def _masked_mean(values, mask):
+    ''' Return column means of values where mask is true, NaN for empty columns.
+    '''
+    counts = mask.sum(axis=0)
+    sums = numpy.where(mask, values, 0.).sum(axis=0)
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return numpy.where(counts > 0, sums / numpy.maximum(counts, 1), numpy.nan)
+
+def _swing_vote(reds, blues, totals, mask, amount):
+    ''' Swing the vote by a percentage per simulation, positive toward blue.
+
+        Mirrors score.swing_vote(), with unusable districts left at zero.
+    '''
+    amount = numpy.broadcast_to(numpy.asarray(amount, dtype=float), reds.shape[1:])
+    swung_reds = numpy.where(mask, (reds/totals - amount) * totals, 0.)
+    swung_blues = numpy.where(mask, (blues/totals + amount) * totals, 0.)
+    is_unswung = (amount == 0)
+
+    return (
+        numpy.where(is_unswung, reds, swung_reds),
+        numpy.where(is_unswung, blues, swung_blues),
+    )
+
+def as_values(scores):
+    ''' Convert an array of scores to a list of floats with None for NaN.
+    '''
+    return [None if numpy.isnan(score) else score for score in scores.tolist()]
+
+def calculate_EGs(red_votes, blue_votes, vote_swing=0):
+    ''' Convert DxS arrays of district vote counts into S EG scores.
+
+        By convention, result is positive for blue and negative for red.
+    '''
+    reds, blues, totals, mask = _prepare_votes(red_votes, blue_votes)
+    init_reds, init_blues = _swing_vote(reds, blues, totals, mask, vote_swing)
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        init_blue_total = init_blues.sum(axis=0)
+        init_vote_share = init_blue_total / (init_blue_total + init_reds.sum(axis=0))
+
+    # Very red states swing to 25 blue/75 red, very blue states to 75 blue/25 red
+    clamped_swing = numpy.where(
+        init_vote_share < .25,
+        vote_swing + (.25 - init_vote_share),
+        numpy.where(
+            init_vote_share > .75,
+            vote_swing - (init_vote_share - .75),
+            vote_swing,
+        ),
+    )
+
+    swung_reds, swung_blues = _swing_vote(reds, blues, totals, mask, clamped_swing)
+    nonzero_mask = mask & ((swung_reds + swung_blues) > 0)
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        district_blue_wins = (nonzero_mask & (swung_blues > swung_reds)).sum(axis=0)
+        statewide_seat_share = district_blue_wins / nonzero_mask.sum(axis=0)
+
+        district_raw_blue_votes = swung_blues.sum(axis=0)
+        district_raw_total_votes = swung_reds.sum(axis=0) + district_raw_blue_votes
+        statewide_vote_share = district_raw_blue_votes / district_raw_total_votes
+
+    return statewide_seat_share - 0.5 - 2 * (statewide_vote_share - 0.5)
+
+def calculate_MMDs(red_votes, blue_votes):
+    ''' Convert DxS arrays of district vote counts into S Mean-Median scores.
+
+        By convention, result is positive for blue and negative for red.
+    '''
+    reds, blues, totals, mask = _prepare_votes(red_votes, blue_votes)
+    counts = mask.sum(axis=0)
+
+    # Unusable districts sort to the end as NaN
+    shares = numpy.sort(numpy.where(mask, blues / totals, numpy.nan), axis=0)
+    lower = numpy.maximum((counts - 1) // 2, 0)[numpy.newaxis,:]
+    upper = numpy.maximum(counts // 2, 0)[numpy.newaxis,:]
+
+    medians = numpy.where(
+        counts % 2 == 1,
+        numpy.take_along_axis(shares, upper, axis=0)[0],
+        (numpy.take_along_axis(shares, lower, axis=0)[0]
+            + numpy.take_along_axis(shares, upper, axis=0)[0]) / 2,
+    )
+
+    return numpy.where(counts > 0, medians - _masked_mean(shares, ~numpy.isnan(shares)), numpy.nan)
+
+def calculate_PBs(red_votes, blue_votes):
+    ''' Convert DxS arrays of district vote counts into S Partisan Bias scores.
+
+        By convention, result is positive for blue and negative for red.
+    '''
+    reds, blues, totals, mask = _prepare_votes(red_votes, blue_votes)
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        red_total, blue_total = reds.sum(axis=0), blues.sum(axis=0)
+        blue_margin = (blue_total - red_total) / (blue_total + red_total)
+
+        reds_5050, blues_5050 = _swing_vote(reds, blues, totals, mask, -blue_margin/2)
+        blue_seats = (mask & (reds_5050 < blues_5050)).sum(axis=0)
+        blue_seatshare = blue_seats / mask.sum(axis=0)
+        blue_voteshare = blues_5050.sum(axis=0) / (blues_5050.sum(axis=0) + reds_5050.sum(axis=0))
+
+    return blue_seatshare - blue_voteshare
+
+def calculate_D2s(red_votes, blue_votes):
+    ''' Convert DxS arrays of district vote counts into S Declination scores.
+
+        By convention, result is positive for blue and negative for red.
+    '''
+    reds, blues, totals, mask = _prepare_votes(red_votes, blue_votes)
+    blue_shares = blues / totals
+
+    red_wins = mask & (blue_shares <= 0.5)
+    blue_wins = mask & (blue_shares > 0.5)
+    seats, red_seats, blue_seats = mask.sum(axis=0), red_wins.sum(axis=0), blue_wins.sum(axis=0)
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        theta = numpy.arctan(
+            (1 - 2 * _masked_mean(blue_shares, red_wins)) * seats / red_seats
+        )
+
+        gamma = numpy.arctan(
+            (2 * _masked_mean(blue_shares, blue_wins) - 1) * seats / blue_seats
+        )
+
+        # -1 if red party does not win at least one seat,
+        # +1 if blue party does not win at least one seat
+        declination = numpy.where(
+            red_seats == 0,
+            -1.,
+            numpy.where(blue_seats == 0, 1., 2.0 * (gamma - theta) / numpy.pi),
+        )
+
+        declination2 = declination * numpy.log(seats) / 2
+
+    return numpy.where(seats > 0, -declination2, numpy.nan)
+
+def calculate_D2_diffs(red_votes, blue_votes):
+    ''' Convert DxS arrays of district vote counts into S vote share differences.
+
+        Simulations where either party wins no seats get NaN.
+    '''
+    reds, blues, totals, mask = _prepare_votes(red_votes, blue_votes)
+    blue_mask = mask & (blues >= reds)
+    red_mask = mask & (blues < reds)
+
+    blue_means = _masked_mean(blues / totals, blue_mask)
+    red_means = _masked_mean(reds / totals, red_mask)
+
+    return blue_means - red_means
@@ -1,10 +1,13 @@
-import os, time, json, posixpath, io, gzip, collections, copy, csv, uuid, datetime, itertools
+import os, time, json, posixpath, io, gzip, collections, copy, csv, uuid, datetime, itertools, struct
 import boto3, botocore.exceptions
-from . import data, constants, score, compactness, polygonize
+from . import data, constants, score, compactness, polygonize, transfer
 import osgeo.ogr
 
 SubTotal = collections.namedtuple('SubTotal', ('totals', 'timing'))
 
+# Seconds to wait between checks for expected objects, doubling up to a limit
+WAIT_DELAY, WAIT_MAX_DELAY = .25, 3
+
 def get_upload_index(storage, key):
     '''
     '''
@@ -55,77 +58,138 @@ def get_district_index(district_key, upload):
     
     return index
 
+def pack_geometry_bundle(wkbs):
+    ''' Return one body for a list of WKB geometries, with an offset index.
+
+        Body starts with a little-endian uint32 count and count + 1 uint64
+        offsets into the WKB data that follows, so geometry i is found at
+        data[offsets[i]:offsets[i + 1]].
+    '''
+    offsets = [0]
+    
+    for wkb in wkbs:
+        offsets.append(offsets[-1] + len(wkb))
+    
+    header = struct.pack(f'<I{len(offsets)}Q', len(wkbs), *offsets)
+    
+    return header + b''.join(bytes(wkb) for wkb in wkbs)
+
+def unpack_geometry_bundle(body):
+    ''' Return a list of WKB geometries from pack_geometry_bundle() output.
+    '''
+    if len(body) < 4:
+        raise ValueError('Bad geometry bundle length')
+    
+    count, = struct.unpack_from('<I', body)
+    start = 4 + 8 * (count + 1)
+    
+    if start > len(body):
+        raise ValueError('Bad geometry bundle length')
+    
+    offsets = struct.unpack_from(f'<{count + 1}Q', body, 4)
+    
+    if start + offsets[-1] != len(body):
+        raise ValueError('Bad geometry bundle length')
+    
+    return [body[start + offsets[i]:start + offsets[i + 1]] for i in range(count)]
+
 def load_upload_geometries(storage, upload):
     ''' Get ordered list of OGR geometries for an upload.
+    
+        Reads a single geometry bundle where one exists, otherwise downloads
+        individual WKT files concurrently and parses each as it arrives.
     '''
+    bundle_key = data.UPLOAD_GEOMETRIES_BUNDLE_KEY.format(id=upload.id)
+    
+    try:
+        object = storage.s3.get_object(Bucket=storage.bucket, Key=bundle_key)
+    except botocore.exceptions.ClientError:
+        # Uploads scored before geometry bundles have only WKT files
+        pass
+    else:
+        wkbs = unpack_geometry_bundle(transfer.read_body(object))
+        return [osgeo.ogr.CreateGeometryFromWkb(wkb) for wkb in wkbs]
+    
     geometries = {}
     
     geoms_prefix = posixpath.dirname(data.UPLOAD_GEOMETRIES_KEY).format(id=upload.id)
-    response = storage.s3.list_objects(Bucket=storage.bucket, Prefix=f'{geoms_prefix}/')
-
-    geometry_keys = [object['Key'] for object in response['Contents']]
+    geometry_keys = transfer.list_keys(storage.s3, storage.bucket, f'{geoms_prefix}/')
     
-    for geometry_key in geometry_keys:
+    for (geometry_key, body) in transfer.iter_objects(storage.s3, storage.bucket, geometry_keys):
         district_index = get_district_index(geometry_key, upload)
-        object = storage.s3.get_object(Bucket=storage.bucket, Key=geometry_key)
-
-        if object.get('ContentEncoding') == 'gzip':
-            object['Body'] = io.BytesIO(gzip.decompress(object['Body'].read()))
-    
-        body_string = object['Body'].read().decode('utf8')
-        district_geom = osgeo.ogr.CreateGeometryFromWkt(body_string)
+        district_geom = osgeo.ogr.CreateGeometryFromWkt(body.decode('utf8'))
         geometries[district_index] = district_geom
     
     return [geom for (_, geom) in sorted(geometries.items())]
 
-def load_upload_assignment_keys(storage, upload):
-    ''' Get ordered list of assignment keys for an upload.
+def load_upload_assignments(storage, upload):
+    ''' Get ordered list of (assignment key, size in bytes) for an upload.
     '''
     assigns_prefix = posixpath.dirname(data.UPLOAD_ASSIGNMENTS_KEY).format(id=upload.id)
     response = storage.s3.list_objects(Bucket=storage.bucket, Prefix=f'{assigns_prefix}/')
 
-    assignment_keys = sorted(
-        [object['Key'] for object in response['Contents']],
-        key=lambda key: get_district_index(key, upload),
+    assignments = sorted(
+        [(object['Key'], object.get('Size', 0)) for object in response['Contents']],
+        key=lambda assignment: get_district_index(assignment[0], upload),
     )
     
-    return assignment_keys
+    return assignments
+
+def load_upload_assignment_keys(storage, upload):
+    ''' Get ordered list of assignment keys for an upload.
+    '''
+    return [key for (key, _) in load_upload_assignments(storage, upload)]
 
 def populate_compactness(geometries):
     '''
     '''
-    districts = [dict(compactness=compactness.get_scores(geometry))
-        for geometry in geometries]
+    districts = [dict(compactness=scores)
+        for scores in compactness.get_plan_scores(geometries)]
     
     return districts
 
-def build_blockassign_geojson(district_keys, model, storage, lam, context):
-    for (assignment_key, geometry_key) in district_keys:
-        print(f'Invoking Polygonize for {assignment_key}')
+def build_blockassign_geojson(district_keys, model, storage, lam, context, block_counts=None):
+    ''' Polygonize districts in batches of Polygonize invocations and return GeoJSON
+
+        Batches are sized by block_counts, or all in one without them. Each
+        invocation shares county graphs among its districts.
+    '''
+    if block_counts is None:
+        batches = [list(range(len(district_keys)))]
+    else:
+        batches = polygonize.batch_districts(block_counts)
+    
+    print(f'Invoking Polygonize {len(batches)} times for {len(district_keys)} districts')
+    
+    for batch in batches:
         lam.invoke(
             FunctionName=polygonize.FUNCTION_NAME,
             InvocationType='Event',
             Payload=json.dumps({
                 'storage': storage.to_event(),
-                'assignment_key': assignment_key,
-                'geometry_key': geometry_key,
+                'districts': [
+                    {'assignment_key': district_keys[i][0], 'geometry_key': district_keys[i][1]}
+                    for i in batch
+                ],
                 'state_code': model.state.value,
             })
         )
     
-    features = []
+    features = {}
+    geometry_keys = [geometry_key for (_, geometry_key) in district_keys]
     
-    for (_, geometry_key) in district_keys:
-        object = wait_for_object(context, storage, geometry_key)
-        content = object['Body'].read().decode('utf8')
-        geometry = osgeo.ogr.CreateGeometryFromWkt(content)
+    # Simplify each district as it arrives but keep features in district order
+    for (geometry_key, body) in wait_for_objects(context, storage, geometry_keys):
+        geometry = osgeo.ogr.CreateGeometryFromWkt(body.decode('utf8'))
         simple30ft = geometry.SimplifyPreserveTopology(.0001)
-        features.append(
+        features[geometry_key] = (
             '{"type": "Feature", "geometry":'
             + simple30ft.ExportToJson(options=['COORDINATE_PRECISION=5'])
             + ', "properties": {}}'
         )
     
+    features = [features[geometry_key] for geometry_key in geometry_keys]
+    
     return ('{"type": "FeatureCollection", "features": [\n'+',\n'.join(features)+'\n]}')
 
 def add_blockassign_upload_geometry(context, lam, storage, upload):
@@ -134,7 +198,9 @@ def add_blockassign_upload_geometry(context, lam, storage, upload):
     put_upload_index(storage, upload.clone(
         message='Scoring: Building a district map.'))
     
-    assignment_keys = load_upload_assignment_keys(storage, upload)
+    assignments = load_upload_assignments(storage, upload)
+    assignment_keys = [key for (key, _) in assignments]
+    block_counts = [size // polygonize.ASSIGNMENT_LINE_BYTES for (_, size) in assignments]
     geometry_keys = [
         data.UPLOAD_GEOMETRIES_KEY.format(
             id=upload.id,
@@ -143,7 +209,7 @@ def add_blockassign_upload_geometry(context, lam, storage, upload):
         for assignment_key in assignment_keys
     ]
     district_keys = list(zip(assignment_keys, geometry_keys))
-    geojson = build_blockassign_geojson(district_keys, upload.model, storage, lam, context)
+    geojson = build_blockassign_geojson(district_keys, upload.model, storage, lam, context, block_counts)
     upload2 = upload.clone(geometry_key=data.UPLOAD_GEOMETRY_KEY.format(id=upload.id))
 
     storage.s3.put_object(Bucket=storage.bucket, Key=upload2.geometry_key,
@@ -152,31 +218,41 @@ def add_blockassign_upload_geometry(context, lam, storage, upload):
 
     return upload2
 
-def wait_for_object(context, storage, key):
-    '''
+def wait_for_objects(context, storage, keys, delay=WAIT_DELAY, max_delay=WAIT_MAX_DELAY):
+    ''' Generate (key, body bytes) tuples for S3 objects in the order they appear
+    
+        Checks for all outstanding keys at once with one listing of their
+        common prefix, backing off exponentially while nothing new appears.
     '''
-    print(f'Sitting down to wait for {key}')
+    remaining = set(keys)
+    prefix = os.path.commonprefix(list(keys))
+    next_delay = delay
     
-    while True:
-        try:
-            object = storage.s3.get_object(Bucket=storage.bucket, Key=key)
-        except botocore.exceptions.ClientError:
-            # Did not find the expected tile, wait a little before checking
-            time.sleep(3)
-        else:
-            if object.get('ContentEncoding') == 'gzip':
-                object['Body'] = io.BytesIO(gzip.decompress(object['Body'].read()))
+    print(f'Sitting down to wait for {len(remaining)} objects under {prefix}')
     
-            # Found the expected key, break out of this loop
-            return object
-
+    while remaining:
+        found = remaining & set(transfer.list_keys(storage.s3, storage.bucket, prefix))
+        
+        if found:
+            remaining -= found
+            next_delay = delay
+            yield from transfer.iter_objects(storage.s3, storage.bucket, sorted(found))
+            continue
+        
         remain_msec = context.get_remaining_time_in_millis()
 
-        if remain_msec < 5000:
+        if remain_msec < 5000 + next_delay * 1000:
             raise RuntimeError('Out of time')
+        
+        # Did not find any expected objects, wait a little longer each time
+        time.sleep(next_delay)
+        next_delay = min(next_delay * 2, max_delay)
 
-def put_part_timings(storage, upload, tiles, part_type):
-    ''' Write a CSV report on tile and slice timing
+def put_stage_timings(storage, upload, timer):
+    ''' Write a tab-delimited report on scoring stage timing
+    
+        Columns continue those of earlier tile and slice timing reports,
+        so the same Athena table can read both.
     '''
     ds = datetime.date.fromtimestamp(upload.start_time).strftime('%Y-%m-%d')
     key = data.UPLOAD_TIMING_KEY.format(id=upload.id, ds=ds)
@@ -184,18 +260,20 @@ def put_part_timings(storage, upload, tiles, part_type):
     buffer = io.StringIO()
     out = csv.writer(buffer, dialect='excel-tab', quotechar='|', quoting=csv.QUOTE_MINIMAL)
     
-    for tile in tiles:
+    for stage in timer.stages:
         out.writerow((
             # ID string from generate_signed_id()
             upload.id,
 
-            # Part type, "tile" or "slice"
-            part_type,
+            # Stage name, e.g. "download" or "district totals"
+            stage.stage,
+
+            # Feature count from old tile and slice reports
+            None,
 
             # Timing details
-            tile.timing['features'],
-            tile.timing['start_time'],
-            tile.timing['elapsed_time'],
+            round(stage.start_time, 3),
+            round(stage.elapsed_time, 3),
             
             # Model state string
             (upload.model.to_dict().get('state') if upload.model else None),
@@ -205,6 +283,9 @@ def put_part_timings(storage, upload, tiles, part_type):
             
             # Model JSON string
             (upload.model.to_json() if upload.model else None),
+            
+            # Peak process memory in megabytes
+            round(stage.peak_memory, 1),
         ))
 
     storage.s3.put_object(Bucket=storage.bucket, Key=key,
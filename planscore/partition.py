@@ -0,0 +1,138 @@
+''' Split large district shapes into grid cells for Athena point-in-polygon tests.
+
+Athena's ST_Within() cost grows with the number of vertices in each district
+row a block point is tested against, so districts whose WKB is too large are
+clipped into pieces. A grid of cells is laid over a district's bounding box
+in one pass and the district is clipped to each cell with GEOS's rectangle
+clipping, much cheaper than full intersections. Pieces still too large are
+gridded again.
+
+Districts are saved for the Athena "districts" table as a Parquet partition
+with WKB polygons, bounding box columns, and dictionary-encoded block GEOIDs.
+'''
+import io, math, collections
+import numpy, pyarrow, pyarrow.parquet
+import shapely.ops, shapely.geometry
+
+from . import constants
+
+# Recursion limit for pieces too large after clipping, e.g. very dense coastlines
+MAX_DEPTH = 6
+
+# Pieces and WKB sizes in bytes, to predict ST_Within() cost of a partition
+PartitionStats = collections.namedtuple('PartitionStats',
+    ('districts', 'pieces', 'bytes', 'max_bytes', 'large_districts'))
+
+# Columns of the Athena "districts" table
+TABLE_SCHEMA = pyarrow.schema([
+    ('Number', pyarrow.int32()),
+    ('Polygon', pyarrow.binary()),
+    ('XMin', pyarrow.float64()),
+    ('YMin', pyarrow.float64()),
+    ('XMax', pyarrow.float64()),
+    ('YMax', pyarrow.float64()),
+    ('GEOID20', pyarrow.string()),
+])
+
+def grid_cells(bounds, size, max_size=constants.PARTITION_PIECE_BYTES, cell_size=constants.PARTITION_CELL_SIZE):
+    ''' Return a list of (xmin, ymin, xmax, ymax) cells covering bounds
+
+        With no cell_size, picks enough cells for pieces half of max_size
+        if the vertices in a shape of WKB size were spread evenly.
+    '''
+    xmin, ymin, xmax, ymax = bounds
+    width, height = xmax - xmin, ymax - ymin
+
+    if cell_size:
+        columns = max(1, math.ceil(width / cell_size))
+        rows = max(1, math.ceil(height / cell_size))
+    else:
+        count = max(2, math.ceil(2 * size / max_size))
+        aspect = width / height if height > 0 else count
+        columns = min(count, max(1, round(math.sqrt(count * aspect))))
+        rows = max(1, math.ceil(count / columns))
+
+    xs, ys = numpy.linspace(xmin, xmax, columns + 1), numpy.linspace(ymin, ymax, rows + 1)
+
+    return [
+        (float(xs[i]), float(ys[j]), float(xs[i + 1]), float(ys[j + 1]))
+        for i in range(columns) for j in range(rows)
+    ]
+
+def polygonal(shape):
+    ''' Return just the polygons of a Shapely geometry, or None if there are none
+    '''
+    if shape.is_empty:
+        return None
+
+    if shape.geom_type in ('Polygon', 'MultiPolygon'):
+        return shape
+
+    if shape.geom_type == 'GeometryCollection':
+        polygons = [part for part in shape.geoms if part.geom_type == 'Polygon' and not part.is_empty]
+        polygons += [poly for part in shape.geoms if part.geom_type == 'MultiPolygon' for poly in part.geoms]
+        if polygons:
+            return polygons[0] if len(polygons) == 1 else shapely.geometry.MultiPolygon(polygons)
+
+    return None
+
+def partition_shape(shape, max_size=constants.PARTITION_PIECE_BYTES, cell_size=constants.PARTITION_CELL_SIZE, depth=0):
+    ''' Return a list of Shapely polygons covering shape, each smaller than max_size bytes of WKB
+    '''
+    size = len(shape.wkb)
+
+    if size < max_size or depth >= MAX_DEPTH:
+        return [shape]
+
+    pieces = []
+
+    for cell in grid_cells(shape.bounds, size, max_size, cell_size):
+        piece = polygonal(shapely.ops.clip_by_rect(shape, *cell))
+
+        if piece is None:
+            continue
+
+        if len(piece.wkb) < max_size:
+            pieces.append(piece)
+        else:
+            # Vertices were bunched up in this cell, so grid it on its own
+            pieces.extend(partition_shape(piece, max_size, None, depth + 1))
+
+    return pieces
+
+def partition_stats(piece_sizes):
+    ''' Return PartitionStats for a list of WKB piece sizes in bytes for each district
+    '''
+    sizes = [size for district_sizes in piece_sizes for size in district_sizes]
+
+    return PartitionStats(
+        len(piece_sizes),
+        len(sizes),
+        sum(sizes),
+        max(sizes) if sizes else 0,
+        sum([1 for district_sizes in piece_sizes if len(district_sizes) > 1]),
+    )
+
+def table_bytes(numbers, polygons=None, bboxes=None, geoid20s=None):
+    ''' Return Parquet bytes for the districts partition
+
+        numbers are district indexes for each row, polygons are WKB bytes,
+        bboxes are (xmin, ymin, xmax, ymax) tuples, and geoid20s are block
+        GEOIDs. Columns left as None are saved as nulls.
+    '''
+    count = len(numbers)
+    bboxes = numpy.full((count, 4), numpy.nan) if bboxes is None \
+        else numpy.array(bboxes, dtype=float).reshape((count, 4))
+
+    columns = [
+        pyarrow.array(numpy.asarray(numbers, dtype=numpy.int32), pyarrow.int32()),
+        pyarrow.array([None] * count if polygons is None else [wkb and bytes(wkb) for wkb in polygons], pyarrow.binary()),
+        *[pyarrow.array(bboxes[:,i], pyarrow.float64(), from_pandas=True) for i in range(4)],
+        pyarrow.nulls(count, pyarrow.string()) if geoid20s is None else pyarrow.array(geoid20s, pyarrow.string()),
+    ]
+
+    buffer = io.BytesIO()
+    pyarrow.parquet.write_table(pyarrow.Table.from_arrays(columns, schema=TABLE_SCHEMA),
+        buffer, use_dictionary=['Number', 'GEOID20'], compression='snappy')
+
+    return buffer.getvalue()
@@ -6,22 +6,41 @@ import json
 import gzip
 import logging
 import operator
-import tempfile
-import functools
 import itertools
+import multiprocessing
+import multiprocessing.connection
 
 import boto3
+import botocore.exceptions
+import numpy
 import networkx
 import shapely.ops
+import shapely.wkb
 import shapely.wkt
 import shapely.geometry
 
-from . import constants, data
+from . import constants, data, transfer, blockgraph, graphcache
 
 logging.basicConfig(level=logging.INFO)
 
 FUNCTION_NAME = os.environ.get('FUNC_NAME_POLYGONIZE', 'PlanScore-Polygonize')
 
+COUNTY_GRAPH_KEY = 'data/{state}/graphs/2020/{county}-tabblock.pickle.gz'
+BLOCK_GRAPH_KEY = 'data/{state}/graphs/2020/{county}-tabblock.npz'
+
+# Rough ratio of in-memory NetworkX graph size to gzipped pickle size,
+# with Python dictionaries and Shapely objects for every node and edge
+PICKLE_EXPANSION = 12
+
+# Bytes per line of an assignment file, a 15-digit block GEOID and a newline
+ASSIGNMENT_LINE_BYTES = 16
+
+# Rough memory used by one NetworkX edge with its attributes and Shapely line
+DIGRAPH_EDGE_BYTES = 2048
+
+GRAPH_CACHE = graphcache.GraphCache(constants.GRAPH_CACHE_BYTES,
+    constants.GRAPH_CACHE_DIR, constants.GRAPH_CACHE_DISK_BYTES)
+
 def load_assignment_block_ids(storage, assignment_key):
     ''' 
     '''
@@ -35,83 +54,355 @@ def load_assignment_block_ids(storage, assignment_key):
     
     return block_ids
 
-@functools.lru_cache()
+def estimate_graph_size(graph, path):
+    ''' Guess memory used by a NetworkX graph from its compressed pickle size
+    '''
+    return os.path.getsize(path) * PICKLE_EXPANSION
+
+def estimate_block_graph_size(graph, path):
+    ''' Count bytes in a BlockGraph's arrays
+    '''
+    return sum(array.nbytes for array in graph)
+
 def load_graph(s3, bucket, key):
     '''
     '''
-    _, ext = os.path.splitext(key)
-    handle, tmp_path = tempfile.mkstemp(prefix='graph-', suffix=ext)
-    os.close(handle)
-    
-    print(f'Downloading s3://{bucket}/{key} to {tmp_path}')
+    return GRAPH_CACHE.load(s3, bucket, key, blockgraph.read_pickle_graph, estimate_graph_size)
 
-    s3.download_file(Bucket=bucket, Key=key, Filename=tmp_path)
-    graph = networkx.read_gpickle(tmp_path)
-    os.unlink(tmp_path)
+def read_block_graph(path):
+    ''' Read a compact county graph's arrays into memory
+    '''
+    # Memory-mapped graphs would hold disk space outside GRAPH_CACHE_DISK_BYTES
+    # after their files are evicted or unlinked, and fill up /tmp
+    return blockgraph.read_block_graph(path, mmap=False)
 
-    return graph
+def load_block_graph(s3, bucket, key):
+    ''' Download a compact county graph and read its arrays into memory
+    '''
+    return GRAPH_CACHE.load(s3, bucket, key, read_block_graph, estimate_block_graph_size)
+
+def county_codes(block_ids):
+    '''
+    '''
+    return sorted({block_id[:5] for block_id in block_ids})
+
+def merge_digraphs(graphs):
+    ''' Merge an iterable of DiGraphs into one, with later graphs winning
+
+        Nodes and edges are added to a single new graph in one pass, so
+        county graphs can come from a generator and nothing already merged
+        is copied again. Attribute values are shared, not copied.
+    '''
+    merged = networkx.DiGraph()
+
+    for graph in graphs:
+        merged.add_nodes_from((node_id, graph.nodes[node_id]) for (node_id, _) in graph.edges.keys())
+        merged.add_edges_from(graph.edges(data=True))
+
+    return merged
 
 def combine_digraphs(graph1, graph2):
     '''
     '''
-    graph3 = networkx.DiGraph()
-    
-    for (node_id, _) in graph1.edges.keys():
-        graph3.add_node(node_id, **graph1.nodes[node_id])
-    
-    for (node_id, _) in graph2.edges.keys():
-        graph3.add_node(node_id, **graph2.nodes[node_id])
-    
-    for ((node1_id, node2_id), edge) in graph1.edges.items():
-        graph3.add_edge(node1_id, node2_id, **edge)
-    
-    for ((node1_id, node2_id), edge) in graph2.edges.items():
-        graph3.add_edge(node1_id, node2_id, **edge)
-    
-    return graph3
+    return merge_digraphs([graph1, graph2])
 
 def assemble_graph(s3, state_code, block_ids):
     '''
     '''
     print('Polygonize assemble_graph() for {}-block district'.format(len(block_ids)))
     
-    county_keys = {
-        'data/{}/graphs/2020/{}-tabblock.pickle.gz'.format(state_code, block_id[:5])
-        for block_id in block_ids
-    }
+    county_keys = [
+        COUNTY_GRAPH_KEY.format(state=state_code, county=county)
+        for county in county_codes(block_ids)
+    ]
 
-    county_graphs = [
+    county_graphs = (
         load_graph(s3, constants.S3_BUCKET, key) for key in county_keys
+    )
+
+    print('Merging digraphs...')
+    return merge_digraphs(county_graphs)
+
+def assemble_block_graphs(s3, state_code, block_ids):
+    ''' Return a list of compact BlockGraphs for every county touched by block_ids
+    '''
+    print('Polygonize assemble_block_graphs() for {} blocks'.format(len(block_ids)))
+    
+    return [
+        load_block_graph(s3, constants.S3_BUCKET, BLOCK_GRAPH_KEY.format(state=state_code, county=county))
+        for county in county_codes(block_ids)
     ]
 
-    print('Combining digraphs...')
-    return functools.reduce(combine_digraphs, county_graphs)
+def load_plan_graph(s3, state_code, block_ids):
+    ''' Return compact county graphs if they exist, or a merged NetworkX graph
+    '''
+    try:
+        return assemble_block_graphs(s3, state_code, block_ids)
+    except botocore.exceptions.ClientError as error:
+        print('Falling back to NetworkX graphs:', error)
+        return assemble_graph(s3, state_code, block_ids)
+
+def boundary_parts(lines):
+    ''' Return a list of LineStrings from boundary lines that may be MultiLineStrings
+    '''
+    parts = []
+    
+    for line in lines:
+        parts.extend(getattr(line, 'geoms', [line]))
+    
+    return parts
+
+def boundary_rings(parts):
+    ''' Return a hole-free Polygon for each closed ring traced along boundary lines
+
+        Returns None if the lines do not merge into simple rings, e.g. where
+        district parts touch only at a corner.
+    '''
+    merged = shapely.ops.linemerge(parts)
+    merged = list(getattr(merged, 'geoms', [merged]))
+    
+    if not all(line.is_ring for line in merged if not line.is_empty):
+        return None
+    
+    return [shapely.geometry.Polygon(line) for line in merged if not line.is_empty]
+
+def boundary_faces(parts):
+    ''' Return faces formed by boundary lines that lie inside the district
+
+        Every boundary line separates the district from something else, so
+        a ray from a point inside the district crosses an odd number of them.
+        Faces enclosed by district parts touching only at corners are left out.
+    '''
+    segments = numpy.concatenate([
+        numpy.hstack([coords[:-1], coords[1:]])
+        for coords in (numpy.asarray(part.coords)[:,:2] for part in parts)
+        if len(coords) > 1
+    ])
+    x1, y1, x2, y2 = segments.T
+    faces = []
+    
+    for face in shapely.ops.polygonize(parts):
+        point = face.representative_point()
+        
+        # Cast a ray toward +x counting edges with point.y in their half-open y-range
+        spans = (numpy.minimum(y1, y2) <= point.y) & (point.y < numpy.maximum(y1, y2))
+        cross_xs = x1[spans] + (point.y - y1[spans]) * (x2[spans] - x1[spans]) / (y2[spans] - y1[spans])
+        
+        if (cross_xs > point.x).sum() % 2 == 1:
+            faces.append(face)
+    
+    return faces
+
+def dissolve_boundary(lines):
+    ''' Return a district (Multi)Polygon from the lines between it and its neighbors
+    
+        Every boundary line separates the district from something else, so
+        rings nested inside an even number of other rings are district
+        shells and the rest are holes. This needs no block points and no
+        point-in-polygon tests, only ring-in-ring tests.
+    '''
+    parts = boundary_parts(lines)
+    rings = boundary_rings(parts)
+    
+    if rings is None:
+        # Lines that do not merge into simple rings still divide the plane into faces
+        logging.debug('District boundary has open lines, using faces instead')
+        return shapely.ops.unary_union(boundary_faces(parts))
+    
+    rings = sorted(rings, key=lambda ring: ring.area, reverse=True)
+    depths, shells = [], {}
+    
+    for (index, ring) in enumerate(rings):
+        point = ring.representative_point()
+        
+        # Smallest larger ring around this one is its immediate parent
+        parent = next((other for other in range(index - 1, -1, -1)
+            if rings[other].contains(point)), None)
+        
+        depths.append(0 if parent is None else depths[parent] + 1)
+        
+        if depths[index] % 2 == 0:
+            shells[index] = []
+        else:
+            shells[parent].append(ring.exterior)
+    
+    polygons = [
+        shapely.geometry.Polygon(rings[index].exterior, holes)
+        for (index, holes) in shells.items()
+    ]
+    logging.debug(f'District polygons: {polygons}')
+    
+    if len(polygons) == 1:
+        return polygons[0]
+    
+    return shapely.geometry.MultiPolygon(polygons)
 
 def polygonize_district(node_ids, graph):
     '''
     '''
     print('Polygonizing district from graph...')
     
-    multipoint = shapely.geometry.MultiPoint([graph.nodes[id]['pos'] for id in node_ids])
-    logging.debug(f'District multipoint: {multipoint}')
-
+    missing_ids = [id for id in node_ids if id not in graph]
+    
+    if missing_ids:
+        raise KeyError(f'{len(missing_ids)} blocks missing from graph, e.g. {missing_ids[0]}')
+    
     boundary = list(networkx.algorithms.boundary.edge_boundary(graph, node_ids))
     logging.debug(f'District boundary: {boundary}')
 
     lines = [graph.edges[(node1, node2)]['line'] for (node1, node2) in boundary]
     logging.debug(f'District lines: {lines}')
 
-    district_polygons = list(shapely.ops.polygonize(lines))
-    logging.debug(f'District district_polygons: {district_polygons}')
+    return dissolve_boundary(lines)
 
-    polys = [poly for poly in district_polygons
-        if poly.relate_pattern(multipoint, '0********')]
-    logging.debug(f'District polys: {polys}')
+def polygonize_block_district(node_ids, graphs):
+    ''' Polygonize a district from a list of compact BlockGraphs
+    '''
+    print('Polygonizing district from block graphs...')
+    
+    _, wkbs = blockgraph.district_boundary(graphs, node_ids)
+    lines = [shapely.wkb.loads(wkb) for wkb in wkbs]
+    logging.debug(f'District lines: {lines}')
 
-    multipolygon = shapely.ops.cascaded_union(polys)
-    logging.debug(f'District multipolygon: {multipolygon}')
+    return dissolve_boundary(lines)
+
+def polygonize_any(node_ids, graph):
+    ''' Polygonize a district from load_plan_graph() output of either kind
+    '''
+    if isinstance(graph, networkx.DiGraph):
+        return polygonize_district(node_ids, graph)
     
-    return multipolygon
+    return polygonize_block_district(node_ids, graph)
+
+def _polygonize_worker(connection, graph, indexed_block_ids):
+    ''' Send (index, WKT or exception) pairs for districts back through a pipe as each finishes
+    '''
+    try:
+        for (index, block_ids) in indexed_block_ids:
+            try:
+                connection.send((index, shapely.wkt.dumps(polygonize_any(block_ids, graph), rounding_precision=7)))
+            except Exception as error:
+                connection.send((index, error))
+    finally:
+        connection.close()
+
+def limit_processes(graph, processes):
+    ''' Limit forked processes by available memory for a NetworkX graph
+
+        Reading Python objects changes their reference counts, so each forked
+        process ends up with its own copy of most of a NetworkX graph. Arrays
+        in compact BlockGraphs are shared as-is.
+    '''
+    if not isinstance(graph, networkx.DiGraph):
+        return processes
+
+    graph_bytes = max(1, graph.number_of_edges() * DIGRAPH_EDGE_BYTES)
+    free_bytes = constants.POLYGONIZE_MEMORY_BYTES - GRAPH_CACHE.stats().bytes - graph_bytes
+
+    return max(1, min(processes, free_bytes // graph_bytes))
+
+def polygonize_districts(district_block_ids, graph, processes=None, callback=None):
+    ''' Return a list of WKT strings for districts polygonized from one graph
+
+        Districts are spread over forked processes that share the graph.
+        Pipes are used instead of multiprocessing.Pool, which needs /dev/shm
+        and is not available in Lambda. Each WKT is passed to callback(index,
+        wkt) as soon as it is ready, and the first district error is raised
+        only after every other district has finished.
+    '''
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    processes = min(limit_processes(graph, processes), len(district_block_ids))
+    wkts, errors = [None] * len(district_block_ids), []
+
+    def finish(index, result):
+        if isinstance(result, Exception):
+            errors.append(result)
+        else:
+            wkts[index] = result
+            if callback is not None:
+                callback(index, result)
+
+    if processes <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        for (index, block_ids) in enumerate(district_block_ids):
+            try:
+                wkt = shapely.wkt.dumps(polygonize_any(block_ids, graph), rounding_precision=7)
+            except Exception as error:
+                finish(index, error)
+            else:
+                finish(index, wkt)
+
+        if errors:
+            raise errors[0]
+
+        return wkts
+
+    # Deal out districts largest first so each process gets a similar load
+    indexes = sorted(range(len(district_block_ids)), key=lambda i: -len(district_block_ids[i]))
+    context = multiprocessing.get_context('fork')
+    workers = {}
+
+    for offset in range(processes):
+        indexed_block_ids = [(i, district_block_ids[i]) for i in indexes[offset::processes]]
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_polygonize_worker, args=(sender, graph, indexed_block_ids))
+        process.start()
+        sender.close()
+        workers[receiver] = (process, {i for (i, _) in indexed_block_ids})
+
+    while workers:
+        for receiver in multiprocessing.connection.wait(list(workers)):
+            process, remaining = workers[receiver]
+
+            try:
+                index, result = receiver.recv()
+            except EOFError:
+                process.join()
+                del workers[receiver]
+
+                if remaining:
+                    # Process died before finishing, e.g. out of memory
+                    errors.append(RuntimeError(f'Polygonize process exited with code {process.exitcode}'))
+            else:
+                remaining.discard(index)
+                finish(index, result)
+
+    if errors:
+        raise errors[0]
+
+    return wkts
+
+def batch_districts(block_counts, max_blocks=constants.POLYGONIZE_BATCH_BLOCKS):
+    ''' Return lists of consecutive district indexes with up to max_blocks blocks each
+
+        Neighboring district numbers tend to share counties, so keeping them
+        together lets each batch load fewer county graphs.
+    '''
+    batches, batch_blocks = [], 0
+
+    for (index, count) in enumerate(block_counts):
+        if not batches or batch_blocks + count > max_blocks:
+            batches.append([])
+            batch_blocks = 0
+
+        batches[-1].append(index)
+        batch_blocks += count
+
+    return batches
+
+def polygonize_plan(s3, state_code, district_block_ids, processes=None, callback=None):
+    ''' Return a list of WKT strings for all districts in a plan
+
+        Each county graph is loaded once and combined into a single graph
+        shared by every district.
+    '''
+    print('Polygonize polygonize_plan() for {}-district plan'.format(len(district_block_ids)))
+
+    all_block_ids = list(itertools.chain(*district_block_ids))
+    plan_graph = load_plan_graph(s3, state_code, all_block_ids)
+
+    return polygonize_districts(district_block_ids, plan_graph, processes, callback)
 
 def main():
     s3 = boto3.client('s3')
@@ -126,10 +417,10 @@ def main():
         
         for (district, blocks) in itertools.groupby(rows, key=operator.itemgetter('DISTRICT')):
             block_ids = [block['BLOCKID'] for block in blocks]
-            block_graph = assemble_graph(s3, state_code, block_ids)
+            block_graph = load_plan_graph(s3, state_code, block_ids)
             
             print(district, block_graph)
-            polygon = polygonize_district(block_ids, block_graph)
+            polygon = polygonize_any(block_ids, block_graph)
             geojson['features'].append({
                 'type': 'Feature',
                 'properties': {'district': district},
@@ -141,9 +432,43 @@ def main():
         
     print('yo')
 
+def batch_lambda_handler(event, context):
+    ''' Polygonize a batch of districts in a plan and write their WKT geometries
+    '''
+    s3 = boto3.client('s3', config=transfer.CLIENT_CONFIG)
+    storage = data.Storage.from_event(event['storage'], s3)
+
+    state_code = event['state_code']
+    assignment_keys = [district['assignment_key'] for district in event['districts']]
+    geometry_keys = [district['geometry_key'] for district in event['districts']]
+
+    block_ids = {
+        key: [line for line in body.decode('utf8').split('\n') if line]
+        for (key, body) in transfer.iter_objects(s3, storage.bucket, assignment_keys)
+    }
+
+    with transfer.ObjectWriter(s3) as writer:
+        def put_geometry(index, wkt):
+            # Write each district as it is finished so the observer can start
+            print('Writing to', geometry_keys[index])
+            writer.put_object(
+                Bucket=storage.bucket,
+                Key=geometry_keys[index], ACL='bucket-owner-full-control',
+                Body=wkt, ContentType='text/plain',
+            )
+        
+        polygonize_plan(s3, state_code, [block_ids[key] for key in assignment_keys], callback=put_geometry)
+
+    print('Graph cache:', GRAPH_CACHE.stats())
+
+    return geometry_keys
+
 def lambda_handler(event, context):
     '''
     '''
+    if 'districts' in event:
+        return batch_lambda_handler(event, context)
+
     s3 = boto3.client('s3')
     storage = data.Storage.from_event(event['storage'], s3)
 
@@ -152,8 +477,8 @@ def lambda_handler(event, context):
     geometry_key = event['geometry_key']
 
     block_ids = load_assignment_block_ids(storage, assignment_key)
-    block_graph = assemble_graph(s3, state_code, block_ids)
-    polygon = polygonize_district(block_ids, block_graph)
+    block_graph = load_plan_graph(s3, state_code, block_ids)
+    polygon = polygonize_any(block_ids, block_graph)
 
     print('Writing to', geometry_key)
     s3.put_object(
@@ -163,4 +488,6 @@ def lambda_handler(event, context):
         ContentType='text/plain',
     )
 
+    print('Graph cache:', GRAPH_CACHE.stats())
+
     return shapely.geometry.mapping(polygon.centroid)
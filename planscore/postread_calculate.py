@@ -3,10 +3,10 @@
 Fans out asynchronous parallel calls to planscore.district function, then
 starts and observer process with planscore.score function.
 '''
-import os, io, json, urllib.parse, gzip, time, math, threading
+import os, io, json, urllib.parse, gzip, time, math, threading, contextlib
 import csv, operator, itertools, zipfile, gzip, datetime
-import boto3, osgeo.ogr, osgeo.osr
-from . import util, data, score, website, constants, observe
+import boto3, botocore.exceptions, numpy, osgeo.ogr, osgeo.osr, shapely.wkb
+from . import util, data, score, website, constants, observe, aggregate, timing, transfer, partition
 
 FUNCTION_NAME = os.environ.get('FUNC_NAME_POSTREAD_CALCULATE') or 'PlanScore-PostreadCalculate'
 
@@ -20,42 +20,63 @@ EPSG4326.SetAxisMappingStrategy(osgeo.osr.OAMS_TRADITIONAL_GIS_ORDER)
 states_path = os.path.join(os.path.dirname(__file__), 'geodata', 'cb_2013_us_state_20m.geojson')
 
 def commence_upload_scoring(context, s3, athena, bucket, upload):
+    ''' Score an upload and write a report on time spent in each stage
     '''
-    '''
-    object = s3.get_object(Bucket=bucket, Key=upload.key)
-    
-    with util.temporary_buffer_file(os.path.basename(upload.key), object['Body']) as ul_path:
-        upload_type = util.guess_upload_type(ul_path)
-
-        if upload_type == util.UploadType.OGR_DATASOURCE:
-            return commence_geometry_upload_scoring(s3, athena, bucket, upload, ul_path)
-        
-        if upload_type == util.UploadType.ZIPPED_OGR_DATASOURCE:
-            return commence_geometry_upload_scoring(
-                s3, athena, bucket, upload, util.vsizip_shapefile(ul_path),
-            )
+    timer = timing.Timer()
+    storage = data.Storage(s3, bucket, upload.model.key_prefix)
 
-        if upload_type in (util.UploadType.BLOCK_ASSIGNMENT, util.UploadType.ZIPPED_BLOCK_ASSIGNMENT):
-            return commence_blockassign_upload_scoring(context, s3, athena, bucket, upload, ul_path)
+    try:
+        with contextlib.ExitStack() as stack:
+            with timer.stage('download'):
+                object = s3.get_object(Bucket=bucket, Key=upload.key)
+                ul_path = stack.enter_context(
+                    util.temporary_buffer_file(os.path.basename(upload.key), object['Body'])
+                )
+            
+            with timer.stage('guess type'):
+                upload_type = util.guess_upload_type(ul_path)
+
+            if upload_type == util.UploadType.OGR_DATASOURCE:
+                return commence_geometry_upload_scoring(s3, athena, bucket, upload, ul_path, timer)
+            
+            if upload_type == util.UploadType.ZIPPED_OGR_DATASOURCE:
+                return commence_geometry_upload_scoring(
+                    s3, athena, bucket, upload, util.vsizip_shapefile(ul_path), timer,
+                )
+
+            if upload_type in (util.UploadType.BLOCK_ASSIGNMENT, util.UploadType.ZIPPED_BLOCK_ASSIGNMENT):
+                return commence_blockassign_upload_scoring(context, s3, athena, bucket, upload, ul_path, timer)
+    finally:
+        try:
+            observe.put_stage_timings(storage, upload, timer)
+        except Exception as error:
+            # Don't hide a scoring error or fail a scored plan for a missing report
+            print('Could not write stage timings:', error)
 
-def commence_geometry_upload_scoring(s3, athena, bucket, upload, ds_path):
+def commence_geometry_upload_scoring(s3, athena, bucket, upload, ds_path, timer=None):
+    timer = timer or timing.Timer()
     storage = data.Storage(s3, bucket, upload.model.key_prefix)
     observe.put_upload_index(storage, upload)
     upload2 = upload.clone(geometry_key=data.UPLOAD_GEOMETRY_KEY.format(id=upload.id))
-    put_district_geometries(s3, bucket, upload2, ds_path)
+
+    with timer.stage('geometry upload'):
+        put_district_geometries(s3, bucket, upload2, ds_path)
     
-    response = accumulate_district_totals(athena, upload2, True)
+    response = accumulate_district_totals(athena, upload2, True, storage)
     
     observe.put_upload_index(storage, upload2.clone(message='Calculating district shapes'))
 
-    geometries = observe.load_upload_geometries(storage, upload2)
-    districts = observe.populate_compactness(geometries)
+    with timer.stage('compactness'):
+        geometries = observe.load_upload_geometries(storage, upload2)
+        districts = observe.populate_compactness(geometries)
+
     upload3 = upload2.clone(districts=districts)
 
     observe.put_upload_index(storage, upload3.clone(message='Counting votes and people in each district'))
 
-    for (state, results) in response:
-        pass
+    with timer.stage('district totals'):
+        for (state, results) in response:
+            pass
 
     print(json.dumps(state))
     print(json.dumps(results))
@@ -68,7 +89,7 @@ def commence_geometry_upload_scoring(s3, athena, bucket, upload, ds_path):
     observe.put_upload_index(storage, upload4.clone(message='Predicting future votes for each district'))
 
     try:
-        upload5 = score.calculate_everything(upload4)
+        upload5 = score.calculate_everything(upload4, timer=timer)
     except Exception as err:
         upload6 = upload5.clone(
             status=False,
@@ -80,29 +101,38 @@ def commence_geometry_upload_scoring(s3, athena, bucket, upload, ds_path):
             message='Finished scoring this plan.',
         )
 
-    observe.put_upload_index(storage, upload6)
+    with timer.stage('index write'):
+        observe.put_upload_index(storage, upload6)
 
-def commence_blockassign_upload_scoring(context, s3, athena, bucket, upload, file_path):
+def commence_blockassign_upload_scoring(context, s3, athena, bucket, upload, file_path, timer=None):
+    timer = timer or timing.Timer()
     storage = data.Storage(s3, bucket, upload.model.key_prefix)
     observe.put_upload_index(storage, upload)
     upload2 = upload.clone()
-    district_keys = put_district_assignments(s3, bucket, upload2, file_path)
 
-    response = accumulate_district_totals(athena, upload2, False)
+    with timer.stage('assignment upload'):
+        district_keys = put_district_assignments(s3, bucket, upload2, file_path)
+
+    response = accumulate_district_totals(athena, upload2, False, storage)
     
     lam = boto3.client('lambda')
-    upload3 = observe.add_blockassign_upload_geometry(context, lam, storage, upload2)
+
+    with timer.stage('district map'):
+        upload3 = observe.add_blockassign_upload_geometry(context, lam, storage, upload2)
 
     observe.put_upload_index(storage, upload3.clone(message='Calculating district shapes'))
 
-    geometries = observe.load_upload_geometries(storage, upload3)
-    districts = observe.populate_compactness(geometries)
+    with timer.stage('compactness'):
+        geometries = observe.load_upload_geometries(storage, upload3)
+        districts = observe.populate_compactness(geometries)
+
     upload4 = upload3.clone(districts=districts)
 
     observe.put_upload_index(storage, upload4.clone(message='Counting votes and people in each district'))
 
-    for (state, results) in response:
-        pass
+    with timer.stage('district totals'):
+        for (state, results) in response:
+            pass
 
     print(json.dumps(state))
     print(json.dumps(results))
@@ -115,7 +145,7 @@ def commence_blockassign_upload_scoring(context, s3, athena, bucket, upload, fil
     observe.put_upload_index(storage, upload5.clone(message='Predicting future votes for each district'))
 
     try:
-        upload6 = score.calculate_everything(upload5)
+        upload6 = score.calculate_everything(upload5, timer=timer)
     except Exception as err:
         upload7 = upload5.clone(
             status=False,
@@ -127,11 +157,40 @@ def commence_blockassign_upload_scoring(context, s3, athena, bucket, upload, fil
             message='Finished scoring this plan.',
         )
 
-    observe.put_upload_index(storage, upload7)
+    with timer.stage('index write'):
+        observe.put_upload_index(storage, upload7)
 
-def accumulate_district_totals(athena, upload, is_spatial):
+def load_plan_envelope(storage, upload):
+    ''' Return (xmin, ymin, xmax, ymax) around all districts, or None if unknown
     '''
+    if storage is None:
+        return None
+    
+    try:
+        object = storage.s3.get_object(Bucket=storage.bucket,
+            Key=data.UPLOAD_GEOMETRY_BBOXES_KEY.format(id=upload.id))
+        features = json.loads(transfer.read_body(object))['features']
+    except (botocore.exceptions.ClientError, ValueError, KeyError):
+        return None
+    
+    points = [point for feature in features for point in feature['geometry']['coordinates'][0]]
+    
+    if not points:
+        return None
+    
+    xs, ys = [x for (x, _) in points], [y for (_, y) in points]
+    
+    return (float(min(xs)), float(min(ys)), float(max(xs)), float(max(ys)))
+
+def accumulate_district_totals(athena, upload, is_spatial, storage=None):
+    ''' Yield Athena query states and finally a list of district totals.
+    
+        With AGGREGATION_ENGINE=local, add up blocks in-process from storage.
     '''
+    if constants.AGGREGATION_ENGINE == 'local':
+        yield from aggregate.accumulate_district_totals(storage, upload, is_spatial)
+        return
+    
     aggregators = {
         score.Aggregator.Sum: 'SUM("{}")',
         score.Aggregator.Median: 'APPROX_PERCENTILE("{}", 0.5)',
@@ -145,7 +204,21 @@ def accumulate_district_totals(athena, upload, is_spatial):
     indent = ',\n            '
     
     if is_spatial:
-        where_clause = 'ST_Within(ST_GeometryFromText(b.point), ST_GeometryFromText(d.polygon))'
+        # Blocks prepared before Lon and Lat columns fall back to parsing Point
+        lon = 'COALESCE(b.lon, ST_X(ST_GeometryFromText(b.point)))'
+        lat = 'COALESCE(b.lat, ST_Y(ST_GeometryFromText(b.point)))'
+        where_clause = f'''{lon} BETWEEN d.xmin AND d.xmax
+            AND {lat} BETWEEN d.ymin AND d.ymax
+            AND ST_Within(ST_GeometryFromText(b.point), ST_GeomFromBinary(d.polygon))'''
+        
+        envelope = load_plan_envelope(storage, upload)
+        
+        if envelope is not None:
+            # Constant ranges let Athena skip Parquet row groups by column statistics
+            xmin, ymin, xmax, ymax = envelope
+            where_clause += f'''
+            AND (b.lon IS NULL OR b.lon BETWEEN {xmin!r} AND {xmax!r})
+            AND (b.lat IS NULL OR b.lat BETWEEN {ymin!r} AND {ymax!r})'''
     else:
         where_clause = 'b.geoid20 = d.geoid20'
 
@@ -198,105 +271,128 @@ def resultset_to_district_totals(results):
         for row in results['ResultSet']['Rows'][1:]
     ]
 
-def partition_large_geometries(geom):
-    '''
+def partition_large_geometries(geom, max_size=constants.PARTITION_PIECE_BYTES, cell_size=constants.PARTITION_CELL_SIZE):
+    ''' Return a list of OGR geometries covering geom, each smaller than max_size bytes of WKB
     '''
     if not geom.IsValid():
         geom = geom.Buffer(1e-6, 4)
     
-    if geom.WkbSize() < 0x4000:
+    if geom.WkbSize() < max_size:
         return [geom]
     
-    xmin, xmax, ymin, ymax = geom.GetEnvelope()
-    
-    if xmax - xmin > ymax - ymin:
-        # split horizontally
-        xmid = xmin/2 + xmax/2
-        bbox1 = osgeo.ogr.CreateGeometryFromWkt(
-            f'polygon(({xmin-1} {ymin-1},{xmid} {ymin-1},{xmid} {ymax+1},{xmin-1} {ymax+1},{xmin-1} {ymin-1}))'
-        )
-        bbox2 = osgeo.ogr.CreateGeometryFromWkt(
-            f'polygon(({xmid} {ymin-1},{xmax+1} {ymin-1},{xmax+1} {ymax+1},{xmid} {ymax+1},{xmid} {ymin-1}))'
-        )
-    else:
-        # split vertically
-        ymid = ymin/2 + ymax/2
-        bbox1 = osgeo.ogr.CreateGeometryFromWkt(
-            f'polygon(({xmin-1} {ymin-1},{xmin-1} {ymid},{xmax+1} {ymid},{xmax+1} {ymin-1},{xmin-1} {ymin-1}))'
-        )
-        bbox2 = osgeo.ogr.CreateGeometryFromWkt(
-            f'polygon(({xmin-1} {ymid},{xmin-1} {ymax+1},{xmax+1} {ymax+1},{xmax+1} {ymid},{xmin-1} {ymid}))'
-        )
+    shape = shapely.wkb.loads(bytes(geom.ExportToWkb()))
     
-    return partition_large_geometries(geom.Intersection(bbox1)) \
-         + partition_large_geometries(geom.Intersection(bbox2))
+    return [
+        osgeo.ogr.CreateGeometryFromWkb(piece.wkb)
+        for piece in partition.partition_shape(shape, max_size, cell_size)
+    ]
 
-def put_district_geometries(s3, bucket, upload, path):
+def load_inspected_geometries(s3, bucket, upload):
+    ''' Return ordered geometries saved by preread_followup, or None if missing
     '''
+    bundle_key = data.UPLOAD_GEOMETRIES_BUNDLE_KEY.format(id=upload.id)
+    
+    try:
+        object = s3.get_object(Bucket=bucket, Key=bundle_key)
+        wkbs = observe.unpack_geometry_bundle(transfer.read_body(object))
+    except (botocore.exceptions.ClientError, ValueError):
+        # Uploads inspected before geometry bundles must be read again
+        return None
+    
+    return [osgeo.ogr.CreateGeometryFromWkb(wkb) for wkb in wkbs]
+
+def read_district_geometries(path):
+    ''' Return ordered district geometries from an OGR datasource
     '''
-    print('put_district_geometries:', (bucket, path))
     try:
         ds = osgeo.ogr.Open(path)
     except:
         # Make our own exception with a tested message below
         ds = None
-    keys, bboxes = [], []
 
     if not ds:
         raise RuntimeError('Could not open file to fan out district invocations')
 
-    partition_buffer = io.StringIO()
-    partition_csv = csv.writer(partition_buffer, dialect='excel')
-
     _, features = util.ordered_districts(ds.GetLayer(0))
     
-    for (index, feature) in enumerate(features):
-        geometry = feature.GetGeometryRef()
+    return [feature.GetGeometryRef().Clone() for feature in features]
+
+def put_district_geometries(s3, bucket, upload, path):
+    '''
+    '''
+    print('put_district_geometries:', (bucket, path))
+    keys, bboxes, wkbs, piece_sizes = [], [], [], []
+    numbers, polygons, envelopes = [], [], []
+    geometries = load_inspected_geometries(s3, bucket, upload)
+    
+    if geometries is None:
+        geometries, has_bundle = read_district_geometries(path), False
+    else:
+        has_bundle = True
 
-        if geometry.GetSpatialReference():
-            geometry.TransformTo(EPSG4326)
+    # Waits for every object to be written before Athena looks for them
+    with transfer.ObjectWriter(s3) as writer:
+    
+        for (index, geometry) in enumerate(geometries):
+            if geometry.GetSpatialReference():
+                geometry.TransformTo(EPSG4326)
         
-        key = data.UPLOAD_GEOMETRIES_KEY.format(id=upload.id, index=index)
+            key = data.UPLOAD_GEOMETRIES_KEY.format(id=upload.id, index=index)
         
-        s3.put_object(Bucket=bucket, Key=key, ACL='bucket-owner-full-control',
-            Body=geometry.ExportToWkt(), ContentType='text/plain')
+            writer.put_object(Bucket=bucket, Key=key, ACL='bucket-owner-full-control',
+                Body=geometry.ExportToWkt(), ContentType='text/plain')
         
-        keys.append(key)
-        bboxes.append((key, geometry.GetEnvelope()))
-
-        for subgeom in partition_large_geometries(geometry):
-            partition_csv.writerow((index, subgeom.ExportToWkt(), None))
-    
-    bboxes_geojson = {
-        'type': 'FeatureCollection',
-        'features': [
-            {
-                'type': 'Feature',
-                'properties': {'key': key},
-                'geometry': {
-                    'type': 'Polygon',
-                    'coordinates': [[[x1, y1], [x1, y2], [x2, y2], [x2, y1], [x1, y1]]]
+            keys.append(key)
+            bboxes.append((key, geometry.GetEnvelope()))
+            wkbs.append(geometry.ExportToWkb())
+
+            subgeoms = partition_large_geometries(geometry)
+            piece_sizes.append([subgeom.WkbSize() for subgeom in subgeoms])
+
+            for subgeom in subgeoms:
+                (x1, x2, y1, y2) = subgeom.GetEnvelope()
+                numbers.append(index)
+                polygons.append(subgeom.ExportToWkb())
+                envelopes.append((x1, y1, x2, y2))
+    
+        # Piece sizes predict the cost of ST_Within() tests in Athena
+        print('put_district_geometries:', partition.partition_stats(piece_sizes))
+    
+        bboxes_geojson = {
+            'type': 'FeatureCollection',
+            'features': [
+                {
+                    'type': 'Feature',
+                    'properties': {'key': key},
+                    'geometry': {
+                        'type': 'Polygon',
+                        'coordinates': [[[x1, y1], [x1, y2], [x2, y2], [x2, y1], [x1, y1]]]
+                    }
                 }
-            }
-            for (key, (x1, x2, y1, y2)) in bboxes
-        ],
-    }
+                for (key, (x1, x2, y1, y2)) in bboxes
+            ],
+        }
 
-    key = data.UPLOAD_GEOMETRY_BBOXES_KEY.format(id=upload.id)
+        key = data.UPLOAD_GEOMETRY_BBOXES_KEY.format(id=upload.id)
 
-    s3.put_object(Bucket=bucket, Key=key, ACL='bucket-owner-full-control',
-        Body=json.dumps(bboxes_geojson), ContentType='application/json')
+        writer.put_object(Bucket=bucket, Key=key, ACL='bucket-owner-full-control',
+            Body=json.dumps(bboxes_geojson), ContentType='application/json')
     
-    keys.append(key)
+        keys.append(key)
     
-    s3.put_object(
-        Bucket=bucket,
-        Key=data.UPLOAD_DISTRICTS_PARTITION_KEY.format(id=upload.id),
-        ACL='bucket-owner-full-control',
-        Body=gzip.compress(partition_buffer.getvalue().encode('utf8')),
-        ContentType='text/plain',
-        ContentEncoding='gzip',
-    )
+        if not has_bundle:
+            # All geometries in one object, for observe.load_upload_geometries()
+            writer.put_object(Bucket=bucket, Key=data.UPLOAD_GEOMETRIES_BUNDLE_KEY.format(id=upload.id),
+                ACL='bucket-owner-full-control', Body=observe.pack_geometry_bundle(wkbs),
+                ContentType='application/octet-stream')
+    
+        writer.put_object(
+            Bucket=bucket,
+            Key=data.UPLOAD_DISTRICTS_PARTITION_KEY.format(id=upload.id),
+            ACL='bucket-owner-full-control',
+            Body=partition.table_bytes(numbers, polygons, envelopes),
+            ContentType='application/octet-stream',
+        )
     
     return keys
 
@@ -307,60 +403,42 @@ def put_district_assignments(s3, bucket, upload, path):
     
     keys = []
 
-    _, ext = os.path.splitext(path.lower())
+    with util.open_baf_file(path) as file:
+        assignments = util.read_baf(file)
     
-    if ext == '.zip':
-        with open(path, 'rb') as file:
-            zf = zipfile.ZipFile(file)
-
-            # Sort names so "real"-looking paths come first: not dot-names, not in '__MACOSX'
-            namelist = sorted(zf.namelist(), reverse=False,
-                key=lambda n: (os.path.basename(n).startswith('.'), n.startswith('__MACOSX')))
-
-            for name in namelist:
-                if os.path.splitext(name.lower())[1] in ('.txt', '.csv'):
-                    rows = util.baf_stream_to_pairs(io.TextIOWrapper(zf.open(name)))
-                    break
-
-    elif ext in ('.csv', '.txt'):
-        with open(path, 'r') as file:
-            rows = util.baf_stream_to_pairs(file)
-    
-    partition_buffer = io.StringIO()
-    partition_csv = csv.writer(partition_buffer, dialect='excel')
-    
-    def district_key(pair):
-        _, district_id = pair
+    def district_key(district_id):
         try:
             return int(district_id)
         except ValueError:
             return 0
     
-    rows2 = itertools.groupby(sorted(rows, key=district_key), district_key)
+    # Sort blocks by numeric district, then by block ID within each district
+    label_keys = numpy.array([district_key(label) for label in assignments.labels], dtype=int)
+    row_keys = label_keys[assignments.codes] if len(assignments.labels) else assignments.codes
+    order = numpy.lexsort((assignments.block_ids, row_keys))
+    block_ids, row_keys = assignments.block_ids[order].astype(str), row_keys[order]
+    _, starts, counts = numpy.unique(row_keys, return_index=True, return_counts=True)
+    numbers = numpy.repeat(numpy.arange(len(starts)), counts)
+    # Waits for every object to be written before Athena looks for them
+    with transfer.ObjectWriter(s3) as writer:
     
-    for (index, (key, rows3)) in enumerate(rows2):
-        rows4 = sorted(rows3, key=operator.itemgetter(0))
-        
-        out = io.StringIO()
-        for (block_id, _) in rows4:
-            print(block_id, file=out)
-            partition_csv.writerow((index, None, block_id))
+        for (index, (start, stop)) in enumerate(zip(starts, list(starts[1:]) + [len(row_keys)])):
+            district_block_ids = block_ids[start:stop].tolist()
     
-        key = data.UPLOAD_ASSIGNMENTS_KEY.format(id=upload.id, index=index)
+            key = data.UPLOAD_ASSIGNMENTS_KEY.format(id=upload.id, index=index)
     
-        s3.put_object(Bucket=bucket, Key=key, ACL='bucket-owner-full-control',
-            Body=out.getvalue(), ContentType='text/plain')
+            writer.put_object(Bucket=bucket, Key=key, ACL='bucket-owner-full-control',
+                Body=''.join(f'{block_id}\n' for block_id in district_block_ids), ContentType='text/plain')
     
-        keys.append(key)
+            keys.append(key)
 
-    s3.put_object(
-        Bucket=bucket,
-        Key=data.UPLOAD_DISTRICTS_PARTITION_KEY.format(id=upload.id),
-        ACL='bucket-owner-full-control',
-        Body=gzip.compress(partition_buffer.getvalue().encode('utf8')),
-        ContentType='text/plain',
-        ContentEncoding='gzip',
-    )
+        writer.put_object(
+            Bucket=bucket,
+            Key=data.UPLOAD_DISTRICTS_PARTITION_KEY.format(id=upload.id),
+            ACL='bucket-owner-full-control',
+            Body=partition.table_bytes(numbers, geoid20s=block_ids),
+            ContentType='application/octet-stream',
+        )
 
     return keys
 
@@ -375,7 +453,7 @@ def get_redirect_url(website_base, id):
 def lambda_handler(event, context):
     '''
     '''
-    s3 = boto3.client('s3')
+    s3 = boto3.client('s3', config=transfer.CLIENT_CONFIG)
     storage = data.Storage(s3, event['bucket'], None)
     athena = boto3.client('athena', region_name='us-east-1')
     upload = data.Upload.from_dict(event)
@@ -1,9 +1,12 @@
-import argparse
-import boto3
-from . import constants
+import io, argparse
+import boto3, pyarrow, pyarrow.parquet
+from . import constants, aggregate, score
 
 BLOCKS_KEY_FORMAT = 'data/{directory}/blocks/assembled-state.parquet'
 
+# Smaller row groups let Athena skip more blocks by Lon and Lat statistics
+BLOCK_ROW_GROUP_SIZE = 0x10000
+
 parser = argparse.ArgumentParser(description='YESS')
 
 parser.add_argument('filename', help='Name of geographic file with precinct data')
@@ -14,6 +17,20 @@ parser.add_argument('--geojson',
 parser.add_argument('--s3', action='store_true',
     help='Upload to S3 instead of local directory')
 
+def add_block_coordinates(filename):
+    ''' Return Parquet bytes for a blocks file with Lon and Lat columns from Point
+    '''
+    table = pyarrow.parquet.read_table(filename)
+    table = table.drop([name for name in table.column_names if name.lower() in ('lon', 'lat')])
+    xs, ys = aggregate.read_points(table.column('Point').to_numpy(zero_copy_only=False))
+    table = table.append_column('Lon', pyarrow.array(xs, from_pandas=True))
+    table = table.append_column('Lat', pyarrow.array(ys, from_pandas=True))
+
+    buffer = io.BytesIO()
+    pyarrow.parquet.write_table(table, buffer, row_group_size=BLOCK_ROW_GROUP_SIZE)
+
+    return buffer.getvalue()
+
 def main():
     args = parser.parse_args()
     s3 = boto3.client('s3') if args.s3 else None
@@ -23,11 +40,26 @@ def main():
     if args.s3 and s3:
         key = BLOCKS_KEY_FORMAT.format(directory=args.directory)
         print('-->', 'Write', f's3://{constants.S3_BUCKET}/{key}')
-        with open(args.filename, "rb") as file:
-            s3.put_object(
-                Bucket=constants.S3_BUCKET,
-                Key=key,
-                Body=file,
-                ContentType='application/octet-stream',
-                ACL='public-read',
-            )
+        body = add_block_coordinates(args.filename)
+        s3.put_object(
+            Bucket=constants.S3_BUCKET,
+            Key=key,
+            Body=body,
+            ContentType='application/octet-stream',
+            ACL='public-read',
+        )
+        
+        names = [name for (name, _, _) in score.BLOCK_TABLE_FIELDS] + ['GEOID20', 'Point', 'Lon', 'Lat']
+        _, blocks = aggregate.read_block_columns(io.BytesIO(body), names)
+        index_buffer = io.BytesIO()
+        aggregate.write_block_index(aggregate.build_block_index(blocks), index_buffer)
+
+        key = aggregate.BLOCK_INDEX_KEY.format(prefix=f'data/{args.directory}')
+        print('-->', 'Write', f's3://{constants.S3_BUCKET}/{key}')
+        s3.put_object(
+            Bucket=constants.S3_BUCKET,
+            Key=key,
+            Body=index_buffer.getvalue(),
+            ContentType='application/octet-stream',
+            ACL='public-read',
+        )
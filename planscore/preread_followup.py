@@ -18,15 +18,23 @@ import multiprocessing.dummy
 import threading
 
 import boto3
+import numpy
 import osgeo.ogr
 import osgeo.osr
+import shapely.wkb
 
-from . import util, data, score, website, constants, observe
+from . import util, data, score, website, constants, observe, stateindex
 
 FUNCTION_NAME = os.environ.get('FUNC_NAME_PREREAD_FOLLOWUP') or 'PlanScore-PrereadFollowup'
 
 Assignment = collections.namedtuple('Assignment', ('block_id', 'district_id'))
 
+# Blocks per state FIPS code and distinct district IDs in a block assignment file
+AssignmentSummary = collections.namedtuple('AssignmentSummary', ('state_counts', 'district_ids'))
+
+# Ordered EPSG:4326 district geometries and polygonal feature count
+UploadInspection = collections.namedtuple('UploadInspection', ('geometries', 'feature_count'))
+
 osgeo.ogr.UseExceptions()
 
 EPSG4326 = osgeo.osr.SpatialReference(); EPSG4326.ImportFromEPSG(4326)
@@ -34,8 +42,6 @@ EPSG4326 = osgeo.osr.SpatialReference(); EPSG4326.ImportFromEPSG(4326)
 # https://github.com/OSGeo/gdal/pull/3311#issuecomment-748728574
 EPSG4326.SetAxisMappingStrategy(osgeo.osr.OAMS_TRADITIONAL_GIS_ORDER)
 
-states_path = os.path.join(os.path.dirname(__file__), 'geodata', 'cb_2013_us_state_20m.geojson')
-
 def commence_upload_parsing(s3, lam, bucket, upload):
     '''
     '''
@@ -56,11 +62,13 @@ def commence_upload_parsing(s3, lam, bucket, upload):
             return commence_blockassign_upload_parsing(s3, lam, bucket, upload, ul_path)
 
 def commence_geometry_upload_parsing(s3, bucket, upload, ds_path):
-    model = guess_geometry_model(ds_path)
+    inspection = inspect_geometry_upload(ds_path)
+    model = guess_geometries_model(inspection.geometries, inspection.feature_count)
     storage = data.Storage(s3, bucket, model.key_prefix)
-    geometry_count = count_district_geometries(ds_path)
+    geometry_count = len(inspection.geometries)
     upload2 = upload.clone(geometry_key=data.UPLOAD_GEOMETRY_KEY.format(id=upload.id))
-    put_geojson_file(s3, bucket, upload2, ds_path)
+    put_geojson_geometries(s3, bucket, upload2, inspection.geometries)
+    put_upload_geometries(s3, bucket, upload2, inspection.geometries)
     
     # Used so that the length of the upload districts array is correct
     district_blanks = [None] * geometry_count
@@ -95,31 +103,66 @@ def commence_blockassign_upload_parsing(s3, lam, bucket, upload, file_path):
     
     return upload3
 
-@functools.lru_cache()
-def get_block_assignments(path):
-    '''
+def inspect_geometry_upload(path):
+    ''' Return UploadInspection for an OGR datasource, opening it just once.
+    
+        Geometries are district-ordered, merged and reprojected to EPSG:4326
+        just as postread_calculate.put_district_geometries() would do.
     '''
-    _, ext = os.path.splitext(path.lower())
+    try:
+        ds = osgeo.ogr.Open(path)
+    except:
+        # Make our own exception with a tested message below
+        ds = None
     
-    if ext == '.zip':
-        with open(path, 'rb') as file:
-            zf = zipfile.ZipFile(file)
-
-            # Sort names so "real"-looking paths come first: not dot-names, not in '__MACOSX'
-            namelist = sorted(zf.namelist(), reverse=False,
-                key=lambda n: (os.path.basename(n).startswith('.'), n.startswith('__MACOSX')))
+    if not ds:
+        raise RuntimeError('Could not open file to guess U.S. state')
+    
+    layer = ds.GetLayer(0)
+    
+    # Count features before ordered_districts() merges any by district number
+    feature_count = sum(1 for feature in layer if util.is_polygonal_feature(feature))
+    _, features = util.ordered_districts(layer)
+    geometries = []
+    
+    for feature in features:
+        geometry = feature.GetGeometryRef().Clone()
 
-            for name in namelist:
-                if os.path.splitext(name.lower())[1] in ('.txt', '.csv'):
-                    rows = util.baf_stream_to_pairs(io.TextIOWrapper(zf.open(name)))
-                    break
+        if geometry.GetSpatialReference():
+            geometry.TransformTo(EPSG4326)
+        
+        geometries.append(geometry)
+    
+    return UploadInspection(geometries, feature_count)
 
-    elif ext in ('.csv', '.txt'):
-        with open(path, 'r') as file:
-            rows = util.baf_stream_to_pairs(file)
+def get_block_assignments(path):
+    '''
+    '''
+    with util.open_baf_file(path) as file:
+        rows = util.baf_stream_to_pairs(file)
     
     return [Assignment(block, district) for (block, district) in rows]
 
+@functools.lru_cache(maxsize=8)
+def summarize_block_assignments(path):
+    ''' Return AssignmentSummary for a block assignment file in one pass
+    '''
+    state_counts = collections.defaultdict(int)
+    district_ids = []
+    
+    with util.open_baf_file(path) as file:
+        for chunk in util.iter_baf_chunks(file):
+            # Count blocks by state FIPS prefix, skipping empty district labels
+            has_district = numpy.array([bool(label) for label in chunk.labels])[chunk.codes]
+            prefixes, counts = numpy.unique(chunk.block_ids[has_district].astype('S2'), return_counts=True)
+            
+            for (prefix, count) in zip(prefixes.tolist(), counts.tolist()):
+                state_counts[prefix.decode('ascii')] += count
+            
+            district_ids = chunk.labels
+    
+    return AssignmentSummary(dict(state_counts), tuple(district_ids))
+
 def count_district_geometries(path):
     '''
     '''
@@ -140,20 +183,11 @@ def count_district_geometries(path):
 def count_district_assignments(path):
     print('count_district_assignments:', path)
     
-    return len({assign.district_id for assign in get_block_assignments(path)})
+    return len(summarize_block_assignments(path).district_ids)
 
-def guess_geometry_model(path):
-    ''' Guess state model for the given input path.
+def coarse_footprint(geometries):
+    ''' Return a rough EPSG:4326 union of geometries for guessing their state
     '''
-    try:
-        ds = osgeo.ogr.Open(path)
-    except:
-        # Make our own exception with a tested message below
-        ds = None
-    
-    if not ds:
-        raise RuntimeError('Could not open file to guess U.S. state')
-    
     def _simplify_coarsely(g):
         if g is None:
             return None
@@ -175,9 +209,10 @@ def guess_geometry_model(path):
         else:
             return a.Union(b)
     
-    features = [feat for feat in ds.GetLayer(0) if util.is_polygonal_feature(feat)]
-    geometries = [_simplify_coarsely(feature.GetGeometryRef()) for feature in features]
-    footprint = functools.reduce(_union_safely, geometries)
+    footprint = functools.reduce(_union_safely, [_simplify_coarsely(g) for g in geometries], None)
+    
+    if footprint is None:
+        return None
     
     if footprint.GetSpatialReference():
         footprint.TransformTo(EPSG4326)
@@ -185,33 +220,79 @@ def guess_geometry_model(path):
     if not footprint.IsValid():
         # Buffer by ~3in to inflate away any validity problems
         footprint = footprint.Buffer(.00001)
+    
+    return footprint
+
+def guess_geometry_model(path):
+    ''' Guess state model for the given input path.
+    '''
+    try:
+        ds = osgeo.ogr.Open(path)
+    except:
+        # Make our own exception with a tested message below
+        ds = None
+    
+    if not ds:
+        raise RuntimeError('Could not open file to guess U.S. state')
+    
+    features = [feat for feat in ds.GetLayer(0) if util.is_polygonal_feature(feat)]
+    geometries = []
+    
+    for feature in features:
+        geometry = feature.GetGeometryRef().Clone()
+        if geometry.GetSpatialReference():
+            geometry.TransformTo(EPSG4326)
+        geometries.append(geometry)
+    
+    return guess_geometries_model(geometries, len(features))
 
-    states_ds = osgeo.ogr.Open(states_path)
-    states_layer = states_ds.GetLayer(0)
-    states_layer.SetSpatialFilter(footprint)
-    state_names, state_guesses = {}, []
-    
-    for state_feature in states_layer:
-        overlap = state_feature.GetGeometryRef().Intersection(footprint)
-        state_guesses.append((
-            overlap.Area(),
-            state_feature.GetGeometryRef().Area(),
-            state_feature.GetField('STUSPS'),
-        ))
-        state_names[state_feature.GetField('STUSPS')] = state_feature.GetField('NAME')
-    
-    if state_guesses:
+def guess_state(geometries):
+    ''' Return StateShape covering most of the EPSG:4326 geometries, or None for Null Island.
+    
+        Places points from a sample of geometries in preloaded state shapes,
+        and intersects a coarse footprint with states only when that sample
+        does not clearly agree on one state.
+    '''
+    index = stateindex.load_state_index()
+    sample = [geometries[i] for i in stateindex.sample_indexes(len(geometries))]
+    points = [geometry.PointOnSurface().GetPoint_2D() for geometry in sample]
+    shares = index.point_shares(points, [geometry.Area() for geometry in sample])
+    
+    if shares and max(shares.values()) >= stateindex.CONFIDENT_SHARE:
+        return index.find_abbr(max(shares, key=shares.get))
+    
+    footprint = coarse_footprint(geometries)
+    overlaps = index.overlap_areas(shapely.wkb.loads(bytes(footprint.ExportToWkb())))
+    
+    if overlaps:
         # Sort by area to findest largest overlap
-        state_abbr, state_area = [(abbr, area) for (_, area, abbr) in sorted(state_guesses)][-1]
+        state_guesses = [(area, index.find_abbr(abbr).area, abbr) for (abbr, area) in overlaps.items()]
+        return index.find_abbr(sorted(state_guesses)[-1][2])
+    
+    # Fall back to Null Island?
+    xmin, xmax, ymin, ymax = footprint.GetEnvelope()
+    if xmin < 0 and 0 < xmax and ymin < 0 and 0 < ymax:
+        return None
+    
+    raise RuntimeError('PlanScore only works for U.S. states')
+
+def guess_geometries_model(geometries, feature_count):
+    ''' Guess state model for ordered EPSG:4326 geometries from a number of features.
+    '''
+    if not geometries:
+        raise RuntimeError('Could not find any district shapes')
+    
+    state = guess_state(geometries)
+    
+    if state is None:
+        state_abbr, state_area = 'XX', 0
     else:
-        # Fall back to Null Island?
-        xmin, xmax, ymin, ymax = footprint.GetEnvelope()
-        if xmin < 0 and 0 < xmax and ymin < 0 and 0 < ymax:
-            state_abbr, state_area = 'XX', 0
-        else:
-            raise RuntimeError('PlanScore only works for U.S. states')
+        state_abbr, state_area = state.abbr, state.area
+    
+    # Districts should not overlap, so their areas add up to the footprint's
+    footprint_area = sum(geometry.Area() for geometry in geometries)
     
-    if footprint.Area() < state_area/3:
+    if footprint_area < state_area/3:
         # Look for the local plan whose seat count doesn't matter
         model_guesses = [
             (None, model)
@@ -222,7 +303,7 @@ def guess_geometry_model(path):
     else:
         # Sort by log(seats) to findest smallest difference
         model_guesses = [
-            (abs(math.log(len(features) / model.seats)), model)
+            (abs(math.log(feature_count / model.seats)), model)
             for model in data.MODELS
             if model.state.value == state_abbr
             and model.seats is not None
@@ -231,36 +312,24 @@ def guess_geometry_model(path):
     try:
         return sorted(model_guesses)[0][1]
     except IndexError:
-        state_name = state_names[state_abbr]
-        raise RuntimeError('{} is not a currently supported state'.format(state_name))
+        raise RuntimeError('{} is not a currently supported state'.format(state.name))
 
 def guess_blockassign_model(path):
     ''' Guess state model for the given input path.
     '''
-    state_counts, seat_count = collections.defaultdict(int), set()
-
-    for assign in get_block_assignments(path):
-        if assign.district_id:
-            state_counts[assign.block_id[:2]] += 1
-            seat_count.add(assign.district_id)
-    
-    state_counts = [(count, fips) for (fips, count) in state_counts.items()]
+    summary = summarize_block_assignments(path)
+    seat_count = {district_id for district_id in summary.district_ids if district_id}
+    state_counts = [(count, fips) for (fips, count) in summary.state_counts.items()]
     matched_fips = sorted(state_counts, reverse=True)[0][1]
     
     if matched_fips == '00':
         # Null Island
         state_abbr = 'XX'
     else:
-        states_ds = osgeo.ogr.Open(states_path)
-        try:
-            state_names, state_abbrs = {}, []
-            for state_feature in states_ds.GetLayer(0):
-                if state_feature.GetField('GEOID') == matched_fips:
-                    state_abbrs.append(state_feature.GetField('STUSPS'))
-                    state_names[state_feature.GetField('STUSPS')] = state_feature.GetField('NAME')
-            state_abbr = state_abbrs[0]
-        except IndexError:
+        state = stateindex.load_state_index().find_geoid(matched_fips)
+        if state is None:
             raise RuntimeError('PlanScore only works for U.S. states')
+        state_abbr = state.abbr
 
     # Sort by log(seats) to findest smallest difference
     model_guesses = [
@@ -273,29 +342,18 @@ def guess_blockassign_model(path):
     try:
         return sorted(model_guesses)[0][1]
     except IndexError:
-        state_name = state_names[state_abbr]
-        raise RuntimeError('{} is not a currently supported state'.format(state_name))
+        raise RuntimeError('{} is not a currently supported state'.format(state.name))
 
 def put_geojson_file(s3, bucket, upload, path):
     ''' Save a property-less GeoJSON file for this upload.
     '''
-    ds = osgeo.ogr.Open(path)
-    geometries = []
-    
-    if not ds:
-        raise RuntimeError('Could not open "{}"'.format(path))
-
-    _, features = util.ordered_districts(ds.GetLayer(0))
-    
-    for (index, feature) in enumerate(features):
-        if not util.is_polygonal_feature(feature):
-            continue
-        geometry = feature.GetGeometryRef()
-        if geometry.GetSpatialReference():
-            geometry.TransformTo(EPSG4326)
-        simple30ft = geometry.SimplifyPreserveTopology(.0001)
-        geometries.append(simple30ft.ExportToJson(options=['COORDINATE_PRECISION=5']))
+    put_geojson_geometries(s3, bucket, upload, inspect_geometry_upload(path).geometries)
 
+def put_geojson_geometries(s3, bucket, upload, geometries):
+    ''' Save a property-less GeoJSON file for ordered EPSG:4326 geometries.
+    '''
+    simple30fts = [geometry.SimplifyPreserveTopology(.0001) for geometry in geometries]
+    geometries = [g.ExportToJson(options=['COORDINATE_PRECISION=5']) for g in simple30fts]
     features = ['{"type": "Feature", "properties": {}, "geometry": '+g+'}' for g in geometries]
     geojson = '{"type": "FeatureCollection", "features": [\n'+',\n'.join(features)+'\n]}'
     
@@ -305,6 +363,14 @@ def put_geojson_file(s3, bucket, upload, path):
     s3.put_object(Bucket=bucket, Key=upload.geometry_key, Body=body,
         ContentType='text/json', ACL='public-read', **args)
 
+def put_upload_geometries(s3, bucket, upload, geometries):
+    ''' Save ordered EPSG:4326 geometries for postread_calculate to reuse.
+    '''
+    body = observe.pack_geometry_bundle([geometry.ExportToWkb() for geometry in geometries])
+    
+    s3.put_object(Bucket=bucket, Key=data.UPLOAD_GEOMETRIES_BUNDLE_KEY.format(id=upload.id),
+        Body=body, ACL='bucket-owner-full-control', ContentType='application/octet-stream')
+
 def get_redirect_url(website_base, id):
     '''
     '''
@@ -3,13 +3,16 @@
 When all districts are added up and present on S3, performs complete scoring
 of district plan and uploads summary JSON file.
 '''
-import io, os, gzip, csv, posixpath, json, statistics, copy, time, itertools, enum
+import io, os, gzip, csv, posixpath, json, statistics, copy, time, itertools, enum, collections
+import re
 import math
 import argparse
+import functools
 import urllib.request
 import pprint
 import boto3, botocore.exceptions
-from . import data, constants, matrix
+import numpy
+from . import data, constants, matrix, metrics, timing
 
 COLUMN_EG = 'eg_adj_avg'
 COLUMN_D2 = 'dec2_avg'
@@ -87,6 +90,16 @@ BLOCK_TABLE_FIELDS = [
 # Template for simulated election vote totals with incumbency
 FIELD_TMPL = '{incumbent}:{party}{sim:03d}'
 
+# Simulated vote totals like "DEM000" from 2018 and 2019 models
+# or like "O:DEM000" from PlanScore models starting 2020
+SIM_FIELD_PATTERN = re.compile(r'^((?P<incumbent>[ODR]):)?(?P<party>DEM|REP)(?P<sim>\d{3})$')
+
+# Simulation array parties and incumbency conditions, with "" for no incumbency
+SIM_PARTIES = ('DEM', 'REP')
+SIM_CONDITIONS = ('', ) + tuple(i.value for i in data.Incumbency)
+
+Simulations = collections.namedtuple('Simulations', ('votes', 'fields'))
+
 def swing_vote(red_districts, blue_districts, amount):
     ''' Swing the vote by a percentage, positive toward blue.
     '''
@@ -129,12 +142,15 @@ def safe_positives(values):
     
     return len([n for n in safe_values if n > 0]) / len(values)
 
-def percentrank_abs(column, house, value):
-    '''
-    '''
-    if house == data.House.localplan:
-        return None
+BiasDistribution = collections.namedtuple('BiasDistribution', ('values', 'abs_values'))
+
+@functools.lru_cache()
+def load_bias_distributions(house):
+    ''' Load sorted historical bias values for a chamber, just once per process.
     
+        Returns a dictionary of BiasDistribution tuples with sorted arrays of
+        values and absolute values for each metric column.
+    '''
     path = os.path.join(os.path.dirname(__file__), 'model', {
         data.House.ushouse: 'bias_ushouse.csv.gz',
         data.House.statehouse: 'bias_statehouse.csv.gz',
@@ -142,13 +158,28 @@ def percentrank_abs(column, house, value):
     }[house])
     
     with gzip.open(path, 'rt') as file:
-        values = [
-            1 if abs(value) > abs(float(row[column])) else 0
-            for row in csv.DictReader(file)
-            if row[column] != ''
-        ]
+        rows = list(csv.DictReader(file))
+    
+    distributions = {}
+    
+    for column in (COLUMN_EG, COLUMN_D2, COLUMN_PB, COLUMN_MMD):
+        values = numpy.sort([float(row[column]) for row in rows if row[column] != ''])
+        distributions[column] = BiasDistribution(values, numpy.sort(numpy.abs(values)))
     
-    return sum(values) / len(values)
+    return distributions
+
+def percentrank_abs(column, house, value):
+    '''
+    '''
+    if house == data.House.localplan:
+        return None
+    
+    abs_values = load_bias_distributions(house)[column].abs_values
+    
+    # Count historical values with smaller absolute value
+    lesser_count = int(numpy.searchsorted(abs_values, abs(value), side='left'))
+    
+    return lesser_count / len(abs_values)
 
 def percentrank_rel(column, house, value):
     '''
@@ -156,24 +187,30 @@ def percentrank_rel(column, house, value):
     if house == data.House.localplan:
         return None
     
-    path = os.path.join(os.path.dirname(__file__), 'model', {
-        data.House.ushouse: 'bias_ushouse.csv.gz',
-        data.House.statehouse: 'bias_statehouse.csv.gz',
-        data.House.statesenate: 'bias_statesenate.csv.gz',
-    }[house])
+    values = load_bias_distributions(house)[column].values
     
-    with gzip.open(path, 'rt') as file:
-        values = [
-            (
-                (1 if value < float(row[column]) else 0)
-                if (value < 0)
-                else (1 if value > float(row[column]) else 0)
-            )
-            for row in csv.DictReader(file)
-            if row[column] != ''
-        ]
+    if value < 0:
+        # Count historical values greater than a negative value
+        count = len(values) - int(numpy.searchsorted(values, value, side='right'))
+    else:
+        # Count historical values less than a positive value
+        count = int(numpy.searchsorted(values, value, side='left'))
     
-    return sum(values) / len(values)
+    return count / len(values)
+
+def percentrank_all(house, values):
+    ''' Get absolute and relative percent ranks for several metrics at once.
+    
+        values is a dictionary of metric values keyed by bias column, and
+        return value is a dictionary of (absolute, relative) rank tuples.
+    '''
+    return {
+        column: (
+            percentrank_abs(column, house, value),
+            percentrank_rel(column, house, value),
+        )
+        for (column, value) in values.items()
+    }
 
 def calculate_EG(red_districts, blue_districts, vote_swing=0):
     ''' Convert two lists of district vote counts into an EG score.
@@ -369,159 +406,156 @@ def calculate_bias(upload):
     
     return upload.clone(summary=summary_dict)
 
-def calculate_open_biases(upload):
-    ''' Calculate partisan metrics for districts with multiple simulations.
-
-        Look for "DEM000"-style vote properties from 2018 and 2019 PlanScore models.
+def load_simulations(districts):
+    ''' Read simulated vote totals from all districts into a single array.
+    
+        Returns a Simulations tuple with a DxSx2xC votes array indexed by
+        district, simulation, party from SIM_PARTIES, and incumbency condition
+        from SIM_CONDITIONS with NaN for missing values, and a dictionary of
+        field name sets found for each incumbency condition.
     '''
-    if f'DEM000' not in upload.districts[0]['totals']:
-        # Skip everything if we don't see a "DEM000"-style vote property
-        return upload.clone()
+    parties = {party: i for (i, party) in enumerate(SIM_PARTIES)}
+    conditions = {condition: i for (i, condition) in enumerate(SIM_CONDITIONS)}
+    fields = {condition: set() for condition in SIM_CONDITIONS}
+    indexes, values = list(), list()
+    
+    for (i, district) in enumerate(districts):
+        for (field, value) in district['totals'].items():
+            match = SIM_FIELD_PATTERN.match(field)
+            if match is None:
+                continue
+            
+            condition = match.group('incumbent') or ''
+            party, sim = match.group('party'), int(match.group('sim'))
+            indexes.append((i, sim, parties[party], conditions[condition]))
+            values.append(value)
+            fields[condition].add(field)
+    
+    sim_count = max([sim + 1 for (_, sim, _, _) in indexes], default=0)
+    votes = numpy.full((len(districts), sim_count, len(SIM_PARTIES), len(SIM_CONDITIONS)), numpy.nan)
     
-    MMDs, PBs, D2s = list(), list(), list()
-    EGs = {swing: list() for swing in (0, 1, -1, 2, -2, 3, -3, 4, -4, 5, -5)}
-    summary_dict, copied_districts = dict(), copy.deepcopy(upload.districts)
-    first_totals = copied_districts[0]['totals']
+    if indexes:
+        votes[tuple(zip(*indexes))] = numpy.array(values, dtype=float)
     
-    # Prepare place for simulation vote totals in each district
-    all_red_districts = [list() for d in copied_districts]
-    all_blue_districts = [list() for d in copied_districts]
+    return Simulations(votes, {c: frozenset(f) for (c, f) in fields.items()})
 
-    # Iterate over all simulations, tracking EG and vote totals
-    for sim in range(1000):
-        if f'REP{sim:03d}' not in first_totals or f'DEM{sim:03d}' not in first_totals:
-            continue
-        
-        sim_red_districts, sim_blue_districts = list(), list()
-
-        for (i, district) in enumerate(copied_districts):
-            red_votes = district['totals'].pop(f'REP{sim:03d}', 0)
-            blue_votes = district['totals'].pop(f'DEM{sim:03d}', 0)
-            sim_red_districts.append(red_votes)
-            sim_blue_districts.append(blue_votes)
-            all_red_districts[i].append(red_votes)
-            all_blue_districts[i].append(blue_votes)
-    
-        MMDs.append(calculate_MMD(sim_red_districts, sim_blue_districts))
-        PBs.append(calculate_PB(sim_red_districts, sim_blue_districts))
-        D2s.append(calculate_D2(sim_red_districts, sim_blue_districts))
-        
-        for swing in EGs:
-            EGs[swing].append(calculate_EG(sim_red_districts, sim_blue_districts, swing/100))
+def strip_simulations(districts, fields):
+    ''' Return copies of districts without simulated vote total fields.
+    '''
+    return [
+        dict(district, totals={
+            key: value for (key, value) in district['totals'].items()
+            if key not in fields
+        })
+        for district in districts
+    ]
+
+def summarize_simulations(districts, red_votes, blue_votes):
+    ''' Calculate partisan metrics and district totals from DxS vote arrays.
+    
+        Updates district totals in place, and returns a summary dictionary.
+    '''
+    MMDs = metrics.as_values(metrics.calculate_MMDs(red_votes, blue_votes))
+    PBs = metrics.as_values(metrics.calculate_PBs(red_votes, blue_votes))
+    D2s = metrics.as_values(metrics.calculate_D2s(red_votes, blue_votes))
+    EGs = {
+        swing: metrics.as_values(metrics.calculate_EGs(red_votes, blue_votes, swing/100))
+        for swing in (0, 1, -1, 2, -2, 3, -3, 4, -4, 5, -5)
+    }
     
     # Finalize per-district vote totals and confidence intervals
-    for (i, district) in enumerate(copied_districts):
-        red_votes, blue_votes = all_red_districts[i], all_blue_districts[i]
+    for (i, district) in enumerate(districts):
         district['totals'].update({
-            'Democratic Votes': round(statistics.mean(blue_votes), constants.ROUND_COUNT),
-            'Republican Votes': round(statistics.mean(red_votes), constants.ROUND_COUNT),
-            'Democratic Votes SD': round(statistics.stdev(blue_votes), constants.ROUND_COUNT),
-            'Republican Votes SD': round(statistics.stdev(red_votes), constants.ROUND_COUNT)
+            'Democratic Votes': round(float(blue_votes[i].mean()), constants.ROUND_COUNT),
+            'Republican Votes': round(float(red_votes[i].mean()), constants.ROUND_COUNT),
+            'Democratic Votes SD': round(float(blue_votes[i].std(ddof=1)), constants.ROUND_COUNT),
+            'Republican Votes SD': round(float(red_votes[i].std(ddof=1)), constants.ROUND_COUNT)
             })
 
-    summary_dict['Mean-Median'] = statistics.mean(MMDs)
-    summary_dict['Mean-Median SD'] = statistics.stdev(MMDs)
-    summary_dict['Partisan Bias'] = statistics.mean(PBs)
-    summary_dict['Partisan Bias SD'] = statistics.stdev(PBs)
-    summary_dict['Declination'] = statistics.mean(D2s)
-    summary_dict['Declination SD'] = statistics.stdev(D2s)
-    summary_dict['Efficiency Gap'] = statistics.mean(EGs[0])
-    summary_dict['Efficiency Gap SD'] = statistics.stdev(EGs[0])
+    summary_dict = {
+        'Mean-Median': safe_mean(MMDs),
+        'Mean-Median SD': safe_stdev(MMDs),
+        'Partisan Bias': safe_mean(PBs),
+        'Partisan Bias SD': safe_stdev(PBs),
+        'Declination': safe_mean(D2s),
+        'Declination SD': safe_stdev(D2s),
+        'Efficiency Gap': safe_mean(EGs[0]),
+        'Efficiency Gap SD': safe_stdev(EGs[0]),
+    }
     
     for swing in (1, 2, 3, 4, 5):
-        summary_dict[f'Efficiency Gap +{swing} Dem'] = statistics.mean(EGs[swing])
-        summary_dict[f'Efficiency Gap +{swing} Rep'] = statistics.mean(EGs[-swing])
-        summary_dict[f'Efficiency Gap +{swing} Dem SD'] = statistics.stdev(EGs[swing])
-        summary_dict[f'Efficiency Gap +{swing} Rep SD'] = statistics.stdev(EGs[-swing])
+        summary_dict[f'Efficiency Gap +{swing} Dem'] = safe_mean(EGs[swing])
+        summary_dict[f'Efficiency Gap +{swing} Rep'] = safe_mean(EGs[-swing])
+        summary_dict[f'Efficiency Gap +{swing} Dem SD'] = safe_stdev(EGs[swing])
+        summary_dict[f'Efficiency Gap +{swing} Rep SD'] = safe_stdev(EGs[-swing])
     
-    rounded_summary_dict = {k: round(v, constants.ROUND_FLOAT) for (k, v) in summary_dict.items()}
-    return upload.clone(districts=copied_districts, summary=rounded_summary_dict)
+    return {
+        k: None if v is None else round(v, constants.ROUND_FLOAT)
+        for (k, v) in summary_dict.items()
+    }
 
-def calculate_biases(upload):
+def calculate_open_biases(upload, simulations=None):
+    ''' Calculate partisan metrics for districts with multiple simulations.
+
+        Look for "DEM000"-style vote properties from 2018 and 2019 PlanScore models.
+        Pass simulations from load_simulations() to avoid reading them again.
+    '''
+    if f'DEM000' not in upload.districts[0]['totals']:
+        # Skip everything if we don't see a "DEM000"-style vote property
+        return upload.clone()
+    
+    if simulations is None:
+        simulations = load_simulations(upload.districts)
+    
+    votes = simulations.votes[:,:,:,SIM_CONDITIONS.index('')]
+    
+    # Use sims found in the first district, with zero votes where missing
+    sims = numpy.flatnonzero(~numpy.isnan(votes[0]).any(axis=1))
+    blue_votes = numpy.nan_to_num(votes[:,sims,SIM_PARTIES.index('DEM')])
+    red_votes = numpy.nan_to_num(votes[:,sims,SIM_PARTIES.index('REP')])
+    
+    copied_districts = strip_simulations(upload.districts, simulations.fields[''])
+    summary_dict = summarize_simulations(copied_districts, red_votes, blue_votes)
+
+    return upload.clone(districts=copied_districts, summary=summary_dict)
+
+def calculate_biases(upload, simulations=None):
     ''' Calculate partisan metrics for districts with simulations and incumbency.
     
         Look for "O:DEM000"-style vote properties from PlanScore models starting 2020.
+        Pass simulations from load_simulations() to avoid reading them again.
     '''
     if FIELD_TMPL.format(party='DEM', sim=0, incumbent=data.Incumbency.Open.value) \
             not in upload.districts[0]['totals']:
         # Skip everything if we don't see an "O:DEM000"-style vote property
         return upload.clone()
     
-    MMDs, PBs, D2s = list(), list(), list()
-    EGs = {swing: list() for swing in (0, 1, -1, 2, -2, 3, -3, 4, -4, 5, -5)}
-    summary_dict, copied_districts = dict(), copy.deepcopy(upload.districts)
-    first_totals = copied_districts[0]['totals']
+    if simulations is None:
+        simulations = load_simulations(upload.districts)
     
-    # Prepare place for simulation vote totals in each district
-    all_red_districts = [list() for d in copied_districts]
-    all_blue_districts = [list() for d in copied_districts]
-
-    # Iterate over all simulations, tracking EG and vote totals
-    for sim in range(1000):
-        if FIELD_TMPL.format(party='DEM', sim=sim, incumbent=data.Incumbency.Open.value) \
-                not in first_totals:
-            # Skip if we don't seem to have sims up to this iteration
-            continue
-        
-        sim_red_districts, sim_blue_districts = list(), list()
-
-        for (i, district) in enumerate(copied_districts):
-            incumbent = upload.incumbents[i]
-            oDEMnnn = FIELD_TMPL.format(party='DEM', sim=sim, incumbent=incumbent)
-            oREPnnn = FIELD_TMPL.format(party='REP', sim=sim, incumbent=incumbent)
-        
-            red_votes = district['totals'].pop(oREPnnn, 0)
-            blue_votes = district['totals'].pop(oDEMnnn, 0)
-            sim_red_districts.append(red_votes)
-            sim_blue_districts.append(blue_votes)
-            all_red_districts[i].append(red_votes)
-            all_blue_districts[i].append(blue_votes)
-            
-            # Clear out vote total fields for all conditions in the current sim
-            for (party, incumbent) in itertools.product(('DEM', 'REP'), list(data.Incumbency)):
-                kwargs = dict(incumbent=incumbent.value, party=party, sim=sim)
-                district['totals'].pop(FIELD_TMPL.format(**kwargs), None)
-    
-        MMDs.append(calculate_MMD(sim_red_districts, sim_blue_districts))
-        PBs.append(calculate_PB(sim_red_districts, sim_blue_districts))
-        D2s.append(calculate_D2(sim_red_districts, sim_blue_districts))
-        
-        for swing in EGs:
-            EGs[swing].append(calculate_EG(sim_red_districts, sim_blue_districts, swing/100))
-    
-    # Finalize per-district vote totals and confidence intervals
-    for (i, district) in enumerate(copied_districts):
-        red_votes, blue_votes = all_red_districts[i], all_blue_districts[i]
-        district['totals'].update({
-            'Democratic Votes': round(statistics.mean(blue_votes), constants.ROUND_COUNT),
-            'Republican Votes': round(statistics.mean(red_votes), constants.ROUND_COUNT),
-            'Democratic Votes SD': round(statistics.stdev(blue_votes), constants.ROUND_COUNT),
-            'Republican Votes SD': round(statistics.stdev(red_votes), constants.ROUND_COUNT)
-            })
-
-    summary_dict['Mean-Median'] = safe_mean(MMDs)
-    summary_dict['Mean-Median SD'] = safe_stdev(MMDs)
-    summary_dict['Partisan Bias'] = safe_mean(PBs)
-    summary_dict['Partisan Bias SD'] = safe_stdev(PBs)
-    summary_dict['Declination'] = safe_mean(D2s)
-    summary_dict['Declination SD'] = safe_stdev(D2s)
-    summary_dict['Efficiency Gap'] = safe_mean(EGs[0])
-    summary_dict['Efficiency Gap SD'] = safe_stdev(EGs[0])
+    # Select votes for each district's incumbency scenario
+    conditions = [SIM_CONDITIONS.index(upload.incumbents[i]) for i in range(len(upload.districts))]
+    votes = simulations.votes[numpy.arange(len(conditions)),:,:,conditions]
     
-    for swing in (1, 2, 3, 4, 5):
-        summary_dict[f'Efficiency Gap +{swing} Dem'] = safe_mean(EGs[swing])
-        summary_dict[f'Efficiency Gap +{swing} Rep'] = safe_mean(EGs[-swing])
-        summary_dict[f'Efficiency Gap +{swing} Dem SD'] = safe_stdev(EGs[swing])
-        summary_dict[f'Efficiency Gap +{swing} Rep SD'] = safe_stdev(EGs[-swing])
+    # Use sims with open-seat votes in the first district, with zero votes where missing
+    open_votes = simulations.votes[0,:,SIM_PARTIES.index('DEM'),SIM_CONDITIONS.index(data.Incumbency.Open.value)]
+    sims = numpy.flatnonzero(~numpy.isnan(open_votes))
+    blue_votes = numpy.nan_to_num(votes[:,sims,SIM_PARTIES.index('DEM')])
+    red_votes = numpy.nan_to_num(votes[:,sims,SIM_PARTIES.index('REP')])
     
-    rounded_summary_dict = {k: round(v, constants.ROUND_FLOAT) for (k, v) in summary_dict.items()}
-    return upload.clone(districts=copied_districts, summary=rounded_summary_dict)
+    incumbency_fields = frozenset().union(*[simulations.fields[i.value] for i in data.Incumbency])
+    copied_districts = strip_simulations(upload.districts, incumbency_fields)
+    summary_dict = summarize_simulations(copied_districts, red_votes, blue_votes)
 
-def calculate_district_biases(upload):
+    return upload.clone(districts=copied_districts, summary=summary_dict)
+
+def calculate_district_biases(upload, timer=None):
     ''' Calculate partisan metrics using district matrix with presidential vote only.
     
         Look for 2016 presidential vote totals to use national PlanScore model.
     '''
+    timer = timer or timing.Timer()
+
     ## TODO: remove print output unless running planscore-score-locally
     #
     #with open('EGs.csv', 'w') as file:
@@ -561,6 +595,7 @@ def calculate_district_biases(upload):
         upload.model.state,
         upload.model.house,
         matrix.filter_district_data(matrix.prepare_district_data(upload)),
+        timer=timer,
     )
     
     # Record per-district vote totals and confidence intervals
@@ -591,52 +626,53 @@ def calculate_district_biases(upload):
             district['is_counted'] = False
             district['number'] = None
     
-    # For each sim, a list of red votes and a list of blue votes in districts
-    red_votes_blue_votes = [
-        (
-            matrix.dropna(output_votes[:,sim,1]).tolist(),
-            matrix.dropna(output_votes[:,sim,0]).tolist(),
-        )
-        for sim in range(output_votes.shape[1])
-    ]
+    # DxS arrays of red and blue votes, with NaN for uncounted districts
+    red_votes, blue_votes = output_votes[:,:,1], output_votes[:,:,0]
     
-    # Calculate partisanship metrics for all simulations
-    MMDs = [calculate_MMD(r, b) for (r, b) in red_votes_blue_votes]
-    PBs = [calculate_PB(r, b) for (r, b) in red_votes_blue_votes]
-    D2s = [calculate_D2(r, b) for (r, b) in red_votes_blue_votes]
-    D2ds = [calculate_D2_diff(r, b) for (r, b) in red_votes_blue_votes]
+    # Calculate partisanship metrics for all simulations at once
+    MMDs = metrics.as_values(metrics.calculate_MMDs(red_votes, blue_votes))
+    PBs = metrics.as_values(metrics.calculate_PBs(red_votes, blue_votes))
+    D2s = metrics.as_values(metrics.calculate_D2s(red_votes, blue_votes))
+    D2ds = metrics.as_values(metrics.calculate_D2_diffs(red_votes, blue_votes))
     
     # Need <50% simulations with single-party outcomes for valid declination
-    D2_is_valid = len(list(filter(None, D2ds))) > len(red_votes_blue_votes) * .75
+    D2_is_valid = len(list(filter(None, D2ds))) > output_votes.shape[1] * .75
     
     # EG alone also gets a sensitivity test for vote swing scenarios
     EGs = {
-        swing: [calculate_EG(r, b, swing/100) for (r, b) in red_votes_blue_votes]
+        swing: metrics.as_values(metrics.calculate_EGs(red_votes, blue_votes, swing/100))
         for swing in (0, 1, -1, 2, -2, 3, -3, 4, -4, 5, -5)
     }
 
+    percent_ranks = percentrank_all(upload.model.house, {
+        COLUMN_MMD: safe_mean(MMDs),
+        COLUMN_PB: safe_mean(PBs),
+        COLUMN_D2: safe_mean(D2s),
+        COLUMN_EG: safe_mean(EGs[0]),
+    })
+
     summary_dict = {
         'Mean-Median': safe_mean(MMDs),
         'Mean-Median SD': safe_stdev(MMDs),
         'Mean-Median Positives': safe_positives(MMDs),
-        'Mean-Median Absolute Percent Rank': percentrank_abs(COLUMN_MMD, upload.model.house, safe_mean(MMDs)),
-        'Mean-Median Relative Percent Rank': percentrank_rel(COLUMN_MMD, upload.model.house, safe_mean(MMDs)),
+        'Mean-Median Absolute Percent Rank': percent_ranks[COLUMN_MMD][0],
+        'Mean-Median Relative Percent Rank': percent_ranks[COLUMN_MMD][1],
         'Partisan Bias': safe_mean(PBs),
         'Partisan Bias SD': safe_stdev(PBs),
         'Partisan Bias Positives': safe_positives(PBs),
-        'Partisan Bias Absolute Percent Rank': percentrank_abs(COLUMN_PB, upload.model.house, safe_mean(PBs)),
-        'Partisan Bias Relative Percent Rank': percentrank_rel(COLUMN_PB, upload.model.house, safe_mean(PBs)),
+        'Partisan Bias Absolute Percent Rank': percent_ranks[COLUMN_PB][0],
+        'Partisan Bias Relative Percent Rank': percent_ranks[COLUMN_PB][1],
         'Declination': safe_mean(D2s),
         'Declination SD': safe_stdev(D2s),
         'Declination Positives': safe_positives(D2s),
         'Declination Is Valid': D2_is_valid,
-        'Declination Absolute Percent Rank': percentrank_abs(COLUMN_D2, upload.model.house, safe_mean(D2s)),
-        'Declination Relative Percent Rank': percentrank_rel(COLUMN_D2, upload.model.house, safe_mean(D2s)),
+        'Declination Absolute Percent Rank': percent_ranks[COLUMN_D2][0],
+        'Declination Relative Percent Rank': percent_ranks[COLUMN_D2][1],
         'Efficiency Gap': safe_mean(EGs[0]),
         'Efficiency Gap SD': safe_stdev(EGs[0]),
         'Efficiency Gap Positives': safe_positives(EGs[0]),
-        'Efficiency Gap Absolute Percent Rank': percentrank_abs(COLUMN_EG, upload.model.house, safe_mean(EGs[0])),
-        'Efficiency Gap Relative Percent Rank': percentrank_rel(COLUMN_EG, upload.model.house, safe_mean(EGs[0])),
+        'Efficiency Gap Absolute Percent Rank': percent_ranks[COLUMN_EG][0],
+        'Efficiency Gap Relative Percent Rank': percent_ranks[COLUMN_EG][1],
     }
     
     for swing in (1, 2, 3, 4, 5):
@@ -677,14 +713,22 @@ def calculate_fva_biases(upload):
 parser = argparse.ArgumentParser()
 parser.add_argument('upload_url')
 
-def calculate_everything(upload1):
-    '''
+def calculate_everything(upload1, timer=None):
+    ''' Calculate all partisan metrics, optionally recording stages to a timing.Timer
     '''
-    upload2 = calculate_bias(upload1)
-    upload3 = calculate_open_biases(upload2)
-    upload4 = calculate_biases(upload3)
-    upload5 = calculate_district_biases(upload4)
-    upload6 = calculate_fva_biases(upload5)
+    timer = timer or timing.Timer()
+
+    with timer.stage('metrics'):
+        upload2 = calculate_bias(upload1)
+        simulations = load_simulations(upload2.districts)
+        upload3 = calculate_open_biases(upload2, simulations)
+        upload4 = calculate_biases(upload3, simulations)
+    
+    # Records its own model load and simulation stages, so stages don't overlap
+    upload5 = calculate_district_biases(upload4, timer)
+    
+    with timer.stage('metrics'):
+        upload6 = calculate_fva_biases(upload5)
     
     rounded_summary_dict = {
         k: None if v is None else round(v, constants.ROUND_FLOAT)
@@ -0,0 +1,122 @@
+''' Preloaded U.S. state shapes for guessing which state an upload covers.
+
+State shapes are read once per process from cb_2013_us_state_20m.geojson
+and kept prepared next to a numpy array of their bounding boxes, so points
+from a sample of districts can be placed in states without opening files
+or intersecting whole plans. Callers fall back to overlap_areas() with an
+exact footprint only when sampled points are split between states.
+'''
+import os, json, functools, collections
+import numpy
+import shapely.geometry, shapely.prepared
+
+STATES_PATH = os.path.join(os.path.dirname(__file__), 'geodata', 'cb_2013_us_state_20m.geojson')
+
+# Number of districts sampled for points
+SAMPLE_SIZE = 64
+
+# Share of sampled district area one state must hold to skip exact overlaps
+CONFIDENT_SHARE = .9
+
+StateShape = collections.namedtuple('StateShape',
+    ('abbr', 'name', 'geoid', 'area', 'shape', 'prepared'))
+
+def sample_indexes(count, size=SAMPLE_SIZE):
+    ''' Return up to size evenly-spaced indexes into a list of count items
+    '''
+    if count <= size:
+        return list(range(count))
+
+    return numpy.unique(numpy.linspace(0, count - 1, size).round().astype(int)).tolist()
+
+class StateIndex:
+    ''' Prepared state shapes with an array of bounding boxes
+    '''
+    def __init__(self, states):
+        self.states = list(states)
+        self.bboxes = numpy.array([state.shape.bounds for state in self.states],
+            dtype=float).reshape((len(self.states), 4))
+
+    def find_abbr(self, abbr):
+        ''' Return StateShape for a postal abbreviation like "NC", or None
+        '''
+        for state in self.states:
+            if state.abbr == abbr:
+                return state
+
+    def find_geoid(self, geoid):
+        ''' Return StateShape for a FIPS code like "37", or None
+        '''
+        for state in self.states:
+            if state.geoid == geoid:
+                return state
+
+    def candidates(self, xmin, ymin, xmax, ymax):
+        ''' Return StateShapes whose bounding boxes intersect the given box
+        '''
+        hits = (self.bboxes[:,0] <= xmax) & (xmin <= self.bboxes[:,2]) \
+             & (self.bboxes[:,1] <= ymax) & (ymin <= self.bboxes[:,3])
+
+        return [self.states[i] for i in numpy.flatnonzero(hits)]
+
+    def locate(self, points):
+        ''' Return a StateShape or None for each (x, y) point
+        '''
+        xys = numpy.array(points, dtype=float).reshape((len(points), 2))
+        located = [None] * len(xys)
+
+        # Boolean matrix of points by states with containing bounding boxes
+        hits = (self.bboxes[:,0] <= xys[:,0,None]) & (xys[:,0,None] <= self.bboxes[:,2]) \
+             & (self.bboxes[:,1] <= xys[:,1,None]) & (xys[:,1,None] <= self.bboxes[:,3])
+
+        for (row, column) in zip(*numpy.nonzero(hits)):
+            state = self.states[column]
+            if located[row] is None and state.prepared.contains(shapely.geometry.Point(xys[row])):
+                located[row] = state
+
+        return located
+
+    def point_shares(self, points, weights):
+        ''' Return a dictionary of weight shares by state abbreviation for points
+        '''
+        weights = numpy.array(weights, dtype=float)
+
+        if not weights.sum() > 0:
+            weights = numpy.ones(len(points))
+
+        shares = collections.defaultdict(float)
+
+        for (state, weight) in zip(self.locate(points), weights):
+            if state is not None:
+                shares[state.abbr] += weight / weights.sum()
+
+        return dict(shares)
+
+    def overlap_areas(self, footprint):
+        ''' Return a dictionary of intersection areas by state abbreviation
+
+            Includes every state whose bounding box meets the footprint,
+            like an OGR layer spatial filter.
+        '''
+        return {
+            state.abbr: state.shape.intersection(footprint).area
+                if state.prepared.intersects(footprint) else 0
+            for state in self.candidates(*footprint.bounds)
+        }
+
+@functools.lru_cache(maxsize=None)
+def load_state_index(path=STATES_PATH):
+    ''' Return a StateIndex for a GeoJSON file, read just once per process
+    '''
+    with open(path) as file:
+        features = json.load(file)['features']
+
+    states = []
+
+    for feature in features:
+        shape = shapely.geometry.shape(feature['geometry'])
+        properties = feature['properties']
+        states.append(StateShape(properties['STUSPS'], properties['NAME'],
+            properties['GEOID'], shape.area, shape, shapely.prepared.prep(shape)))
+
+    return StateIndex(states)
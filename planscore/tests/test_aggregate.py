@@ -0,0 +1,302 @@
+import unittest, unittest.mock
+import io, os
+import numpy, botocore.exceptions, shapely.geometry, shapely.wkt
+from .. import aggregate, data, partition
+
+class TestAggregate (unittest.TestCase):
+
+    def setUp(self):
+        aggregate.BLOCK_INDEXES.clear()
+        aggregate.POINT_GRIDS.clear()
+        self.blocks_path = os.path.join(os.path.dirname(__file__), 'data', 'XX', 'blocks', 'assembled-state-XX.parquet')
+
+    def make_storage(self, partition_rows, extra_bodies={}):
+        ''' Return mock S3 storage with the XX blocks and a districts partition
+        '''
+        numbers = [number for (number, _, _) in partition_rows]
+        shapes = [wkt and shapely.wkt.loads(wkt) for (_, wkt, _) in partition_rows]
+        polygons = [shape and shape.wkb for shape in shapes]
+        bboxes = [shape.bounds if shape else [numpy.nan] * 4 for shape in shapes]
+        geoid20s = [geoid20 for (_, _, geoid20) in partition_rows]
+
+        with open(self.blocks_path, 'rb') as file:
+            bodies = {
+                'data/XX/blocks/assembled-state-XX.parquet': file.read(),
+                data.UPLOAD_DISTRICTS_PARTITION_KEY.format(id='ID'):
+                    partition.table_bytes(numbers, polygons, bboxes or None, geoid20s),
+            }
+        
+        bodies.update(extra_bodies)
+        
+        def get_object(Bucket, Key):
+            if Key not in bodies:
+                raise botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+            return {'Body': io.BytesIO(bodies[Key])}
+
+        s3 = unittest.mock.Mock()
+        s3.get_paginator.return_value.paginate.return_value = [
+            {'Contents': [{'Key': 'data/XX/blocks/assembled-state-XX.parquet'}, {'Key': 'data/XX/blocks/README'}]},
+        ]
+        s3.get_object.side_effect = get_object
+
+        return data.Storage(s3, 'bucket', None)
+
+    def test_load_blocks(self):
+        storage = self.make_storage([])
+        row_count, blocks = aggregate.load_blocks(storage, 'data/XX',
+            ['US President 2016 - DEM', 'Population 2020', 'geoid20'])
+
+        self.assertEqual(row_count, 10)
+        self.assertEqual(set(blocks.keys()), {'US President 2016 - DEM', 'geoid20'},
+            'Should match names without case and skip missing columns')
+        self.assertEqual(blocks['geoid20'][0], '0000000001')
+        self.assertEqual(blocks['US President 2016 - DEM'].sum(), 600)
+
+        storage.s3.get_paginator.assert_called_once_with('list_objects_v2')
+        storage.s3.get_paginator.return_value.paginate.assert_called_once_with(
+            Bucket='bucket', Prefix='data/XX/blocks/')
+        self.assertEqual(len(storage.s3.get_object.mock_calls), 1, 'Should only read Parquet files')
+
+    def test_read_points(self):
+        xs, ys = aggregate.read_points(['POINT (1 2)', 'point(-1.5e-05 3)', None, 'LINESTRING (0 0, 1 1)'])
+
+        self.assertEqual(xs[:2].tolist(), [1, -1.5e-05])
+        self.assertEqual(ys[:2].tolist(), [2, 3])
+        self.assertTrue(numpy.isnan(xs[2:]).all())
+        self.assertTrue(numpy.isnan(ys[2:]).all())
+
+    def test_geoid_keys(self):
+        keys = aggregate.geoid_keys(['0001', '001', '1', '', None, 'x1', '\u0661', '9' * 17, '9' * 18])
+        self.assertEqual(keys.tolist(), [10001, 1001, 11, -1, -1, -1, -1, int('1' + '9' * 17), -1])
+
+    def test_build_block_index(self):
+        index = aggregate.build_block_index({
+            'GEOID20': numpy.array(['0003', None, '0001', '0002'], dtype='O'),
+            'Point': numpy.array(['POINT (3 -3)', 'POINT (9 -9)', None, 'POINT (2 -2)'], dtype='O'),
+            'US President 2020 - DEM': numpy.array([3., 9., 1., 2.]),
+            'Population 2020': numpy.array([30, 90, 10, 20]),
+            'Unknown': numpy.array([0, 0, 0, 0]),
+        })
+
+        self.assertEqual(index.keys.tolist(), [10001, 10002, 10003])
+        self.assertEqual(index.names, ['US President 2020 - DEM', 'Population 2020'],
+            'Should only see BLOCK_TABLE_FIELDS columns, in their order')
+        self.assertEqual(index.values.tolist(), [[1, 10], [2, 20], [3, 30]])
+        self.assertEqual(index.xs.tolist()[1:], [2, 3])
+        self.assertEqual(index.ys.tolist()[1:], [-2, -3])
+        self.assertTrue(numpy.isnan(index.xs[0]) and numpy.isnan(index.ys[0]))
+        
+        buffer = io.BytesIO()
+        aggregate.write_block_index(index, buffer)
+        buffer.seek(0)
+        index2 = aggregate.read_block_index(buffer)
+
+        self.assertEqual(index2.keys.tolist(), index.keys.tolist())
+        self.assertEqual(index2.names, index.names)
+        self.assertEqual(index2.values.tolist(), index.values.tolist())
+        self.assertEqual(index2.xs.tolist()[1:], index.xs.tolist()[1:])
+
+    def test_load_block_index(self):
+        buffer = io.BytesIO()
+        aggregate.write_block_index(aggregate.build_block_index({
+            'GEOID20': numpy.array(['0001']), 'Population 2020': numpy.array([7]),
+        }), buffer)
+        
+        storage = self.make_storage([], {'data/XX/block-index.npz': buffer.getvalue()})
+        index1 = aggregate.load_block_index(storage.s3, storage.bucket, 'data/XX')
+        index2 = aggregate.load_block_index(storage.s3, storage.bucket, 'data/XX')
+
+        self.assertIs(index1, index2, 'Should load the block index only once')
+        self.assertEqual(index1.keys.tolist(), [10001])
+        self.assertEqual(index1.values.tolist(), [[7]])
+        storage.s3.get_object.assert_called_once_with(Bucket='bucket', Key='data/XX/block-index.npz')
+
+        # Lambda handlers make a new S3 client for every invocation
+        s3 = unittest.mock.Mock()
+        index3 = aggregate.load_block_index(s3, storage.bucket, 'data/XX')
+        grid1 = aggregate.load_point_grid(s3, storage.bucket, 'data/XX')
+        grid2 = aggregate.load_point_grid(storage.s3, storage.bucket, 'data/XX')
+
+        self.assertIs(index3, index1, 'Should find the block index with a new client')
+        self.assertIs(grid2, grid1, 'Should find the point grid with a new client')
+        self.assertEqual(len(s3.mock_calls), 0, 'Should not use the new client')
+
+    def test_state_cache(self):
+        cache, reads = aggregate.StateCache(2), []
+        read = lambda name: (lambda: reads.append(name) or name)
+
+        self.assertEqual(cache.load('bucket', 'data/XX', read('XX')), 'XX')
+        self.assertEqual(cache.load('bucket', 'data/YY', read('YY')), 'YY')
+        self.assertEqual(cache.load('bucket', 'data/XX', read('XX2')), 'XX')
+        self.assertEqual(cache.load('bucket', 'data/ZZ', read('ZZ')), 'ZZ')
+        self.assertEqual(cache.load('bucket', 'data/YY', read('YY2')), 'YY2', 'Should drop least-recently-used')
+        self.assertEqual(reads, ['XX', 'YY', 'ZZ', 'YY2'])
+        self.assertEqual(len(cache.items), 2)
+
+    def test_load_block_index_missing(self):
+        storage = self.make_storage([])
+        index = aggregate.load_block_index(storage.s3, storage.bucket, 'data/XX')
+
+        self.assertEqual(len(index.keys), 10)
+        self.assertEqual(index.keys.tolist(), sorted(index.keys.tolist()))
+        self.assertEqual(index.names, ['US President 2016 - DEM', 'US President 2016 - REP'])
+        self.assertFalse(numpy.isnan(index.xs).any(), 'Should see a point for every block')
+
+    def test_match_geoids(self):
+        keys = numpy.array([10001, 10002, 10004])
+        block_indexes, numbers = aggregate.match_geoids(keys, [
+            aggregate.PartitionRow(0, None, '0004'),
+            aggregate.PartitionRow(0, None, '0001'),
+            aggregate.PartitionRow(1, None, '0003'),
+            aggregate.PartitionRow(1, None, '9999'),
+            aggregate.PartitionRow(2, None, '00010'),
+            aggregate.PartitionRow(2, None, None),
+        ])
+
+        self.assertEqual(block_indexes.tolist(), [0, 2])
+        self.assertEqual(numbers.tolist(), [0, 0])
+
+    def test_build_point_grid(self):
+        random = numpy.random.default_rng(seed=1)
+        xs, ys = random.uniform(-10, 10, 1000), random.uniform(0, 5, 1000)
+        xs[::100] = numpy.nan
+        grid = aggregate.build_point_grid(xs, ys, 8)
+        
+        self.assertEqual(len(grid.order), 990, 'Should skip NaN points')
+        self.assertEqual(grid.starts[-1], 990)
+        self.assertEqual(len(grid.starts), grid.columns * grid.rows + 1)
+        
+        for bounds in [(-3, 1, 2, 2), (-20, -20, 20, 20), (8, 4, 8.5, 4.5), (11, 0, 12, 5)]:
+            xmin, ymin, xmax, ymax = bounds
+            candidates = aggregate.grid_candidates(grid, bounds)
+            expected = numpy.flatnonzero((xs >= xmin) & (xs <= xmax) & (ys >= ymin) & (ys <= ymax))
+            
+            self.assertEqual(len(set(candidates)), len(candidates), 'Should see each point once')
+            self.assertTrue(set(expected) <= set(candidates), 'Should see every point in bounds')
+        
+        grid2 = aggregate.build_point_grid(numpy.array([1., 1.]), numpy.array([2., 2.]))
+        self.assertEqual(aggregate.grid_candidates(grid2, (0, 0, 3, 3)).tolist(), [0, 1])
+        self.assertEqual(aggregate.grid_candidates(grid2, (3, 3, 4, 4)).tolist(), [])
+
+    def test_contains_points(self):
+        random = numpy.random.default_rng(seed=1)
+        xs, ys = random.uniform(-1, 11, 5000), random.uniform(-1, 11, 5000)
+        
+        geometry = shapely.wkt.loads('''MULTIPOLYGON (
+            ((0 0, 10 0, 10 10, 5 3, 0 10, 0 0), (1 1, 1 2, 2 2, 2 1, 1 1)),
+            ((6 9, 7 8, 8 9.5, 6 9))
+        )''')
+        
+        is_inside = aggregate.contains_points(geometry, xs, ys)
+        expected = [geometry.contains(shapely.geometry.Point(x, y)) for (x, y) in zip(xs, ys)]
+        
+        self.assertEqual(is_inside.tolist(), expected)
+        self.assertEqual(aggregate.contains_points(geometry, xs[:0], ys[:0]).tolist(), [])
+
+    def test_match_points(self):
+        index = aggregate.BlockIndex(numpy.arange(4), numpy.array([.5, 1.5, .5, 9.]),
+            numpy.array([.5, .5, 1.5, 9.]), numpy.zeros((4, 0)), [])
+
+        block_indexes, numbers = aggregate.match_points(index,
+            aggregate.build_point_grid(index.xs, index.ys), [
+            aggregate.PartitionRow(3, shapely.wkt.loads('POLYGON ((1 0, 2 0, 2 2, 1 2, 1 0))').wkb, None),
+            aggregate.PartitionRow(4, shapely.wkt.loads('POLYGON ((0 0, 1 0, 1 2, 0 2, 0 0))').wkb, None),
+            aggregate.PartitionRow(5, shapely.wkt.loads('POLYGON ((5 5, 6 5, 6 6, 5 6, 5 5))').wkb, None),
+            aggregate.PartitionRow(6, None, '0001'),
+        ])
+
+        self.assertEqual(block_indexes.tolist(), [0, 1, 2])
+        self.assertEqual(numbers.tolist(), [4, 3, 4])
+
+    def test_match_points_bboxes(self):
+        index = aggregate.BlockIndex(numpy.arange(4), numpy.array([.5, 1.5, .5, 9.]),
+            numpy.array([.5, .5, 1.5, 9.]), numpy.zeros((4, 0)), [])
+
+        block_indexes, numbers = aggregate.match_points(index,
+            aggregate.build_point_grid(index.xs, index.ys), [
+            aggregate.PartitionRow(3, shapely.wkt.loads('POLYGON ((1 0, 2 0, 2 2, 1 2, 1 0))').wkb, None, (1, 0, 2, 2)),
+            aggregate.PartitionRow(4, shapely.wkt.loads('POLYGON ((0 0, 1 0, 1 2, 0 2, 0 0))').wkb, None, (0, 0, 1, 2)),
+            aggregate.PartitionRow(5, b'Not a polygon', None, (5, 5, 6, 6)),
+        ])
+
+        self.assertEqual(block_indexes.tolist(), [0, 1, 2])
+        self.assertEqual(numbers.tolist(), [4, 3, 4], 'Should not read polygons with no blocks in bbox')
+
+    def test_block_points(self):
+        xs, ys = aggregate.block_points({
+            'Lon': numpy.array([1., numpy.nan, numpy.nan]),
+            'Lat': numpy.array([2., numpy.nan, numpy.nan]),
+            'Point': numpy.array(['POINT (9 9)', 'POINT (3 4)', None], dtype='O'),
+        }, 3)
+
+        self.assertEqual(xs[:2].tolist(), [1, 3], 'Should prefer Lon over Point')
+        self.assertEqual(ys[:2].tolist(), [2, 4], 'Should prefer Lat over Point')
+        self.assertTrue(numpy.isnan(xs[2]) and numpy.isnan(ys[2]))
+
+        xs, ys = aggregate.block_points({'Point': numpy.array(['POINT (3 4)'], dtype='O')}, 1)
+        self.assertEqual((xs.tolist(), ys.tolist()), ([3], [4]))
+
+    def test_aggregate_blocks(self):
+        blocks = {
+            'Population 2020': numpy.array([1, 2, 3, numpy.nan]),
+            'US President 2020 - DEM': numpy.array([1.5, numpy.nan, 2.5, numpy.nan]),
+            'Household Income 2020 ACS': numpy.array([10, 30, 20, 40]),
+        }
+
+        totals = aggregate.aggregate_blocks(blocks, numpy.array([0, 1, 2, 3, 0]), numpy.array([7, 5, 5, 9, 5]))
+
+        self.assertEqual(totals, [
+            {
+                'district_number': 5,
+                'Population 2020': 6,
+                'US President 2020 - DEM': 4.,
+                'Household Income 2020 ACS': 20.,
+            },
+            {
+                'district_number': 7,
+                'Population 2020': 1,
+                'US President 2020 - DEM': 1.5,
+                'Household Income 2020 ACS': 10.,
+            },
+            {
+                'district_number': 9,
+                'Household Income 2020 ACS': 40.,
+            },
+        ])
+
+        self.assertIs(type(totals[0]['Population 2020']), int)
+
+    def test_accumulate_district_totals_spatial(self):
+        storage = self.make_storage([
+            (0, 'POLYGON ((-1 -1, 0 -1, 0 1, -1 1, -1 -1))', None),
+            (1, 'POLYGON ((0 0, 1 0, 1 1, 0 1, 0 0))', None),
+            (1, 'POLYGON ((0 -1, 1 -1, 1 0, 0 0, 0 -1))', None),
+            (2, 'POLYGON ((5 5, 6 5, 6 6, 5 6, 5 5))', None),
+        ])
+
+        upload = unittest.mock.Mock()
+        upload.id, upload.model.key_prefix = 'ID', 'data/XX'
+        (response, ) = aggregate.accumulate_district_totals(storage, upload, True)
+
+        self.assertEqual(response, ('SUCCEEDED', [
+            {'district_number': 0, 'US President 2016 - DEM': 100., 'US President 2016 - REP': 300.},
+            {'district_number': 1, 'US President 2016 - DEM': 500., 'US President 2016 - REP': 300.},
+        ]))
+
+    def test_accumulate_district_totals_geoids(self):
+        storage = self.make_storage([
+            (0, None, '0000000001'),
+            (0, None, '0000000002'),
+            (1, None, '0000000004'),
+            (1, None, '9999999999'),
+            (2, None, '9999999998'),
+        ])
+
+        upload = unittest.mock.Mock()
+        upload.id, upload.model.key_prefix = 'ID', 'data/XX'
+        (response, ) = aggregate.accumulate_district_totals(storage, upload, False)
+
+        self.assertEqual(response, ('SUCCEEDED', [
+            {'district_number': 0, 'US President 2016 - DEM': 200., 'US President 2016 - REP': 75.},
+            {'district_number': 1, 'US President 2016 - DEM': 0., 'US President 2016 - REP': 100.},
+        ]))
@@ -0,0 +1,81 @@
+import unittest, unittest.mock
+import io
+import numpy
+import shapely.wkt, shapely.ops
+from .. import benchmark, data, util, score
+
+class TestBenchmark (unittest.TestCase):
+
+    def test_case_name(self):
+        self.assertEqual(benchmark.case_name(benchmark.Case('2025A', 14, False)), '2025A-014-open')
+        self.assertEqual(benchmark.case_name(benchmark.Case('2025B', 400, True)), '2025B-400-incumbents')
+
+    def test_make_upload(self):
+        upload = benchmark.make_upload(benchmark.Case('2025B', 52, True))
+
+        self.assertEqual(len(upload.districts), 52)
+        self.assertEqual(len(upload.incumbents), 52)
+        self.assertEqual(upload.model_version, '2025B')
+        self.assertEqual(upload.model.house, data.House.ushouse, 'Should use only available 2025B models')
+        self.assertIn('US President 2024 - DEM', upload.districts[0]['totals'])
+        self.assertIn('US President 2020 - DEM', upload.districts[0]['totals'])
+        self.assertTrue(set(upload.incumbents) <= {'D', 'R', 'O'})
+        
+        totals = upload.districts[0]['totals']
+        self.assertIn('DEM000', totals)
+        self.assertIn('O:REP000', totals)
+        self.assertIn('D:DEM000', totals)
+        self.assertIn('R:REP000', totals)
+        self.assertEqual(totals['DEM000'], totals['O:DEM000'], 'Should model open seats alike')
+        
+        simulations = score.load_simulations(upload.districts)
+        self.assertEqual(simulations.votes.shape[0], 52)
+        self.assertGreater(simulations.votes.shape[1], 1, 'Should keep every modeled simulation')
+        self.assertFalse(numpy.isnan(simulations.votes).any(), 'Should fill every simulation')
+
+        upload2 = benchmark.make_upload(benchmark.Case('2025A', 2, False))
+        self.assertEqual(upload2.incumbents, ['O', 'O'])
+
+    def test_make_geometry_wkts(self):
+        wkts = benchmark.make_geometry_wkts(3, 100)
+        geometries = [shapely.wkt.loads(wkt) for wkt in wkts]
+
+        self.assertEqual(len(geometries), 3)
+        self.assertTrue(all(geometry.is_valid for geometry in geometries))
+        self.assertEqual(len(geometries[0].exterior.coords), 101)
+        self.assertAlmostEqual(sum(geometry.area for geometry in geometries),
+            shapely.ops.unary_union(geometries).area, places=6, msg='Should not overlap')
+
+    def test_make_baf_text(self):
+        pairs = util.baf_stream_to_pairs(io.StringIO(benchmark.make_baf_text(3, 10)))
+
+        self.assertEqual(len(pairs), 10)
+        self.assertEqual(pairs[0][0], '370000000000000')
+        self.assertTrue({district for (_, district) in pairs} <= {'1', '2', '3'})
+
+    def test_compare_results(self):
+        baseline = {'cases': {
+            '2025A-002-open': {'a': .100, 'b': .001, 'c': .100},
+        }}
+
+        results = {'cases': {
+            '2025A-002-open': {'a': .200, 'b': .003, 'c': .110, 'd': 1.},
+            '2025A-014-open': {'a': 1.},
+        }}
+
+        self.assertEqual(benchmark.compare_results(baseline, results),
+            [('2025A-002-open', 'a', .100, .200)],
+            'Should skip small, new, and noisy differences')
+
+    @unittest.mock.patch('planscore.postread_calculate.partition_large_geometries')
+    @unittest.mock.patch('planscore.compactness.get_scores')
+    def test_run_cases(self, get_scores, partition_large_geometries):
+        results = benchmark.run_cases([benchmark.Case('2025A', 2, True)], repeat=1, block_count=10)
+        timings = results['cases']['2025A-002-incumbents']
+
+        self.assertEqual(len(get_scores.mock_calls), 2)
+        self.assertEqual(len(partition_large_geometries.mock_calls), 2)
+
+        for stage in ('matrix.load_model', 'matrix.model_votes', 'score.calculate_district_biases',
+                'score.calculate_everything', 'util.baf_stream_to_pairs'):
+            self.assertGreaterEqual(timings[stage], 0)
@@ -0,0 +1,121 @@
+import unittest, unittest.mock, os, io, shutil, tempfile
+import numpy, networkx, shapely.wkb
+from .. import blockgraph
+
+graph_path = os.path.join(os.path.dirname(__file__), 'data', 'XX-graphs', '2020', '00000-tabblock.pickle.gz')
+
+class TestBlockGraph (unittest.TestCase):
+
+    def test_from_digraph(self):
+        graph = blockgraph.read_pickle_graph(graph_path)
+        compact = blockgraph.from_digraph(graph)
+        
+        self.assertEqual(len(compact.node_ids), 11)
+        self.assertEqual(compact.node_ids[-1], b'outside')
+        self.assertEqual(len(compact.targets), 54)
+        self.assertEqual(compact.indptr[-1], 54)
+        self.assertEqual(compact.line_offsets[-1], len(compact.line_wkb))
+        self.assertTrue(numpy.isnan(compact.pos[-1]).all(), 'Outside has no position')
+        self.assertEqual(tuple(compact.pos[0]), graph.nodes['0000000001']['pos'])
+        
+        # Every edge and its line should survive the trip
+        for (i, node_id) in enumerate(compact.node_ids):
+            for edge in range(compact.indptr[i], compact.indptr[i + 1]):
+                target_id = compact.node_ids[compact.targets[edge]]
+                start, stop = compact.line_offsets[edge], compact.line_offsets[edge + 1]
+                line = shapely.wkb.loads(bytes(compact.line_wkb[start:stop]))
+                expected = graph.edges[(node_id.decode('ascii'), target_id.decode('ascii'))]['line']
+                self.assertTrue(line.equals(expected))
+    
+    def test_read_block_graph(self):
+        compact1 = blockgraph.from_digraph(blockgraph.read_pickle_graph(graph_path))
+        
+        with tempfile.TemporaryDirectory() as dirname:
+            path = os.path.join(dirname, 'graph.npz')
+
+            with open(path, 'wb') as file:
+                blockgraph.write_block_graph(compact1, file)
+            
+            compact2 = blockgraph.read_block_graph(path)
+            
+            for (array1, array2) in zip(compact1, compact2):
+                self.assertIsInstance(array2, numpy.memmap)
+                self.assertTrue(numpy.array_equal(array1, array2, equal_nan=(array1.dtype == float)))
+    
+    def test_read_block_graph_unmapped(self):
+        compact1 = blockgraph.from_digraph(blockgraph.read_pickle_graph(graph_path))
+        
+        with tempfile.TemporaryDirectory() as dirname:
+            path = os.path.join(dirname, 'graph.npz')
+
+            with open(path, 'wb') as file:
+                blockgraph.write_block_graph(compact1, file)
+            
+            compact2 = blockgraph.read_block_graph(path, mmap=False)
+            os.unlink(path)
+        
+        for (array1, array2) in zip(compact1, compact2):
+            self.assertNotIsInstance(array2, numpy.memmap)
+            self.assertTrue(numpy.array_equal(array1, array2, equal_nan=(array1.dtype == float)))
+    
+    def test_npz_path(self):
+        self.assertEqual(blockgraph.npz_path('data/XX/graphs/2020/00000-tabblock.pickle.gz'),
+            'data/XX/graphs/2020/00000-tabblock.npz')
+        self.assertEqual(blockgraph.npz_path('00000-tabblock.pickle'), '00000-tabblock.npz')
+    
+    def test_convert_s3_graph(self):
+        s3 = unittest.mock.Mock()
+        s3.download_file.side_effect = lambda Bucket, Key, Filename: shutil.copy(graph_path, Filename)
+        
+        key = blockgraph.convert_s3_graph(s3, 'bucket', 'data/XX/graphs/2020/00000-tabblock.pickle.gz')
+        self.assertEqual(key, 'data/XX/graphs/2020/00000-tabblock.npz')
+        
+        (put_call, ) = s3.put_object.mock_calls
+        self.assertEqual(put_call[2]['Bucket'], 'bucket')
+        self.assertEqual(put_call[2]['Key'], key)
+        
+        with tempfile.TemporaryDirectory() as dirname:
+            path = os.path.join(dirname, 'graph.npz')
+
+            with open(path, 'wb') as file:
+                file.write(put_call[2]['Body'])
+            
+            compact = blockgraph.read_block_graph(path, mmap=False)
+        
+        self.assertEqual(len(compact.node_ids), 11)
+        self.assertEqual(len(compact.targets), 54)
+    
+    def test_read_block_graph_empty(self):
+        compact1 = blockgraph.from_digraph(networkx.DiGraph())
+        
+        with tempfile.TemporaryDirectory() as dirname:
+            path = os.path.join(dirname, 'graph.npz')
+
+            with open(path, 'wb') as file:
+                blockgraph.write_block_graph(compact1, file)
+            
+            compact2 = blockgraph.read_block_graph(path)
+        
+        self.assertEqual(len(compact2.node_ids), 0)
+        self.assertEqual(list(compact2.indptr), [0])
+        self.assertEqual(blockgraph.district_boundary([compact2], ['0000000001']), ([], []))
+    
+    def test_district_boundary(self):
+        graph = blockgraph.read_pickle_graph(graph_path)
+        compact = blockgraph.from_digraph(graph)
+        node_ids = ['0000000004', '0000000008', '0000000009', '0000000010']
+        
+        points, wkbs = blockgraph.district_boundary([compact], node_ids)
+        expected = list(networkx.algorithms.boundary.edge_boundary(graph, node_ids))
+        
+        self.assertEqual(sorted(points), sorted(graph.nodes[id]['pos'] for id in node_ids))
+        self.assertEqual(len(wkbs), len(expected))
+        self.assertAlmostEqual(
+            sum(shapely.wkb.loads(wkb).length for wkb in wkbs),
+            sum(graph.edges[edge]['line'].length for edge in expected),
+        )
+        
+        # A second copy of the same graph should not duplicate any lines
+        points2, wkbs2 = blockgraph.district_boundary([compact, compact], node_ids)
+        self.assertEqual(len(points2), len(points))
+        self.assertEqual(len(wkbs2), len(wkbs))
@@ -1,50 +1,152 @@
-import unittest, unittest.mock, math
+import unittest, unittest.mock, math, multiprocessing
+import numpy
 from osgeo import ogr
 from .. import compactness
+from ..compactness import minimumcircle, smallestenclosingcircle
 
 def raises_exception():
     raise Exception('Well actually')
 
+def random_point_sets(seed, count):
+    ''' Generate arrays of points in shapes that trip up geometry code
+    '''
+    rng = numpy.random.default_rng(seed)
+    
+    for i in range(count):
+        size, scale = rng.integers(1, 200), 10 ** rng.uniform(-3, 6)
+        kind = i % 5
+        
+        if kind == 0:
+            # Gaussian cloud
+            xy = rng.normal(size=(size, 2))
+        elif kind == 1:
+            # Small integer grid with duplicate and collinear points
+            xy = rng.integers(-3, 4, size=(size, 2)).astype(float)
+        elif kind == 2:
+            # Noisy ring, like a wiggly district boundary
+            t = rng.uniform(0, 2 * math.pi, size)
+            r = 1 + rng.uniform(-.05, .05, size)
+            xy = numpy.stack([r * numpy.cos(t), r * numpy.sin(t)], axis=1)
+        elif kind == 3:
+            # Points along one line
+            xy = numpy.outer(rng.uniform(-1, 1, size), rng.normal(size=2))
+        else:
+            # Long thin rectangle, rotated and far from the origin
+            xy = rng.uniform(0, 1, size=(size, 2)) * (1, .01)
+            angle = rng.uniform(0, math.pi)
+            xy = xy @ [[math.cos(angle), math.sin(angle)], [-math.sin(angle), math.cos(angle)]] + 1e3
+        
+        yield xy * scale
+
 class TestCompactness (unittest.TestCase):
 
-    @unittest.mock.patch('planscore.compactness.get_polsbypopper_score')
-    @unittest.mock.patch('planscore.compactness.get_reock_score')
-    def test_get_scores(self, get_reock_score, get_polsbypopper_score):
+    @unittest.mock.patch('planscore.compactness.project_geometry')
+    def test_get_scores(self, project_geometry):
+        '''
         '''
+        reock, polsbypopper = unittest.mock.Mock(), unittest.mock.Mock()
+        geometry = unittest.mock.Mock()
+
+        with unittest.mock.patch.dict(compactness.METRICS, {'Reock': reock, 'Polsby-Popper': polsbypopper}):
+            scores = compactness.get_scores(geometry)
+
+        self.assertEqual(set(scores.keys()), {'Reock', 'Polsby-Popper'})
+        self.assertEqual(scores['Reock'], reock.return_value)
+        self.assertEqual(scores['Polsby-Popper'], polsbypopper.return_value)
+        project_geometry.assert_called_once_with(geometry)
+        reock.assert_called_once_with(project_geometry.return_value)
+        polsbypopper.assert_called_once_with(project_geometry.return_value)
+    
+    @unittest.mock.patch('planscore.compactness.project_geometry')
+    def test_get_scores_more_metrics(self, project_geometry):
+        ''' Additional metrics share one projected shape
         '''
+        metrics = {name: unittest.mock.Mock() for name in compactness.METRICS}
         geometry = unittest.mock.Mock()
-        scores = compactness.get_scores(geometry)
 
-        self.assertEqual(scores['Reock'], get_reock_score.return_value)
-        self.assertEqual(scores['Polsby-Popper'], get_polsbypopper_score.return_value)
-        get_reock_score.assert_called_once_with(geometry)
-        get_polsbypopper_score.assert_called_once_with(geometry)
+        with unittest.mock.patch.dict(compactness.METRICS, metrics):
+            scores = compactness.get_scores(geometry, tuple(metrics.keys()))
+
+        self.assertEqual(set(scores.keys()), {'Reock', 'Polsby-Popper', 'Schwartzberg', 'Convex Hull'})
+        project_geometry.assert_called_once_with(geometry)
+        
+        for (name, metric) in metrics.items():
+            self.assertEqual(scores[name], metric.return_value)
+            metric.assert_called_once_with(project_geometry.return_value)
     
-    @unittest.mock.patch('planscore.compactness.get_polsbypopper_score')
-    @unittest.mock.patch('planscore.compactness.get_reock_score')
-    def test_get_scores_bad_reock(self, get_reock_score, get_polsbypopper_score):
+    @unittest.mock.patch('planscore.compactness.project_geometry')
+    def test_get_scores_bad_reock(self, project_geometry):
         '''
         '''
-        get_reock_score.side_effect = raises_exception
+        reock = unittest.mock.Mock(side_effect=raises_exception)
 
-        geometry = unittest.mock.Mock()
-        scores = compactness.get_scores(geometry)
+        with unittest.mock.patch.dict(compactness.METRICS, {'Reock': reock}):
+            scores = compactness.get_scores(unittest.mock.Mock())
 
         self.assertIsNone(scores['Reock'])
-        get_reock_score.assert_called_once_with(geometry)
+        self.assertIsNotNone(scores['Polsby-Popper'])
+        reock.assert_called_once_with(project_geometry.return_value)
     
-    @unittest.mock.patch('planscore.compactness.get_polsbypopper_score')
-    @unittest.mock.patch('planscore.compactness.get_reock_score')
-    def test_get_scores_bad_polsbypopper(self, get_reock_score, get_polsbypopper_score):
+    @unittest.mock.patch('planscore.compactness.project_geometry')
+    def test_get_scores_bad_polsbypopper(self, project_geometry):
         '''
         '''
-        get_polsbypopper_score.side_effect = raises_exception
+        polsbypopper = unittest.mock.Mock(side_effect=raises_exception)
 
-        geometry = unittest.mock.Mock()
-        scores = compactness.get_scores(geometry)
+        with unittest.mock.patch.dict(compactness.METRICS, {'Polsby-Popper': polsbypopper}):
+            scores = compactness.get_scores(unittest.mock.Mock())
 
         self.assertIsNone(scores['Polsby-Popper'])
-        get_polsbypopper_score.assert_called_once_with(geometry)
+        polsbypopper.assert_called_once_with(project_geometry.return_value)
+    
+    @unittest.mock.patch('planscore.compactness.project_geometry')
+    def test_get_scores_bad_projection(self, project_geometry):
+        '''
+        '''
+        project_geometry.side_effect = raises_exception
+        scores = compactness.get_scores(unittest.mock.Mock())
+
+        self.assertEqual(scores, {'Reock': None, 'Polsby-Popper': None})
+    
+    @unittest.mock.patch('planscore.compactness.get_scores')
+    def test_get_plan_scores(self, get_scores):
+        ''' Districts are scored in order, in parallel or not
+        '''
+        get_scores.side_effect = lambda geometry, metrics: {'Index': geometry}
+        geometries = list(range(40))
+
+        scores = compactness.get_plan_scores(geometries, processes=1)
+        self.assertEqual(scores, [{'Index': i} for i in range(40)])
+        self.assertEqual(len(get_scores.mock_calls), 40)
+
+        scores = compactness.get_plan_scores(geometries, processes=3)
+        self.assertEqual(scores, [{'Index': i} for i in range(40)])
+
+        self.assertEqual(compactness.get_plan_scores([]), [])
+    
+    @unittest.mock.patch('planscore.compactness.get_scores')
+    def test_get_plan_scores_error(self, get_scores):
+        ''' Errors in parallel processes are raised
+        '''
+        get_scores.side_effect = lambda geometry, metrics: 1 / geometry
+
+        with self.assertRaises(ZeroDivisionError):
+            compactness.get_plan_scores([1, 2, 0, 4], processes=2)
+    
+    @unittest.mock.patch('planscore.compactness.get_scores')
+    def test_get_plan_scores_error_joins(self, get_scores):
+        ''' Every parallel process is joined before an error is raised
+        '''
+        get_scores.side_effect = lambda geometry, metrics: 1 / geometry
+        join = multiprocessing.process.BaseProcess.join
+
+        with unittest.mock.patch('multiprocessing.process.BaseProcess.join',
+            autospec=True, side_effect=join) as mock_join:
+            with self.assertRaises(ZeroDivisionError):
+                compactness.get_plan_scores([0, 1, 2, 3, 4, 5], processes=3)
+        
+        self.assertEqual(len(mock_join.mock_calls), 3, 'Should join every process')
+        self.assertTrue(all(call[1][0].exitcode == 0 for call in mock_join.mock_calls))
     
     def test_reock_score(self):
         ''' Reock score looks about right
@@ -75,3 +177,83 @@ class TestCompactness (unittest.TestCase):
         # A square around Lake Merritt with a peephole in it
         geom3 = ogr.CreateGeometryFromJson('{"type": "Polygon", "coordinates": [[[-122.2631266, 37.7987797], [-122.2631266, 37.8103489], [-122.2484841, 37.8103489], [-122.2484841, 37.7987797], [-122.2631266, 37.7987797]], [[-122.257189, 37.804124], [-122.257189, 37.804132], [-122.257178, 37.804132], [-122.257178, 37.804124], [-122.257189, 37.804124]]]}')
         self.assertAlmostEqual(compactness.get_polsbypopper_score(geom3), math.pi/4, places=2)
+    
+    def test_more_scores(self):
+        ''' Schwartzberg and Convex Hull scores look about right
+        '''
+        # A square around Lake Merritt
+        geom1 = ogr.CreateGeometryFromJson('{"type": "Polygon", "coordinates": [[[-122.2631266, 37.7987797], [-122.2631266, 37.8103489], [-122.2484841, 37.8103489], [-122.2484841, 37.7987797], [-122.2631266, 37.7987797]]]}')
+        scores1 = compactness.get_scores(geom1, tuple(compactness.METRICS.keys()))
+        self.assertAlmostEqual(scores1['Schwartzberg'], math.sqrt(math.pi/4), places=3)
+        self.assertAlmostEqual(scores1['Convex Hull'], 1., places=4)
+
+        # An L-shape covering three quarters of a square
+        geom2 = ogr.CreateGeometryFromJson('{"type": "Polygon", "coordinates": [[[-122.26, 37.80], [-122.26, 37.81], [-122.255, 37.81], [-122.255, 37.805], [-122.25, 37.805], [-122.25, 37.80], [-122.26, 37.80]]]}')
+        scores2 = compactness.get_scores(geom2, ('Convex Hull', ))
+        self.assertAlmostEqual(scores2['Convex Hull'], 6/7, places=2)
+
+class TestMinimumCircle (unittest.TestCase):
+
+    def test_convex_hull(self):
+        ''' Convex hull is counter-clockwise and contains every point
+        '''
+        square = [(0, 0), (1, 0), (1, 1), (0, 1), (.5, .5), (0, .5), (1, 1)]
+        self.assertEqual(minimumcircle.convex_hull(square).tolist(), [[0, 0], [1, 0], [1, 1], [0, 1]])
+        self.assertEqual(minimumcircle.convex_hull([(2, 2), (0, 0), (1, 1)]).tolist(), [[0, 0], [2, 2]])
+        self.assertEqual(minimumcircle.convex_hull([(1, 1)] * 3).tolist(), [[1, 1]])
+        self.assertEqual(minimumcircle.convex_hull([(1, 1), (1, 1)]).tolist(), [[1, 1]])
+        self.assertEqual(minimumcircle.convex_hull([]).tolist(), [])
+        
+        for xy in random_point_sets(1, 200):
+            hull = minimumcircle.convex_hull(xy)
+            
+            # Every vertex is an input point
+            self.assertTrue(all((xy == vertex).all(axis=1).any() for vertex in hull))
+            
+            if len(hull) < 3:
+                continue
+            
+            # Every point is left of or on every edge
+            for (a, b) in zip(hull, numpy.roll(hull, -1, axis=0)):
+                cross = minimumcircle._cross(a, b, xy)
+                self.assertTrue((cross >= -1e-9 * numpy.abs(xy).max() ** 2).all())
+    
+    def test_convex_hull_prefilter(self):
+        ''' Points inside the polygon of extreme points are dropped before quickhull
+        '''
+        xy = numpy.random.default_rng(seed=1).normal(size=(10000, 2))
+        
+        with unittest.mock.patch('planscore.compactness.minimumcircle._hull_side',
+            wraps=minimumcircle._hull_side) as hull_side:
+            hull = minimumcircle.convex_hull(xy)
+        
+        searched = sum([len(call[1][0]) for call in hull_side.mock_calls])
+        self.assertLess(searched, 500, 'Should drop most interior points')
+        self.assertGreaterEqual(searched, len(hull) - 2)
+    
+    def test_make_circle(self):
+        ''' Circles around convex hulls match Nayuki's implementation for all points
+        '''
+        self.assertIsNone(minimumcircle.make_circle([]))
+        self.assertEqual(minimumcircle.make_circle([(1, 2)]), (1, 2, 0))
+        self.assertEqual(minimumcircle.make_circle([(0, 0), (2, 0)]), (1, 0, 1))
+        
+        for xy in random_point_sets(2, 500):
+            expected = smallestenclosingcircle.make_circle(xy.tolist())
+            circle = minimumcircle.make_circle(minimumcircle.convex_hull(xy))
+            
+            self.assertAlmostEqual(circle[2], expected[2], delta=1e-9 * max(1, expected[2]))
+            self.assertAlmostEqual(circle[0], expected[0], delta=1e-7 * max(1, expected[2]))
+            self.assertAlmostEqual(circle[1], expected[1], delta=1e-7 * max(1, expected[2]))
+            
+            distances = numpy.hypot(xy[:,0] - circle[0], xy[:,1] - circle[1])
+            self.assertTrue((distances <= circle[2] * (1 + 1e-9)).all(), 'Should enclose every point')
+    
+    def test_make_circle_deterministic(self):
+        ''' Same seed gives the same circle, other seeds the same within precision
+        '''
+        xy = next(random_point_sets(3, 1))
+        circle = minimumcircle.make_circle(xy)
+        
+        self.assertEqual(minimumcircle.make_circle(xy), circle)
+        self.assertAlmostEqual(minimumcircle.make_circle(xy, seed=99)[2], circle[2], places=9)
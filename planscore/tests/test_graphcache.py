@@ -0,0 +1,134 @@
+import unittest, unittest.mock, os, time, tempfile, shutil
+from .. import graphcache
+
+def fake_download_file(Bucket, Key, Filename):
+    with open(Filename, 'w') as file:
+        file.write(Key)
+
+def read_text(path):
+    with open(path) as file:
+        return file.read()
+
+def estimate_size(graph, path):
+    return 10
+
+class TestGraphCache (unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(prefix='TestGraphCache-')
+    
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_memory_cache(self, stdout):
+        s3 = unittest.mock.Mock()
+        s3.download_file.side_effect = fake_download_file
+        cache = graphcache.GraphCache(25)
+
+        self.assertEqual(cache.load(s3, 'bucket', 'key1', read_text, estimate_size), 'key1')
+        self.assertEqual(cache.load(s3, 'bucket', 'key2', read_text, estimate_size), 'key2')
+        self.assertEqual(cache.load(s3, 'bucket', 'key1', read_text, estimate_size), 'key1')
+        self.assertEqual(cache.stats(), graphcache.CacheStats(1, 2, 0, 0, 0, 2, 20))
+        
+        # Another client with the same bucket and key should still hit
+        self.assertEqual(cache.load(unittest.mock.Mock(), 'bucket', 'key2', read_text, estimate_size), 'key2')
+        
+        # Third graph is over budget and pushes out least-recently-used key1
+        self.assertEqual(cache.load(s3, 'bucket', 'key3', read_text, estimate_size), 'key3')
+        self.assertEqual(cache.stats(), graphcache.CacheStats(2, 3, 0, 1, 0, 2, 20))
+        self.assertEqual(list(cache.graphs), [('bucket', 'key2'), ('bucket', 'key3')])
+        
+        self.assertEqual(len(s3.download_file.mock_calls), 3)
+        
+        for call in s3.download_file.mock_calls:
+            self.assertFalse(os.path.exists(call[2]['Filename']), 'Should leave no files behind')
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_oversize_graph(self, stdout):
+        s3 = unittest.mock.Mock()
+        s3.download_file.side_effect = fake_download_file
+        cache = graphcache.GraphCache(5)
+
+        cache.load(s3, 'bucket', 'key1', read_text, estimate_size)
+        cache.load(s3, 'bucket', 'key2', read_text, estimate_size)
+        self.assertEqual(list(cache.graphs), [('bucket', 'key2')], 'Should keep newest graph')
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_disk_cache(self, stdout):
+        s3 = unittest.mock.Mock()
+        s3.download_file.side_effect = fake_download_file
+        
+        # Room in memory for one graph, and on disk for two 9-byte files
+        cache = graphcache.GraphCache(10, self.dirname, 20)
+
+        cache.load(s3, 'bucket', 'data/key1', read_text, estimate_size)
+        cache.load(s3, 'bucket', 'data/key2', read_text, estimate_size)
+        self.assertEqual(cache.load(s3, 'bucket', 'data/key1', read_text, estimate_size), 'data/key1')
+        self.assertEqual(len(s3.download_file.mock_calls), 2, 'Should read key1 from disk')
+        self.assertEqual(cache.stats(), graphcache.CacheStats(0, 3, 1, 2, 0, 1, 10))
+        
+        # Third file pushes least-recently-used key2 off the disk
+        cache.load(s3, 'bucket', 'data/key3', read_text, estimate_size)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dirname, 'bucket', 'data'))), ['key1', 'key3'])
+        self.assertEqual(cache.stats().disk_evictions, 1)
+        
+        # A fresh cache, as after a cold start, still finds files on disk
+        cache2 = graphcache.GraphCache(10, self.dirname, 20)
+        self.assertEqual(cache2.load(s3, 'bucket', 'data/key3', read_text, estimate_size), 'data/key3')
+        self.assertEqual(cache2.stats().disk_hits, 1)
+        self.assertEqual(len(s3.download_file.mock_calls), 3)
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_failed_download(self, stdout):
+        s3 = unittest.mock.Mock()
+        s3.download_file.side_effect = IOError('Nope')
+        cache = graphcache.GraphCache(10, self.dirname, 20)
+        
+        with self.assertRaises(IOError):
+            cache.load(s3, 'bucket', 'data/key1', read_text, estimate_size)
+        
+        self.assertEqual(os.listdir(os.path.join(self.dirname, 'bucket', 'data')), [])
+        self.assertEqual(cache.stats().count, 0)
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_partial_downloads(self, stdout):
+        s3 = unittest.mock.Mock()
+        s3.download_file.side_effect = fake_download_file
+        cache = graphcache.GraphCache(10, self.dirname, 20)
+        os.makedirs(os.path.join(self.dirname, 'bucket', 'data'))
+        
+        # One download killed long ago, and one still in progress
+        stale_path = os.path.join(self.dirname, 'bucket', 'data', 'partial-stale')
+        fresh_path = os.path.join(self.dirname, 'bucket', 'data', 'partial-fresh')
+        
+        for path in (stale_path, fresh_path):
+            with open(path, 'w') as file:
+                file.write('x' * 9)
+        
+        stale_time = time.time() - graphcache.STALE_PARTIAL_SECONDS - 1
+        os.utime(stale_path, (stale_time, stale_time))
+        
+        cache.load(s3, 'bucket', 'data/key1', read_text, estimate_size)
+        self.assertFalse(os.path.exists(stale_path), 'Should delete stale partial file')
+        self.assertTrue(os.path.exists(fresh_path), 'Should keep partial file in progress')
+        self.assertEqual(cache.stats().disk_evictions, 1)
+        
+        # Partial file in progress counts toward the budget and pushes out key1
+        cache.load(s3, 'bucket', 'data/key2', read_text, estimate_size)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dirname, 'bucket', 'data'))), ['key2', 'partial-fresh'])
+        self.assertEqual(cache.stats().disk_evictions, 2)
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_killed_download(self, stdout):
+        s3 = unittest.mock.Mock()
+        s3.download_file.side_effect = KeyboardInterrupt()
+        
+        for cache in (graphcache.GraphCache(10, self.dirname, 20), graphcache.GraphCache(10)):
+            with self.assertRaises(KeyboardInterrupt):
+                cache.load(s3, 'bucket', 'data/key1', read_text, estimate_size)
+        
+        self.assertEqual(os.listdir(os.path.join(self.dirname, 'bucket', 'data')), [])
+        
+        for call in s3.download_file.mock_calls:
+            self.assertFalse(os.path.exists(call[2]['Filename']), 'Should leave no files behind')
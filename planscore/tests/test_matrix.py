@@ -1,6 +1,6 @@
 import unittest, unittest.mock
-import itertools
-from .. import matrix, data
+import itertools, os, tempfile
+from .. import matrix, data, timing
 import numpy
 
 ZERO = 0.
@@ -178,6 +178,48 @@ class TestMatrix (unittest.TestCase):
         # self.assertAlmostEqual(model.c_matrix[matrix.VOT_C,0], 0.0769)
         # self.assertAlmostEqual(model.c_matrix[matrix.INC_C,0], ZERO) # Open seat
     
+    def test_load_matrices(self):
+        matrices1 = matrix.load_matrices('-2025A', '-openseat-congress')
+        matrices2 = matrix.load_matrices('-2025A', '-openseat-congress')
+        
+        self.assertIs(matrices1, matrices2, 'Should load matrices just once')
+        self.assertEqual(matrices1.c_index['b_Intercept'], 0)
+        self.assertEqual(matrices1.c_matrix.shape[1], 1000)
+        self.assertEqual(matrices1.e_matrix.shape, (500, 1000))
+        self.assertFalse(matrices1.c_matrix.flags.writeable)
+        self.assertFalse(matrices1.e_matrix.flags.writeable)
+    
+    def test_has_matrices(self):
+        self.assertTrue(matrix.has_matrices('-2025A', '-openseat-congress'))
+        self.assertTrue(matrix.has_matrices('-2025B', '-incumbency-congress'))
+        self.assertFalse(matrix.has_matrices('-2025B', '-incumbency-statelege'))
+        self.assertFalse(matrix.has_matrices('-2025B', ''))
+    
+    @unittest.mock.patch('planscore.matrix.matrix_paths')
+    def test_convert_matrices(self, matrix_paths):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            model_dir = os.path.join(os.path.dirname(matrix.__file__), 'model')
+            matrix_paths.return_value = (
+                os.path.join(model_dir, 'C_matrix_full-2025A-openseat-congress.csv.gz'),
+                os.path.join(model_dir, 'E_matrix_full-2025A-openseat-congress.csv.gz'),
+                os.path.join(tmpdir, 'CE_matrix_full-2025A-openseat-congress.npz'),
+            )
+            
+            npz_path = matrix.convert_matrices('-2025A', '-openseat-congress')
+            self.assertEqual(npz_path, matrix_paths.return_value[2])
+
+            try:
+                matrix.load_matrices.cache_clear()
+                converted = matrix.load_matrices('-2025A', '-openseat-congress')
+            finally:
+                matrix.load_matrices.cache_clear()
+        
+        c_keys, c_matrix, e_matrix = matrix.read_matrices(*matrix_paths.return_value[:2])
+        
+        self.assertEqual(converted.c_index, {c_key: i for (i, c_key) in enumerate(c_keys)})
+        self.assertTrue((converted.c_matrix == c_matrix).all())
+        self.assertTrue((converted.e_matrix == e_matrix).all())
+    
     def test_apply_model_2025A_incumbents_congress(self):
         model = matrix.load_model('-2025A', 'ca', 2024, has_incumbents=True, is_congress=True)
     
@@ -292,6 +334,7 @@ class TestMatrix (unittest.TestCase):
             [0.6, 0.7]
         ])
 
+        timer = timing.Timer()
         R = matrix.model_votes(
             '2025B',
             data.State.NC,
@@ -301,8 +344,10 @@ class TestMatrix (unittest.TestCase):
                 (5, 5, 'O'),
                 (6, 4, 'D'),
             ],
+            timer=timer,
         )
         
+        self.assertEqual([stage.stage for stage in timer.stages], ['model load', 'simulation'])
         self.assertEqual(apply_model.mock_calls[0][1], (
             [(.4, -1), (.5, 0), (.6, 1)],
             load_model.return_value,
@@ -0,0 +1,81 @@
+import unittest
+import numpy
+from .. import metrics, score, matrix
+
+class TestMetrics (unittest.TestCase):
+
+    def setUp(self):
+        ''' Random DxS votes with a few uncounted and empty districts
+        '''
+        random = numpy.random.default_rng(seed=1)
+        totals = random.uniform(1000, 10000, size=(13, 200))
+        blue_shares = random.beta(4, 4, size=totals.shape)
+
+        self.blue_votes = totals * blue_shares
+        self.red_votes = totals - self.blue_votes
+
+        self.red_votes[3,:], self.blue_votes[3,:] = numpy.nan, numpy.nan
+        self.red_votes[7,::5], self.blue_votes[7,::5] = numpy.nan, numpy.nan
+        self.red_votes[11,::7], self.blue_votes[11,::7] = 0, 0
+
+        # A few one-sided simulations where one party wins every seat
+        self.red_votes[:,0], self.blue_votes[:,0] = self.red_votes[:,0] + totals[:,0], self.blue_votes[:,0] / 10
+        self.red_votes[:,1], self.blue_votes[:,1] = self.red_votes[:,1] / 10, self.blue_votes[:,1] + totals[:,1]
+
+    def iter_sims(self):
+        for sim in range(self.red_votes.shape[1]):
+            yield (
+                matrix.dropna(self.red_votes[:,sim]).tolist(),
+                matrix.dropna(self.blue_votes[:,sim]).tolist(),
+            )
+
+    def assertMatchesScalar(self, scores, expected_scores):
+        self.assertEqual(len(scores), len(expected_scores))
+
+        for (score1, score2) in zip(metrics.as_values(scores), expected_scores):
+            if score2 is None:
+                self.assertIsNone(score1)
+            else:
+                self.assertAlmostEqual(score1, score2, places=12)
+
+    def test_as_values(self):
+        self.assertEqual(metrics.as_values(numpy.array([1., numpy.nan, -1.])), [1., None, -1.])
+
+    def test_calculate_EGs(self):
+        for swing in (0, 1, -1, 5, -5, 30, -30):
+            self.assertMatchesScalar(
+                metrics.calculate_EGs(self.red_votes, self.blue_votes, swing/100),
+                [score.calculate_EG(r, b, swing/100) for (r, b) in self.iter_sims()],
+            )
+
+    def test_calculate_EGs_simple(self):
+        gaps1 = metrics.calculate_EGs([[2], [3], [5], [6]], [[6], [5], [3], [2]])
+        self.assertAlmostEqual(gaps1[0], 0)
+
+        gaps2 = metrics.calculate_EGs([[1], [5], [5], [5]], [[7], [3], [3], [3]], -.1)
+        self.assertAlmostEqual(gaps2[0], -.05)
+
+    def test_calculate_MMDs(self):
+        self.assertMatchesScalar(
+            metrics.calculate_MMDs(self.red_votes, self.blue_votes),
+            [score.calculate_MMD(r, b) for (r, b) in self.iter_sims()],
+        )
+
+    def test_calculate_PBs(self):
+        self.assertMatchesScalar(
+            metrics.calculate_PBs(self.red_votes, self.blue_votes),
+            [score.calculate_PB(r, b) for (r, b) in self.iter_sims()],
+        )
+
+    def test_calculate_D2s(self):
+        self.assertMatchesScalar(
+            metrics.calculate_D2s(self.red_votes, self.blue_votes),
+            [score.calculate_D2(r, b) for (r, b) in self.iter_sims()],
+        )
+
+    def test_calculate_D2_diffs(self):
+        D2ds = metrics.calculate_D2_diffs(self.red_votes, self.blue_votes)
+
+        self.assertMatchesScalar(D2ds, [score.calculate_D2_diff(r, b) for (r, b) in self.iter_sims()])
+        self.assertTrue(numpy.isnan(D2ds[0]), 'Should see no D2 diff when red wins every seat')
+        self.assertTrue(numpy.isnan(D2ds[1]), 'Should see no D2 diff when blue wins every seat')
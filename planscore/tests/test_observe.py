@@ -1,6 +1,6 @@
 import unittest, unittest.mock, os, io, itertools, gzip, json
 import botocore.exceptions
-from .. import observe, data
+from .. import observe, data, timing
 
 should_gzip = itertools.cycle([True, False])
 
@@ -61,22 +61,24 @@ class TestObserveTiles (unittest.TestCase):
             CacheControl='public, no-cache, no-store',
             ACL='public-read', ContentType='text/plain'))
 
-    def test_put_part_timings(self):
+    def test_put_stage_timings(self):
         ''' Upload timing file is posted to S3
         '''
         storage, upload = unittest.mock.Mock(), unittest.mock.Mock()
         upload.id, upload.start_time = 'fake-id', 1621099219
         upload.model = None
-        observe.put_part_timings(storage, upload, [
-            observe.SubTotal(None, dict(start_time=1.1, elapsed_time=2.2, features=3)),
-            observe.SubTotal(None, dict(start_time=4.4, elapsed_time=5.5, features=6)),
-        ], 'mock')
+        timer = timing.Timer()
+        timer.stages = [
+            timing.StageTiming('download', 1.1, 2.2, 333.3),
+            timing.StageTiming('compactness', 4.4, 5.5, 666.6),
+        ]
+        observe.put_stage_timings(storage, upload, timer)
         
         (put_call, ) = storage.s3.put_object.mock_calls
         
         self.assertEqual(put_call[2], dict(Bucket=storage.bucket,
             Key=data.UPLOAD_TIMING_KEY.format(id=upload.id, ds='2021-05-15'),
-            Body='fake-id\tmock\t3\t1.1\t2.2\t\t\t\r\nfake-id\tmock\t6\t4.4\t5.5\t\t\t\r\n',
+            Body='fake-id\tdownload\t\t1.1\t2.2\t\t\t\t333.3\r\nfake-id\tcompactness\t\t4.4\t5.5\t\t\t\t666.6\r\n',
             ACL='public-read', ContentType='text/plain'))
 
     def test_get_district_index(self):
@@ -120,6 +122,36 @@ class TestObserveTiles (unittest.TestCase):
         s3.list_objects.assert_called_once_with(Bucket='bucket-name',
             Prefix="uploads/sample-plan/geometries/")
     
+    def test_geometry_bundle(self):
+        ''' Geometry bundle round-trips a list of WKB strings
+        '''
+        wkbs = [b'\x01\x03', b'', bytearray(b'\x01\x06\x00')]
+        body = observe.pack_geometry_bundle(wkbs)
+
+        self.assertEqual(observe.unpack_geometry_bundle(body), [b'\x01\x03', b'', b'\x01\x06\x00'])
+        self.assertEqual(observe.unpack_geometry_bundle(observe.pack_geometry_bundle([])), [])
+
+        with self.assertRaises(ValueError):
+            observe.unpack_geometry_bundle(body[:-1])
+    
+    @unittest.mock.patch('osgeo.ogr.CreateGeometryFromWkb')
+    def test_load_upload_geometries_bundle(self, CreateGeometryFromWkb):
+        ''' Expected geometries are retrieved from a single S3 bundle.
+        '''
+        s3, upload = unittest.mock.Mock(), unittest.mock.Mock()
+        storage = data.Storage(s3, 'bucket-name', 'XX')
+        upload.id = 'sample-plan'
+
+        body = observe.pack_geometry_bundle([b'zero', b'one'])
+        s3.get_object.return_value = {'Body': io.BytesIO(gzip.compress(body)), 'ContentEncoding': 'gzip'}
+
+        geometries = observe.load_upload_geometries(storage, upload)
+
+        self.assertEqual(len(geometries), 2)
+        self.assertEqual([call[1][0] for call in CreateGeometryFromWkb.mock_calls], [b'zero', b'one'])
+        s3.get_object.assert_called_once_with(Bucket='bucket-name', Key='uploads/sample-plan/geometries.wkb')
+        self.assertEqual(len(s3.list_objects.mock_calls), 0)
+    
     def test_load_upload_assignment_keys(self):
         ''' Expected assignment keys are retrieved from S3.
         '''
@@ -141,19 +173,37 @@ class TestObserveTiles (unittest.TestCase):
         s3.list_objects.assert_called_once_with(Bucket='bucket-name',
             Prefix="uploads/sample-plan3/assignments/")
 
-    @unittest.mock.patch('planscore.compactness.get_scores')
-    def test_populate_compactness(self, get_scores):
+    def test_load_upload_assignments(self):
+        ''' Assignment keys are retrieved in district order with their sizes.
+        '''
+        s3, upload = unittest.mock.Mock(), unittest.mock.Mock()
+        storage = data.Storage(s3, 'bucket-name', 'XX')
+        upload.id = 'sample-plan3'
+
+        s3.list_objects.return_value = {'Contents': [
+            {'Key': "uploads/sample-plan3/assignments/10.txt", 'Size': 32},
+            {'Key': "uploads/sample-plan3/assignments/9.txt", 'Size': 16},
+            ]}
+
+        self.assertEqual(observe.load_upload_assignments(storage, upload), [
+            ("uploads/sample-plan3/assignments/9.txt", 16),
+            ("uploads/sample-plan3/assignments/10.txt", 32),
+        ])
+
+    @unittest.mock.patch('planscore.compactness.get_plan_scores')
+    def test_populate_compactness(self, get_plan_scores):
         '''
         '''
         geometries = [unittest.mock.Mock()]
+        get_plan_scores.return_value = [{'Reock': .5}]
         districts = observe.populate_compactness(geometries)
         
-        get_scores.assert_called_once_with(geometries[0])
+        get_plan_scores.assert_called_once_with(geometries)
         self.assertEqual(len(districts), len(geometries))
-        self.assertEqual(districts[0]['compactness'], get_scores.return_value)
+        self.assertEqual(districts[0]['compactness'], {'Reock': .5})
     
-    @unittest.mock.patch('planscore.observe.wait_for_object')
-    def test_build_blockassign_geojson(self, wait_for_object):
+    @unittest.mock.patch('planscore.observe.wait_for_objects')
+    def test_build_blockassign_geojson(self, wait_for_objects):
         '''
         '''
         context, storage = unittest.mock.Mock(), unittest.mock.Mock()
@@ -162,8 +212,10 @@ class TestObserveTiles (unittest.TestCase):
         
         storage.to_event.return_value = {}
         
-        wait_for_object.return_value = {'Body': unittest.mock.Mock()}
-        wait_for_object.return_value['Body'].read.return_value = b'POINT(0 0)'
+        wait_for_objects.return_value = iter([
+            (data.UPLOAD_GEOMETRIES_KEY.format(id='sample-plan3', index='1'), b'POINT(1 1)'),
+            (data.UPLOAD_GEOMETRIES_KEY.format(id='sample-plan3', index='0'), b'POINT(0 0)'),
+        ])
         
         district_keys = [
             (
@@ -179,28 +231,105 @@ class TestObserveTiles (unittest.TestCase):
         geojson = observe.build_blockassign_geojson(district_keys, model, storage, lam, context)
         self.assertTrue(geojson.startswith('{'))
         
-        self.assertEqual(len(lam.invoke.mock_calls), 2)
+        self.assertEqual(len(lam.invoke.mock_calls), 1)
         self.assertEqual(
-            lam.invoke.mock_calls[0][2]['Payload'],
-            '{"storage": {}, "assignment_key": "uploads/sample-plan3/assignments/0.txt", "geometry_key": "uploads/sample-plan3/geometries/0.wkt", "state_code": "XX"}',
+            json.loads(lam.invoke.mock_calls[0][2]['Payload']),
+            {
+                'storage': {},
+                'districts': [
+                    {'assignment_key': 'uploads/sample-plan3/assignments/0.txt', 'geometry_key': 'uploads/sample-plan3/geometries/0.wkt'},
+                    {'assignment_key': 'uploads/sample-plan3/assignments/1.txt', 'geometry_key': 'uploads/sample-plan3/geometries/1.wkt'},
+                ],
+                'state_code': 'XX',
+            },
         )
+
+    @unittest.mock.patch('osgeo.ogr.CreateGeometryFromWkt')
+    @unittest.mock.patch('planscore.observe.wait_for_objects')
+    def test_build_blockassign_geojson_batches(self, wait_for_objects, CreateGeometryFromWkt):
+        ''' Districts are split into Polygonize invocations by block count
+        '''
+        CreateGeometryFromWkt.return_value.SimplifyPreserveTopology.return_value.ExportToJson.return_value = '{}'
+        context, storage = unittest.mock.Mock(), unittest.mock.Mock()
+        lam, model = unittest.mock.Mock(), unittest.mock.Mock()
+        model.state.value = 'XX'
+        storage.to_event.return_value = {}
+        
+        district_keys = [
+            (
+                data.UPLOAD_ASSIGNMENTS_KEY.format(id='sample-plan3', index=str(i)),
+                data.UPLOAD_GEOMETRIES_KEY.format(id='sample-plan3', index=str(i)),
+            )
+            for i in range(3)
+        ]
+        
+        wait_for_objects.return_value = iter([(geometry_key, b'POINT(0 0)') for (_, geometry_key) in district_keys])
+        
+        block_counts = [60000, 30000, 60000]
+        observe.build_blockassign_geojson(district_keys, model, storage, lam, context, block_counts)
+        
         self.assertEqual(
-            lam.invoke.mock_calls[1][2]['Payload'],
-            '{"storage": {}, "assignment_key": "uploads/sample-plan3/assignments/1.txt", "geometry_key": "uploads/sample-plan3/geometries/1.wkt", "state_code": "XX"}',
+            [
+                [district['geometry_key'] for district in json.loads(call[2]['Payload'])['districts']]
+                for call in lam.invoke.mock_calls
+            ],
+            [
+                ['uploads/sample-plan3/geometries/0.wkt', 'uploads/sample-plan3/geometries/1.wkt'],
+                ['uploads/sample-plan3/geometries/2.wkt'],
+            ],
         )
 
+    @unittest.mock.patch('time.sleep')
+    def test_wait_for_objects(self, sleep):
+        ''' Objects are yielded in the order they appear, checked in one listing
+        '''
+        s3, context = unittest.mock.Mock(), unittest.mock.Mock()
+        storage = data.Storage(s3, 'bucket-name', 'XX')
+        context.get_remaining_time_in_millis.return_value = 60000
+        
+        keys = ['uploads/ID/geometries/0.wkt', 'uploads/ID/geometries/1.wkt', 'uploads/ID/geometries/2.wkt']
+        
+        s3.list_objects.side_effect = [
+            {'Contents': []},
+            {'Contents': []},
+            {'Contents': [{'Key': keys[2]}]},
+            {'Contents': [{'Key': keys[2]}]},
+            {'Contents': [{'Key': keys[0]}, {'Key': keys[1]}, {'Key': keys[2]}]},
+        ]
+        s3.get_object.side_effect = lambda Bucket, Key: {'Body': io.BytesIO(Key.encode('utf8'))}
+        
+        objects = list(observe.wait_for_objects(context, storage, keys))
+        
+        self.assertEqual([key for (key, _) in objects], [keys[2], keys[0], keys[1]])
+        self.assertEqual(objects[0][1], keys[2].encode('utf8'))
+        self.assertEqual(sleep.mock_calls, [unittest.mock.call(.25), unittest.mock.call(.5), unittest.mock.call(.25)])
+        self.assertEqual(s3.list_objects.mock_calls[0], unittest.mock.call(Bucket='bucket-name', Prefix='uploads/ID/geometries/'))
+        self.assertEqual(len(s3.get_object.mock_calls), 3, 'Should get each object once')
+    
+    @unittest.mock.patch('time.sleep')
+    def test_wait_for_objects_out_of_time(self, sleep):
+        '''
+        '''
+        s3, context = unittest.mock.Mock(), unittest.mock.Mock()
+        storage = data.Storage(s3, 'bucket-name', 'XX')
+        context.get_remaining_time_in_millis.return_value = 4000
+        s3.list_objects.return_value = {'Contents': []}
+        
+        with self.assertRaises(RuntimeError):
+            list(observe.wait_for_objects(context, storage, ['uploads/ID/geometries/0.wkt']))
+
     @unittest.mock.patch('planscore.observe.build_blockassign_geojson')
-    @unittest.mock.patch('planscore.observe.load_upload_assignment_keys')
+    @unittest.mock.patch('planscore.observe.load_upload_assignments')
     @unittest.mock.patch('planscore.observe.put_upload_index')
-    def test_add_blockassign_upload_geometry(self, put_upload_index, load_upload_assignment_keys, build_blockassign_geojson):
+    def test_add_blockassign_upload_geometry(self, put_upload_index, load_upload_assignments, build_blockassign_geojson):
         context = unittest.mock.Mock()
         lam = unittest.mock.Mock()
         storage = unittest.mock.Mock()
         upload = unittest.mock.Mock()
         upload.id = 'sample-plan'
-        load_upload_assignment_keys.return_value = [
-            'uploads/sample-plan/assignments/0.txt',
-            'uploads/sample-plan/assignments/1.txt',
+        load_upload_assignments.return_value = [
+            ('uploads/sample-plan/assignments/0.txt', 1600),
+            ('uploads/sample-plan/assignments/1.txt', 3200),
         ]
         build_blockassign_geojson.return_value = '{"type": "FeatureCollection"}'
         
@@ -211,7 +340,7 @@ class TestObserveTiles (unittest.TestCase):
                 ('uploads/sample-plan/assignments/0.txt', 'uploads/sample-plan/geometries/0.wkt'),
                 ('uploads/sample-plan/assignments/1.txt', 'uploads/sample-plan/geometries/1.wkt'),
             ],
-            upload.model, storage, lam, context,
+            upload.model, storage, lam, context, [100, 200],
         )
         self.assertEqual(len(storage.s3.put_object.mock_calls), 1)
         self.assertEqual(storage.s3.put_object.mock_calls[0][2]['Bucket'], storage.bucket)
@@ -0,0 +1,96 @@
+import unittest, io, math
+import numpy, pyarrow.parquet, shapely.geometry, shapely.ops, shapely.wkb
+from .. import partition
+
+def wiggly_polygon(count, scale=1):
+    ''' Return a star-ish polygon with a lot of vertices
+    '''
+    return shapely.geometry.Polygon([
+        (scale * (1 + .1 * math.sin(i / 7)) * math.cos(2 * math.pi * i / count),
+         scale * (1 + .1 * math.sin(i / 7)) * math.sin(2 * math.pi * i / count))
+        for i in range(count)
+    ])
+
+class TestPartition (unittest.TestCase):
+
+    def test_grid_cells(self):
+        cells = partition.grid_cells((0, 0, 4, 1), 0x4000 * 2, 0x4000)
+        self.assertEqual(len(cells), 4)
+        self.assertEqual(cells[0], (0, 0, 1, 1))
+        self.assertEqual(cells[-1], (3, 0, 4, 1))
+
+        cells = partition.grid_cells((0, 0, 2, 2), 0x4000 * 2, 0x4000)
+        self.assertEqual(len(cells), 4, 'Should see a 2x2 grid for a square')
+
+        cells = partition.grid_cells((0, 0, 4, 1), 1, cell_size=.5)
+        self.assertEqual(len(cells), 16, 'Should see fixed size cells')
+        self.assertEqual(cells[1], (0, .5, .5, 1))
+
+        cells = partition.grid_cells((0, 0, 4, 0), 0x4000 * 2, 0x4000)
+        self.assertEqual(len(cells), 4, 'Should see one row for a flat shape')
+
+    def test_polygonal(self):
+        box1, box2 = shapely.geometry.box(0, 0, 1, 1), shapely.geometry.box(2, 2, 3, 3)
+        line = shapely.geometry.LineString([(0, 0), (1, 1)])
+
+        self.assertIs(partition.polygonal(box1), box1)
+        self.assertIsNone(partition.polygonal(line))
+        self.assertIsNone(partition.polygonal(shapely.geometry.Polygon()))
+        self.assertEqual(partition.polygonal(shapely.geometry.GeometryCollection([box1, line])), box1)
+        self.assertEqual(partition.polygonal(shapely.geometry.GeometryCollection([box1, line, box2])),
+            shapely.geometry.MultiPolygon([box1, box2]))
+
+    def test_partition_shape_small(self):
+        shape = shapely.geometry.box(0, 0, 1, 1)
+        self.assertEqual(partition.partition_shape(shape), [shape])
+
+    def test_partition_shape(self):
+        shape = wiggly_polygon(20000, 1000)
+        pieces = partition.partition_shape(shape, 0x4000)
+
+        self.assertGreater(len(pieces), 1)
+        self.assertTrue(all(len(piece.wkb) < 0x4000 for piece in pieces))
+        self.assertAlmostEqual(sum([piece.area for piece in pieces]), shape.area, delta=shape.area * 1e-9)
+        self.assertAlmostEqual(shapely.ops.unary_union(pieces).area, shape.area, delta=shape.area * 1e-9)
+
+        pieces2 = partition.partition_shape(shape, 0x4000, 100)
+        self.assertTrue(all(len(piece.wkb) < 0x4000 for piece in pieces2))
+        self.assertGreater(len(pieces2), len(pieces), 'Should see more pieces with small cells')
+        self.assertAlmostEqual(sum([piece.area for piece in pieces2]), shape.area, delta=shape.area * 1e-9)
+
+    def test_partition_shape_bunched(self):
+        ''' Cells with most of the vertices are gridded again
+        '''
+        dense = wiggly_polygon(20000, .01)
+        shape = shapely.geometry.MultiPolygon([dense, shapely.geometry.box(10, 10, 11, 11)])
+        pieces = partition.partition_shape(shape, 0x4000)
+
+        self.assertTrue(all(len(piece.wkb) < 0x4000 for piece in pieces))
+        self.assertAlmostEqual(sum([piece.area for piece in pieces]), shape.area, delta=shape.area * 1e-9)
+
+    def test_partition_stats(self):
+        stats = partition.partition_stats([[100], [200, 300, 50], []])
+        self.assertEqual(stats, partition.PartitionStats(3, 4, 650, 300, 1))
+        self.assertEqual(partition.partition_stats([]), partition.PartitionStats(0, 0, 0, 0, 0))
+
+    def test_table_bytes_polygons(self):
+        box1, box2 = shapely.geometry.box(0, 0, 1, 1), shapely.geometry.box(-1, 2, 0, 3)
+        body = partition.table_bytes([0, 1], [box1.wkb, box2.wkb], [box1.bounds, box2.bounds])
+        table = pyarrow.parquet.read_table(io.BytesIO(body))
+
+        self.assertEqual(table.schema, partition.TABLE_SCHEMA)
+        self.assertEqual(table['Number'].to_pylist(), [0, 1])
+        self.assertEqual(shapely.wkb.loads(table['Polygon'][1].as_py()), box2)
+        self.assertEqual(table['XMin'].to_pylist(), [0, -1])
+        self.assertEqual(table['YMax'].to_pylist(), [1, 3])
+        self.assertEqual(table['GEOID20'].null_count, 2)
+
+    def test_table_bytes_geoids(self):
+        body = partition.table_bytes(numpy.array([0, 0, 1]), geoid20s=numpy.array(['0001', '0002', '0003']))
+        table = pyarrow.parquet.read_table(io.BytesIO(body))
+        metadata = pyarrow.parquet.ParquetFile(io.BytesIO(body)).metadata
+
+        self.assertEqual(table['GEOID20'].to_pylist(), ['0001', '0002', '0003'])
+        self.assertEqual(table['Polygon'].null_count, 3)
+        self.assertEqual(table['XMin'].null_count, 3)
+        self.assertIn('RLE_DICTIONARY', metadata.row_group(0).column(6).encodings)
@@ -1,5 +1,6 @@
-import unittest, unittest.mock, os
-import networkx
+import unittest, unittest.mock, os, io, itertools
+import networkx, shapely.ops, shapely.wkt, shapely.geometry, botocore.exceptions
+from .. import blockgraph
 from .. import polygonize
 
 class TestPolygonize (unittest.TestCase):
@@ -24,6 +25,31 @@ class TestPolygonize (unittest.TestCase):
         self.assertEqual(graph3.edges[('A', 'B')]['line'], 'yes')
         self.assertEqual(graph3.edges[('B', 'A')]['line'], 'yup')
     
+    def test_merge_digraphs(self):
+        ''' Many DiGraphs are merged in one pass, later graphs winning
+        '''
+        graphs = [networkx.DiGraph() for _ in range(3)]
+        
+        graphs[0].add_edge('A', 'B', line='a-b')
+        graphs[0].add_node('A', pos='a')
+        graphs[1].add_edge('B', 'C', line='b-c')
+        graphs[1].add_edge('B', 'A', line='nope') # to be overriden by graphs[2]
+        graphs[1].add_node('B', pos='b')
+        graphs[2].add_edge('B', 'A', line='b-a')
+        graphs[2].add_edge('C', 'B', line='c-b')
+        graphs[2].add_node('C', pos='c')
+        graphs[2].add_node('D', pos='lonely') # not on any edge
+        
+        graph = polygonize.merge_digraphs(iter(graphs))
+        self.assertEqual(set(graph.nodes), {'A', 'B', 'C'})
+        self.assertEqual(len(graph.edges), 4)
+        self.assertEqual({id: graph.nodes[id]['pos'] for id in graph.nodes}, {'A': 'a', 'B': 'b', 'C': 'c'})
+        self.assertEqual(graph.edges[('B', 'A')]['line'], 'b-a')
+        
+        combined = polygonize.combine_digraphs(polygonize.combine_digraphs(graphs[0], graphs[1]), graphs[2])
+        self.assertEqual(dict(graph.nodes(data=True)), dict(combined.nodes(data=True)))
+        self.assertEqual(set(graph.edges(data='line')), set(combined.edges(data='line')))
+    
     def test_polygonize_district(self):
         '''
         '''
@@ -37,3 +63,214 @@ class TestPolygonize (unittest.TestCase):
         node_ids2 = ['0000000001', '0000000002', '0000000003', '0000000005', '0000000006', '0000000007']
         geometry2 = polygonize.polygonize_district(node_ids2, graph)
         self.assertAlmostEqual(geometry2.area, 1.77923e-07, places=10)
+    
+    def test_dissolve_boundary(self):
+        ''' Ring tracing matches the union of block shapes for many districts
+        '''
+        path = os.path.join(os.path.dirname(__file__), 'data', 'XX-graphs', '2020', '00000-tabblock.pickle.gz')
+        graph = networkx.read_gpickle(path)
+        all_ids = sorted(id for id in graph.nodes if id != 'outside')
+        
+        # Every district of one or two blocks and a sample of larger ones
+        districts = [
+            node_ids for count in range(1, len(all_ids) + 1)
+            for (index, node_ids) in enumerate(itertools.combinations(all_ids, count))
+            if count <= 2 or index % 7 == 0
+        ]
+        
+        for node_ids in districts:
+            boundary = networkx.algorithms.boundary.edge_boundary(graph, node_ids)
+            lines = [graph.edges[edge]['line'] for edge in boundary]
+            geometry = polygonize.dissolve_boundary(lines)
+            self.assertTrue(geometry.is_valid, node_ids)
+            
+            expected = shapely.ops.unary_union([graph.nodes[id]['geom'] for id in node_ids])
+            self.assertAlmostEqual(geometry.symmetric_difference(expected).area, 0, places=15, msg=node_ids)
+            
+            # Previous method tested polygonized faces against every block
+            # point, and missed slivers of multipolygon blocks like 0000000002
+            multipoint = shapely.geometry.MultiPoint([graph.nodes[id]['pos'] for id in node_ids])
+            previous = shapely.ops.unary_union([poly for poly in shapely.ops.polygonize(lines)
+                if poly.relate_pattern(multipoint, '0********')])
+            self.assertAlmostEqual(previous.difference(geometry).area, 0, places=15, msg=node_ids)
+    
+    def test_dissolve_boundary_shapes(self):
+        ''' Ring tracing handles holes, islands in holes, and pinched corners
+        '''
+        ls = shapely.geometry.LineString
+        
+        # Square with a hole holding an island, boundary split into pieces
+        lines = [
+            ls([(0, 0), (6, 0), (6, 6)]), ls([(6, 6), (0, 6), (0, 0)]),
+            ls([(1, 1), (5, 1), (5, 5), (1, 5), (1, 1)]),
+            ls([(2, 2), (4, 2), (4, 4)]), ls([(4, 4), (2, 4), (2, 2)]),
+        ]
+        geometry = polygonize.dissolve_boundary(lines)
+        self.assertEqual(geometry.geom_type, 'MultiPolygon')
+        self.assertAlmostEqual(geometry.area, 36 - 16 + 4)
+        self.assertFalse(geometry.contains(shapely.geometry.Point(1.5, 3)))
+        self.assertTrue(geometry.contains(shapely.geometry.Point(3, 3)))
+        
+        # Two squares touching at one corner
+        lines = [
+            shapely.geometry.MultiLineString([[(0, 0), (1, 0), (1, 1)], [(1, 1), (0, 1), (0, 0)]]),
+            ls([(1, 1), (2, 1), (2, 2), (1, 2), (1, 1)]),
+        ]
+        geometry = polygonize.dissolve_boundary(lines)
+        self.assertTrue(geometry.is_valid)
+        self.assertAlmostEqual(geometry.area, 2)
+        
+        # U-shaped block and a triangle touching its arms at corners, around a courtyard
+        block_a = [(0, 0), (3, 0), (3, 3), (2, 3), (2, 1), (1, 1), (1, 3), (0, 3), (0, 0)]
+        block_b = [(1, 3), (2, 3), (1.5, 4), (1, 3)]
+        lines = [ls([p, q]) for ring in (block_a, block_b) for (p, q) in zip(ring[:-1], ring[1:])]
+        geometry = polygonize.dissolve_boundary(lines)
+        self.assertTrue(geometry.is_valid)
+        self.assertAlmostEqual(geometry.area, 7 + .5)
+        self.assertFalse(geometry.contains(shapely.geometry.Point(1.5, 2)), 'Courtyard should be a hole')
+        
+        # One square
+        geometry = polygonize.dissolve_boundary([ls([(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)])])
+        self.assertEqual(geometry.geom_type, 'Polygon')
+        self.assertAlmostEqual(geometry.area, 1)
+    
+    def test_polygonize_block_district(self):
+        ''' Compact block graphs polygonize the same as NetworkX graphs
+        '''
+        path = os.path.join(os.path.dirname(__file__), 'data', 'XX-graphs', '2020', '00000-tabblock.pickle.gz')
+        graph = networkx.read_gpickle(path)
+        graphs = [blockgraph.from_digraph(graph)]
+
+        node_ids1 = ['0000000004', '0000000008', '0000000009', '0000000010']
+        geometry1 = polygonize.polygonize_block_district(node_ids1, graphs)
+        self.assertTrue(geometry1.equals(polygonize.polygonize_district(node_ids1, graph)))
+
+        node_ids2 = ['0000000001', '0000000002', '0000000003', '0000000005', '0000000006', '0000000007']
+        geometry2 = polygonize.polygonize_any(node_ids2, graphs)
+        self.assertAlmostEqual(geometry2.area, 1.77923e-07, places=10)
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('planscore.polygonize.assemble_graph')
+    @unittest.mock.patch('planscore.polygonize.load_block_graph')
+    def test_load_plan_graph(self, load_block_graph, assemble_graph, stdout):
+        ''' Compact graphs are preferred, with NetworkX pickles as a fallback
+        '''
+        s3, block_ids = unittest.mock.Mock(), ['0000100001', '0000200001', '0000100002']
+
+        graphs = polygonize.load_plan_graph(s3, 'XX', block_ids)
+        self.assertEqual(graphs, [load_block_graph.return_value] * 2)
+        self.assertEqual([call[1][2] for call in load_block_graph.mock_calls],
+            ['data/XX/graphs/2020/00001-tabblock.npz', 'data/XX/graphs/2020/00002-tabblock.npz'])
+        self.assertEqual(len(assemble_graph.mock_calls), 0)
+
+        load_block_graph.side_effect = botocore.exceptions.ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        graph = polygonize.load_plan_graph(s3, 'XX', block_ids)
+        self.assertIs(graph, assemble_graph.return_value)
+        assemble_graph.assert_called_once_with(s3, 'XX', block_ids)
+    
+    def test_polygonize_districts(self):
+        '''
+        '''
+        path = os.path.join(os.path.dirname(__file__), 'data', 'XX-graphs', '2020', '00000-tabblock.pickle.gz')
+        graph = networkx.read_gpickle(path)
+
+        district_block_ids = [
+            ['0000000004', '0000000008', '0000000009', '0000000010'],
+            ['0000000001', '0000000002', '0000000003', '0000000005', '0000000006', '0000000007'],
+        ]
+        
+        wkts1 = polygonize.polygonize_districts(district_block_ids, graph, processes=1)
+        wkts2 = polygonize.polygonize_districts(district_block_ids, graph, processes=2)
+        
+        self.assertEqual(wkts1, wkts2, 'Forked processes should match serial results')
+        self.assertAlmostEqual(shapely.wkt.loads(wkts2[0]).area, 1.01019e-07, places=10)
+        self.assertAlmostEqual(shapely.wkt.loads(wkts2[1]).area, 1.77923e-07, places=10)
+    
+    def test_polygonize_districts_error(self):
+        '''
+        '''
+        graph = networkx.DiGraph()
+
+        with self.assertRaises(KeyError):
+            polygonize.polygonize_districts([['missing1'], ['missing2']], graph, processes=2)
+    
+    def test_polygonize_districts_callback(self):
+        ''' Finished districts are passed along before an error in another is raised
+        '''
+        path = os.path.join(os.path.dirname(__file__), 'data', 'XX-graphs', '2020', '00000-tabblock.pickle.gz')
+        graph = networkx.read_gpickle(path)
+
+        district_block_ids = [
+            ['0000000004', '0000000008', '0000000009', '0000000010'],
+            ['missing1'],
+            ['0000000001', '0000000002', '0000000003', '0000000005', '0000000006', '0000000007'],
+        ]
+        
+        for processes in (1, 2):
+            finished = {}
+            
+            with self.assertRaises(KeyError):
+                polygonize.polygonize_districts(district_block_ids, graph, processes, finished.__setitem__)
+            
+            self.assertEqual(sorted(finished.keys()), [0, 2], f'Should finish good districts with {processes} processes')
+            self.assertAlmostEqual(shapely.wkt.loads(finished[0]).area, 1.01019e-07, places=10)
+    
+    @unittest.mock.patch('planscore.polygonize.GRAPH_CACHE')
+    def test_limit_processes(self, GRAPH_CACHE):
+        '''
+        '''
+        GRAPH_CACHE.stats.return_value.bytes = 0
+        graph = networkx.DiGraph()
+        graph.add_edges_from([(1, 2), (2, 3)])
+        graph_bytes = 2 * polygonize.DIGRAPH_EDGE_BYTES
+        
+        with unittest.mock.patch('planscore.constants.POLYGONIZE_MEMORY_BYTES', graph_bytes * 4):
+            self.assertEqual(polygonize.limit_processes(graph, 8), 3, 'Should fit three copies beside the original')
+            self.assertEqual(polygonize.limit_processes(graph, 2), 2)
+            self.assertEqual(polygonize.limit_processes([], 8), 8, 'Should not limit BlockGraphs')
+        
+        with unittest.mock.patch('planscore.constants.POLYGONIZE_MEMORY_BYTES', graph_bytes):
+            self.assertEqual(polygonize.limit_processes(graph, 8), 1)
+    
+    def test_batch_districts(self):
+        '''
+        '''
+        self.assertEqual(polygonize.batch_districts([60, 30, 60, 10, 200, 5], 100), [[0, 1], [2, 3], [4], [5]])
+        self.assertEqual(polygonize.batch_districts([1, 2, 3], 100), [[0, 1, 2]])
+        self.assertEqual(polygonize.batch_districts([]), [])
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('planscore.polygonize.load_block_graph')
+    @unittest.mock.patch('planscore.polygonize.load_graph')
+    @unittest.mock.patch('boto3.client')
+    def test_batch_lambda_handler(self, boto3_client, load_graph, load_block_graph, stdout):
+        ''' All districts are polygonized from county graphs loaded once
+        '''
+        path = os.path.join(os.path.dirname(__file__), 'data', 'XX-graphs', '2020', '00000-tabblock.pickle.gz')
+        load_graph.return_value = networkx.read_gpickle(path)
+        load_block_graph.side_effect = botocore.exceptions.ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+
+        s3 = boto3_client.return_value
+        s3.put_object.return_value = {'ResponseMetadata': {'RetryAttempts': 0}}
+        s3.get_object.side_effect = lambda Bucket, Key: {'Body': io.BytesIO({
+            'uploads/ID/assignments/0.txt': b'0000000004\n0000000008\n0000000009\n0000000010\n',
+            'uploads/ID/assignments/1.txt': b'0000000001\n0000000002\n0000000003\n0000000005\n0000000006\n0000000007\n',
+        }[Key])}
+
+        event = {
+            'storage': {'bucket': 'bucket-name', 'prefix': 'XX'},
+            'state_code': 'XX',
+            'districts': [
+                {'assignment_key': 'uploads/ID/assignments/0.txt', 'geometry_key': 'uploads/ID/geometries/0.wkt'},
+                {'assignment_key': 'uploads/ID/assignments/1.txt', 'geometry_key': 'uploads/ID/geometries/1.wkt'},
+            ],
+        }
+
+        geometry_keys = polygonize.lambda_handler(event, None)
+
+        self.assertEqual(geometry_keys, ['uploads/ID/geometries/0.wkt', 'uploads/ID/geometries/1.wkt'])
+        self.assertEqual(len(load_graph.mock_calls), 1, 'Should load one county graph once')
+
+        bodies = {call[2]['Key']: call[2]['Body'] for call in s3.put_object.mock_calls}
+        self.assertAlmostEqual(shapely.wkt.loads(bodies['uploads/ID/geometries/0.wkt']).area, 1.01019e-07, places=10)
+        self.assertAlmostEqual(shapely.wkt.loads(bodies['uploads/ID/geometries/1.wkt']).area, 1.77923e-07, places=10)
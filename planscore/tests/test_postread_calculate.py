@@ -1,7 +1,27 @@
-import unittest, unittest.mock, io, os, contextlib, gzip
-from .. import postread_calculate, data, constants
+import unittest, unittest.mock, io, os, json, contextlib, gzip
+import botocore.exceptions, shapely.geometry, pyarrow.parquet
+from .. import postread_calculate, data, constants, observe
 from osgeo import ogr
 
+def put_bodies(s3):
+    ''' Return put_object() bodies by key, since concurrent puts may come in any order
+    '''
+    return {call[2]['Key']: call[2]['Body'] for call in s3.put_object.mock_calls}
+
+def partition_rows(body):
+    ''' Return (Number, GEOID20) tuples from a districts partition Parquet body
+    '''
+    table = pyarrow.parquet.read_table(io.BytesIO(body), columns=['Number', 'GEOID20'])
+    return list(zip(*[column.to_pylist() for column in table.columns]))
+
+def missing_s3():
+    ''' Return a mock S3 client with no objects to get
+    '''
+    s3 = unittest.mock.Mock()
+    s3.put_object.return_value = {'ResponseMetadata': {'RetryAttempts': 0}}
+    s3.get_object.side_effect = botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+    return s3
+
 class TestPostreadCalculate (unittest.TestCase):
 
     def setUp(self):
@@ -60,7 +80,7 @@ class TestPostreadCalculate (unittest.TestCase):
     def test_put_district_geometries(self, stdout):
         '''
         '''
-        s3 = unittest.mock.Mock()
+        s3 = missing_s3()
         upload = data.Upload('ID', 'uploads/ID/upload/file.geojson')
         null_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.geojson')
         keys = postread_calculate.put_district_geometries(s3, 'bucket-name', upload, null_plan_path)
@@ -70,13 +90,14 @@ class TestPostreadCalculate (unittest.TestCase):
             'uploads/ID/geometry-bboxes.geojson',
         ])
         
-        self.assertEqual(s3.mock_calls[-1][2]['Key'], 'uploads/ID/districts/partition.csv.gz')
+        self.assertIn('uploads/ID/districts/partition.parquet', put_bodies(s3))
+        self.assertIn('uploads/ID/geometries.wkb', put_bodies(s3))
     
     @unittest.mock.patch('sys.stdout')
     def test_put_district_geometries_25d(self, stdout):
         '''
         '''
-        s3 = unittest.mock.Mock()
+        s3 = missing_s3()
         upload = data.Upload('ID', 'uploads/ID/upload/file.geojson')
         null_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan-25d.geojson')
         keys = postread_calculate.put_district_geometries(s3, 'bucket-name', upload, null_plan_path)
@@ -86,13 +107,13 @@ class TestPostreadCalculate (unittest.TestCase):
             'uploads/ID/geometry-bboxes.geojson',
         ])
         
-        self.assertEqual(s3.mock_calls[-1][2]['Key'], 'uploads/ID/districts/partition.csv.gz')
+        self.assertIn('uploads/ID/districts/partition.parquet', put_bodies(s3))
     
     @unittest.mock.patch('sys.stdout')
     def test_put_district_geometries_missing_geometries(self, stdout):
         '''
         '''
-        s3 = unittest.mock.Mock()
+        s3 = missing_s3()
         upload = data.Upload('ID', 'uploads/ID/upload/file.geojson')
         null_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan-missing-geometries.geojson')
         keys = postread_calculate.put_district_geometries(s3, 'bucket-name', upload, null_plan_path)
@@ -102,72 +123,144 @@ class TestPostreadCalculate (unittest.TestCase):
             'uploads/ID/geometry-bboxes.geojson',
         ])
         
-        self.assertEqual(s3.mock_calls[-1][2]['Key'], 'uploads/ID/districts/partition.csv.gz')
+        self.assertIn('uploads/ID/districts/partition.parquet', put_bodies(s3))
     
     @unittest.mock.patch('sys.stdout')
     def test_put_district_geometries_mixed_geometries(self, stdout):
         '''
         '''
-        s3 = unittest.mock.Mock()
+        s3 = missing_s3()
         upload = data.Upload('ID', 'uploads/ID/upload/file.geojson')
         plan_path = os.path.join(os.path.dirname(__file__), 'data', 'PA-DRA-points-included.geojson')
         keys = postread_calculate.put_district_geometries(s3, 'bucket-name', upload, plan_path)
         self.assertEqual(len(keys), 51)
         
-        self.assertEqual(s3.mock_calls[-1][2]['Key'], 'uploads/ID/districts/partition.csv.gz')
+        self.assertIn('uploads/ID/districts/partition.parquet', put_bodies(s3))
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_put_district_geometries_inspected(self, stdout):
+        ''' Geometries saved by preread_followup are used in place of the upload
+        '''
+        null_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.geojson')
+        ds = ogr.Open(null_plan_path)
+        wkbs = [feature.GetGeometryRef().ExportToWkb() for feature in ds.GetLayer(0)]
+        
+        s3 = unittest.mock.Mock()
+        s3.put_object.return_value = {'ResponseMetadata': {'RetryAttempts': 0}}
+        s3.get_object.return_value = {'Body': io.BytesIO(observe.pack_geometry_bundle(wkbs))}
+        upload = data.Upload('ID', 'uploads/ID/upload/file.geojson')
+        keys = postread_calculate.put_district_geometries(s3, 'bucket-name', upload, 'missing.geojson')
+        self.assertEqual(keys, [
+            'uploads/ID/geometries/0.wkt',
+            'uploads/ID/geometries/1.wkt',
+            'uploads/ID/geometry-bboxes.geojson',
+        ])
+        
+        self.assertIn('uploads/ID/districts/partition.parquet', put_bodies(s3))
+        self.assertNotIn('uploads/ID/geometries.wkb', put_bodies(s3), 'Should not write bundle again')
+    
+    @unittest.mock.patch('osgeo.ogr.CreateGeometryFromWkb')
+    def test_load_inspected_geometries(self, CreateGeometryFromWkb):
+        ''' Geometry bundle is read back, or None returned for a missing or bad one
+        '''
+        s3 = unittest.mock.Mock()
+        s3.get_object.return_value = {'Body': io.BytesIO(observe.pack_geometry_bundle([b'one', b'two']))}
+        upload = data.Upload('ID', 'uploads/ID/upload/file.geojson')
+        
+        geometries = postread_calculate.load_inspected_geometries(s3, 'bucket-name', upload)
+        self.assertEqual(geometries, [CreateGeometryFromWkb.return_value] * 2)
+        self.assertEqual(CreateGeometryFromWkb.mock_calls,
+            [unittest.mock.call(b'one'), unittest.mock.call(b'two')])
+        s3.get_object.assert_called_once_with(Bucket='bucket-name', Key='uploads/ID/geometries.wkb')
+        
+        s3.get_object.return_value = {'Body': io.BytesIO(b'Bad data')}
+        self.assertIsNone(postread_calculate.load_inspected_geometries(s3, 'bucket-name', upload))
+        
+        self.assertIsNone(postread_calculate.load_inspected_geometries(missing_s3(), 'bucket-name', upload))
     
     @unittest.mock.patch('sys.stdout')
     def test_put_district_assignments(self, stdout):
         '''
         '''
         s3 = unittest.mock.Mock()
+        s3.put_object.return_value = {'ResponseMetadata': {'RetryAttempts': 0}}
         upload = data.Upload('ID', 'uploads/ID/upload/file.txt')
         null_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan-blockassignments.txt')
         keys = postread_calculate.put_district_assignments(s3, 'bucket-name', upload, null_plan_path)
         self.assertEqual(keys, ['uploads/ID/assignments/0.txt', 'uploads/ID/assignments/1.txt'])
         
-        self.assertEqual(s3.mock_calls[0][2]['Key'], 'uploads/ID/assignments/0.txt')
-        self.assertEqual(s3.mock_calls[1][2]['Key'], 'uploads/ID/assignments/1.txt')
-        self.assertEqual(s3.mock_calls[0][2]['Body'], '0000000004\n0000000008\n0000000009\n0000000010\n')
-        self.assertEqual(s3.mock_calls[1][2]['Body'], '0000000001\n0000000002\n0000000003\n0000000005\n0000000006\n0000000007\n')
-        self.assertEqual(s3.mock_calls[2][2]['Key'], 'uploads/ID/districts/partition.csv.gz')
-        self.assertEqual(gzip.decompress(s3.mock_calls[2][2]['Body']), b'0,,0000000004\r\n0,,0000000008\r\n0,,0000000009\r\n0,,0000000010\r\n1,,0000000001\r\n1,,0000000002\r\n1,,0000000003\r\n1,,0000000005\r\n1,,0000000006\r\n1,,0000000007\r\n')
+        bodies = put_bodies(s3)
+        self.assertEqual(len(bodies), 3)
+        self.assertEqual(bodies['uploads/ID/assignments/0.txt'], '0000000004\n0000000008\n0000000009\n0000000010\n')
+        self.assertEqual(bodies['uploads/ID/assignments/1.txt'], '0000000001\n0000000002\n0000000003\n0000000005\n0000000006\n0000000007\n')
+        self.assertEqual(partition_rows(bodies['uploads/ID/districts/partition.parquet']), [
+            (0, '0000000004'),
+            (0, '0000000008'),
+            (0, '0000000009'),
+            (0, '0000000010'),
+            (1, '0000000001'),
+            (1, '0000000002'),
+            (1, '0000000003'),
+            (1, '0000000005'),
+            (1, '0000000006'),
+            (1, '0000000007'),
+        ])
     
     @unittest.mock.patch('sys.stdout')
     def test_put_district_assignments_funky_districts(self, stdout):
         '''
         '''
         s3 = unittest.mock.Mock()
+        s3.put_object.return_value = {'ResponseMetadata': {'RetryAttempts': 0}}
         upload = data.Upload('ID', 'uploads/ID/upload/file.txt')
         null_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'ohio-1195_001.csv')
         keys = postread_calculate.put_district_assignments(s3, 'bucket-name', upload, null_plan_path)
         self.assertEqual(keys, ['uploads/ID/assignments/0.txt', 'uploads/ID/assignments/1.txt', 'uploads/ID/assignments/2.txt'])
         
-        self.assertEqual(s3.mock_calls[0][2]['Key'], 'uploads/ID/assignments/0.txt')
-        self.assertEqual(s3.mock_calls[1][2]['Key'], 'uploads/ID/assignments/1.txt')
-        self.assertEqual(s3.mock_calls[2][2]['Key'], 'uploads/ID/assignments/2.txt')
-        self.assertEqual(s3.mock_calls[0][2]['Body'], '390017701001008\n')
-        self.assertEqual(s3.mock_calls[1][2]['Body'], '390017701001004\n390017701001005\n390017701001006\n390017701001007\n')
-        self.assertEqual(s3.mock_calls[2][2]['Body'], '390017701001000\n390017701001001\n390017701001002\n390017701001003\n')
-        self.assertEqual(s3.mock_calls[3][2]['Key'], 'uploads/ID/districts/partition.csv.gz')
-        self.assertEqual(gzip.decompress(s3.mock_calls[3][2]['Body']), b'0,,390017701001008\r\n1,,390017701001004\r\n1,,390017701001005\r\n1,,390017701001006\r\n1,,390017701001007\r\n2,,390017701001000\r\n2,,390017701001001\r\n2,,390017701001002\r\n2,,390017701001003\r\n')
+        bodies = put_bodies(s3)
+        self.assertEqual(len(bodies), 4)
+        self.assertEqual(bodies['uploads/ID/assignments/0.txt'], '390017701001008\n')
+        self.assertEqual(bodies['uploads/ID/assignments/1.txt'], '390017701001004\n390017701001005\n390017701001006\n390017701001007\n')
+        self.assertEqual(bodies['uploads/ID/assignments/2.txt'], '390017701001000\n390017701001001\n390017701001002\n390017701001003\n')
+        self.assertEqual(partition_rows(bodies['uploads/ID/districts/partition.parquet']), [
+            (0, '390017701001008'),
+            (1, '390017701001004'),
+            (1, '390017701001005'),
+            (1, '390017701001006'),
+            (1, '390017701001007'),
+            (2, '390017701001000'),
+            (2, '390017701001001'),
+            (2, '390017701001002'),
+            (2, '390017701001003'),
+        ])
     
     @unittest.mock.patch('sys.stdout')
     def test_put_district_assignments_zipped(self, stdout):
         '''
         '''
         s3 = unittest.mock.Mock()
+        s3.put_object.return_value = {'ResponseMetadata': {'RetryAttempts': 0}}
         upload = data.Upload('ID', 'uploads/ID/upload/file.txt')
         null_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan-blockassignments.txt.zip')
         keys = postread_calculate.put_district_assignments(s3, 'bucket-name', upload, null_plan_path)
         self.assertEqual(keys, ['uploads/ID/assignments/0.txt', 'uploads/ID/assignments/1.txt'])
         
-        self.assertEqual(s3.mock_calls[0][2]['Key'], 'uploads/ID/assignments/0.txt')
-        self.assertEqual(s3.mock_calls[1][2]['Key'], 'uploads/ID/assignments/1.txt')
-        self.assertEqual(s3.mock_calls[0][2]['Body'], '0000000004\n0000000008\n0000000009\n0000000010\n')
-        self.assertEqual(s3.mock_calls[1][2]['Body'], '0000000001\n0000000002\n0000000003\n0000000005\n0000000006\n0000000007\n')
-        self.assertEqual(s3.mock_calls[2][2]['Key'], 'uploads/ID/districts/partition.csv.gz')
-        self.assertEqual(gzip.decompress(s3.mock_calls[2][2]['Body']), b'0,,0000000004\r\n0,,0000000008\r\n0,,0000000009\r\n0,,0000000010\r\n1,,0000000001\r\n1,,0000000002\r\n1,,0000000003\r\n1,,0000000005\r\n1,,0000000006\r\n1,,0000000007\r\n')
+        bodies = put_bodies(s3)
+        self.assertEqual(len(bodies), 3)
+        self.assertEqual(bodies['uploads/ID/assignments/0.txt'], '0000000004\n0000000008\n0000000009\n0000000010\n')
+        self.assertEqual(bodies['uploads/ID/assignments/1.txt'], '0000000001\n0000000002\n0000000003\n0000000005\n0000000006\n0000000007\n')
+        self.assertEqual(partition_rows(bodies['uploads/ID/districts/partition.parquet']), [
+            (0, '0000000004'),
+            (0, '0000000008'),
+            (0, '0000000009'),
+            (0, '0000000010'),
+            (1, '0000000001'),
+            (1, '0000000002'),
+            (1, '0000000003'),
+            (1, '0000000005'),
+            (1, '0000000006'),
+            (1, '0000000007'),
+        ])
     
     @unittest.mock.patch('planscore.util.temporary_buffer_file')
     @unittest.mock.patch('planscore.postread_calculate.commence_geometry_upload_scoring')
@@ -195,6 +288,13 @@ class TestPostreadCalculate (unittest.TestCase):
         self.assertIs(commence_geometry_upload_scoring.mock_calls[0][1][2], bucket)
         self.assertEqual(commence_geometry_upload_scoring.mock_calls[0][1][3].id, upload.id)
         self.assertEqual(commence_geometry_upload_scoring.mock_calls[0][1][4], nullplan_path)
+        
+        timer = commence_geometry_upload_scoring.mock_calls[0][1][5]
+        self.assertEqual([stage.stage for stage in timer.stages], ['download', 'guess type'])
+        
+        timing_call = s3.put_object.mock_calls[-1]
+        self.assertTrue(timing_call[2]['Key'].startswith('logs/timing/ds='))
+        self.assertTrue(timing_call[2]['Body'].startswith('ID\tdownload\t'))
     
     @unittest.mock.patch('planscore.util.temporary_buffer_file')
     @unittest.mock.patch('planscore.postread_calculate.commence_blockassign_upload_scoring')
@@ -292,6 +392,25 @@ class TestPostreadCalculate (unittest.TestCase):
 
         self.assertEqual(str(error.exception), 'Could not open file to fan out district invocations')
     
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('planscore.observe.put_stage_timings')
+    @unittest.mock.patch('planscore.util.guess_upload_type')
+    @unittest.mock.patch('planscore.util.temporary_buffer_file')
+    def test_commence_upload_scoring_timings_failure(self, temporary_buffer_file, guess_upload_type, put_stage_timings, stdout):
+        ''' A failure to write stage timings does not replace a scoring error
+        '''
+        (context, s3, athena), bucket = [unittest.mock.Mock() for i in 'iii'], 'fake-bucket-name'
+        s3.get_object.return_value = {'Body': io.BytesIO(b'Bad data')}
+        guess_upload_type.side_effect = RuntimeError('Bad upload')
+        put_stage_timings.side_effect = botocore.exceptions.ClientError({'Error': {'Code': 'AccessDenied'}}, 'PutObject')
+
+        with self.assertRaises(RuntimeError) as error:
+            postread_calculate.commence_upload_scoring(context, s3, athena, bucket,
+                data.Upload('id', 'uploads/id/null-plan.geojson', model=data.MODELS[0]))
+
+        self.assertEqual(str(error.exception), 'Bad upload')
+        self.assertEqual(len(put_stage_timings.mock_calls), 1)
+    
 
     @unittest.mock.patch('planscore.score.calculate_everything')
     @unittest.mock.patch('planscore.observe.populate_compactness')
@@ -384,17 +503,18 @@ class TestPostreadCalculate (unittest.TestCase):
         geom5 = unittest.mock.Mock()
         geom5.WkbSize.return_value = 0x4001
         geom5.IsValid.return_value = True
-        geom5.GetEnvelope.return_value = (0, 1, 0, 1)
-        geom5.Intersection.return_value.WkbSize.return_value = 0x2000
-        geom5.Intersection.return_value.IsValid.return_value = True
-        geom6, geom7 = postread_calculate.partition_large_geometries(geom5)
-        self.assertIs(geom6, geom5.Intersection.return_value, 'Should see first intersected geometry')
-        self.assertIs(geom7, geom5.Intersection.return_value, 'Should see second intersected geometry')
-        self.assertEqual(
-            geom5.Intersection.mock_calls[0][1][0].GetEnvelope(),
-            (-1, 2, -1, .5),
-            'Should see top half passed to first intersection call',
-        )
+        geom5.ExportToWkb.return_value = shapely.geometry.box(0, 0, 1, 1).wkb
+        
+        with unittest.mock.patch('planscore.partition.partition_shape') as partition_shape, \
+             unittest.mock.patch('osgeo.ogr.CreateGeometryFromWkb') as CreateGeometryFromWkb:
+            pieces = [shapely.geometry.box(0, 0, .5, 1), shapely.geometry.box(.5, 0, 1, 1)]
+            partition_shape.return_value = pieces
+            geom6, geom7 = postread_calculate.partition_large_geometries(geom5, cell_size=.5)
+        
+        self.assertEqual(partition_shape.mock_calls[0][1][0], shapely.geometry.box(0, 0, 1, 1))
+        self.assertEqual(partition_shape.mock_calls[0][1][1:], (0x4000, .5))
+        self.assertEqual(CreateGeometryFromWkb.mock_calls,
+            [unittest.mock.call(pieces[0].wkb), unittest.mock.call(pieces[1].wkb)])
     
     @unittest.mock.patch('planscore.util.iter_athena_exec')
     def test_accumulate_district_totals(self, iter_athena_exec):
@@ -408,6 +528,9 @@ class TestPostreadCalculate (unittest.TestCase):
         response1 = next(postread_calculate.accumulate_district_totals(athena, upload, True))
         query1 = iter_athena_exec.mock_calls[-1][1][1]
         self.assertIn('ST_Within(', query1)
+        self.assertIn('BETWEEN d.xmin AND d.xmax', query1)
+        self.assertIn('BETWEEN d.ymin AND d.ymax', query1)
+        self.assertNotIn('b.lon BETWEEN', query1, 'Should not guess a plan envelope without storage')
         self.assertIn(f"b.prefix = '{upload.model.key_prefix}'", query1)
         self.assertIn(f"d.upload = '{upload.id}'", query1)
         self.assertEqual(response1, iter_athena_exec.return_value[0])
@@ -419,6 +542,58 @@ class TestPostreadCalculate (unittest.TestCase):
         self.assertIn(f"d.upload = '{upload.id}'", query2)
         self.assertEqual(response2, iter_athena_exec.return_value[0])
     
+    @unittest.mock.patch('planscore.util.iter_athena_exec')
+    def test_accumulate_district_totals_envelope(self, iter_athena_exec):
+        '''
+        '''
+        athena, upload = unittest.mock.Mock(), unittest.mock.Mock()
+        upload.id, upload.model.key_prefix = 'ID', 'data/XX'
+        iter_athena_exec.return_value = [(True, {})]
+        
+        with unittest.mock.patch('planscore.postread_calculate.load_plan_envelope') as load_plan_envelope:
+            load_plan_envelope.return_value = (-1., -2.5, 3., 4.)
+            next(postread_calculate.accumulate_district_totals(athena, upload, True, 'storage'))
+        
+        query = iter_athena_exec.mock_calls[-1][1][1]
+        load_plan_envelope.assert_called_once_with('storage', upload)
+        self.assertIn('(b.lon IS NULL OR b.lon BETWEEN -1.0 AND 3.0)', query)
+        self.assertIn('(b.lat IS NULL OR b.lat BETWEEN -2.5 AND 4.0)', query)
+    
+    def test_load_plan_envelope(self):
+        '''
+        '''
+        upload = data.Upload('ID', 'uploads/ID/upload/file.geojson')
+        bboxes = {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {}, 'geometry': {'type': 'Polygon',
+                'coordinates': [[[x1, y1], [x1, y2], [x2, y2], [x2, y1], [x1, y1]]]}}
+            for (x1, y1, x2, y2) in [(0, 0, 1, 1), (-2, .5, .5, 3)]
+        ]}
+        
+        s3 = unittest.mock.Mock()
+        s3.get_object.return_value = {'Body': io.BytesIO(json.dumps(bboxes).encode('utf8'))}
+        envelope = postread_calculate.load_plan_envelope(data.Storage(s3, 'bucket-name', None), upload)
+        
+        self.assertEqual(envelope, (-2, 0, 1, 3))
+        s3.get_object.assert_called_once_with(Bucket='bucket-name', Key='uploads/ID/geometry-bboxes.geojson')
+        
+        self.assertIsNone(postread_calculate.load_plan_envelope(data.Storage(missing_s3(), 'bucket-name', None), upload))
+        self.assertIsNone(postread_calculate.load_plan_envelope(None, upload))
+    
+    @unittest.mock.patch('planscore.aggregate.accumulate_district_totals')
+    @unittest.mock.patch('planscore.util.iter_athena_exec')
+    def test_accumulate_district_totals_locally(self, iter_athena_exec, aggregate_accumulate_district_totals):
+        '''
+        '''
+        athena, upload, storage = unittest.mock.Mock(), unittest.mock.Mock(), unittest.mock.Mock()
+        aggregate_accumulate_district_totals.return_value = [('SUCCEEDED', [])]
+        
+        with unittest.mock.patch('planscore.constants.AGGREGATION_ENGINE', 'local'):
+            responses = list(postread_calculate.accumulate_district_totals(athena, upload, True, storage))
+        
+        self.assertEqual(responses, [('SUCCEEDED', [])])
+        aggregate_accumulate_district_totals.assert_called_once_with(storage, upload, True)
+        self.assertEqual(len(iter_athena_exec.mock_calls), 0, 'Should not query Athena')
+    
     def test_resultset_to_district_totals(self):
         result = { "UpdateCount": 0, "ResultSet": { "Rows": [ { "Data": [ { "VarCharValue": "district_number" }, { "VarCharValue": "US President 2020 - DEM" }, { "VarCharValue": "US President 2020 - REP" }, { "VarCharValue": "US President 3000 - Other" }, ] }, { "Data": [ { "VarCharValue": "0" }, { "VarCharValue": "100" }, { "VarCharValue": "200.2" }, { }, ] }, { "Data": [ { "VarCharValue": "0" }, { "VarCharValue": "200" }, { "VarCharValue": "100.1" }, { }, ] } ], "ResultSetMetadata": { "ColumnInfo": [ { "CatalogName": "hive", "SchemaName": "", "TableName": "", "Name": "district_number", "Label": "district_number", "Type": "integer", "Precision": 10, "Scale": 0, "Nullable": "UNKNOWN", "CaseSensitive": False }, { "CatalogName": "hive", "SchemaName": "", "TableName": "", "Name": "US President 2020 - DEM", "Label": "US President 2020 - DEM", "Type": "bigint", "Precision": 17, "Scale": 0, "Nullable": "UNKNOWN", "CaseSensitive": False }, { "CatalogName": "hive", "SchemaName": "", "TableName": "", "Name": "US President 2020 - REP", "Label": "US President 2020 - REP", "Type": "double", "Precision": 17, "Scale": 0, "Nullable": "UNKNOWN", "CaseSensitive": False }, { "CatalogName": "hive", "SchemaName": "", "TableName": "", "Name": "US President 3000 - Other", "Label": "US President 3000 - Other", "Type": "double", "Precision": 17, "Scale": 0, "Nullable": "UNKNOWN", "CaseSensitive": False }, ] } }, }
         totals = postread_calculate.resultset_to_district_totals(result)
@@ -1,5 +1,5 @@
 import unittest, unittest.mock, io, os, contextlib, json
-from .. import preread_followup, data, constants
+from .. import preread_followup, data, constants, observe, stateindex
 from osgeo import ogr
 
 class TestPrereadFollowup (unittest.TestCase):
@@ -119,55 +119,114 @@ class TestPrereadFollowup (unittest.TestCase):
 
         self.assertEqual(str(ni_error.exception), 'PlanScore only works for U.S. states')
     
+    @unittest.mock.patch('planscore.preread_followup.guess_state')
     @unittest.mock.patch('planscore.util.is_polygonal_feature')
     @unittest.mock.patch('osgeo.ogr')
-    def test_guess_geometry_model_imagined(self, osgeo_ogr, is_polygonal_feature):
+    def test_guess_geometry_model_imagined(self, osgeo_ogr, is_polygonal_feature, guess_state):
         ''' Test that guess_geometry_model() guesses the correct U.S. state and house.
         '''
         is_polygonal_feature.return_value = True
         
         # Mock OGR boilerplate
         ogr_feature = unittest.mock.Mock()
-        ogr_geometry = ogr_feature.GetGeometryRef.return_value
-        ogr_geometry.Area.return_value = 0
-        ogr_geometry.Intersection.return_value.Area.return_value = 1
-        ogr_geometry.GetEnvelope.return_value = (0, 1, 0, 1)
-        ogr_geometry.Union.return_value = ogr_geometry
-        ogr_geometry.SimplifyPreserveTopology.return_value.Union.return_value = ogr_geometry
+        ogr_geometry = ogr_feature.GetGeometryRef.return_value.Clone.return_value
+        ogr_geometry.Area.return_value = 1
         feature_iter = osgeo_ogr.Open.return_value.GetLayer.return_value.__iter__
-        state_field = ogr_feature.GetField
+        nc_state = stateindex.StateShape('NC', 'North Carolina', '37', 0, None, None)
 
         # Real tests
-        feature_iter.return_value, state_field.return_value = [ogr_feature] * 2, 'XX'
+        feature_iter.return_value, guess_state.return_value = [ogr_feature] * 2, None
         self.assertEqual(preread_followup.guess_geometry_model('districts.shp').key_prefix[:8], 'data/XX/')
 
-        feature_iter.return_value, state_field.return_value = [ogr_feature] * 11, 'NC'
+        feature_iter.return_value, guess_state.return_value = [ogr_feature] * 11, nc_state
         self.assertEqual(preread_followup.guess_geometry_model('districts.shp').house, data.House.ushouse)
         self.assertEqual(preread_followup.guess_geometry_model('districts.shp').key_prefix[:8], 'data/NC/')
 
-        feature_iter.return_value, state_field.return_value = [ogr_feature] * 13, 'NC'
+        feature_iter.return_value = [ogr_feature] * 13
         self.assertEqual(preread_followup.guess_geometry_model('districts.shp').house, data.House.ushouse)
 
-        feature_iter.return_value, state_field.return_value = [ogr_feature] * 15, 'NC'
+        feature_iter.return_value = [ogr_feature] * 15
         self.assertEqual(preread_followup.guess_geometry_model('districts.shp').house, data.House.ushouse)
 
-        feature_iter.return_value, state_field.return_value = [ogr_feature] * 40, 'NC'
+        feature_iter.return_value = [ogr_feature] * 40
         self.assertEqual(preread_followup.guess_geometry_model('districts.shp').house, data.House.statesenate)
 
-        feature_iter.return_value, state_field.return_value = [ogr_feature] * 50, 'NC'
+        feature_iter.return_value = [ogr_feature] * 50
         self.assertEqual(preread_followup.guess_geometry_model('districts.shp').house, data.House.statesenate)
 
-        feature_iter.return_value, state_field.return_value = [ogr_feature] * 60, 'NC'
+        feature_iter.return_value = [ogr_feature] * 60
         self.assertEqual(preread_followup.guess_geometry_model('districts.shp').house, data.House.statesenate)
 
-        feature_iter.return_value, state_field.return_value = [ogr_feature] * 110, 'NC'
+        feature_iter.return_value = [ogr_feature] * 110
         self.assertEqual(preread_followup.guess_geometry_model('districts.shp').house, data.House.statehouse)
 
-        feature_iter.return_value, state_field.return_value = [ogr_feature] * 120, 'NC'
+        feature_iter.return_value = [ogr_feature] * 120
         self.assertEqual(preread_followup.guess_geometry_model('districts.shp').house, data.House.statehouse)
 
-        feature_iter.return_value, state_field.return_value = [ogr_feature] * 130, 'NC'
+        feature_iter.return_value = [ogr_feature] * 130
         self.assertEqual(preread_followup.guess_geometry_model('file.gpkg').house, data.House.statehouse)
+        
+        # Small footprint compared to the state
+        feature_iter.return_value = [ogr_feature] * 11
+        guess_state.return_value = nc_state._replace(area=100)
+        self.assertEqual(preread_followup.guess_geometry_model('districts.shp').house, data.House.localplan)
+    
+    @unittest.mock.patch('planscore.stateindex.load_state_index')
+    def test_guess_state(self, load_state_index):
+        ''' Sampled points decide the state unless they are split between states
+        '''
+        index = load_state_index.return_value
+        geometries = [unittest.mock.Mock() for i in range(3)]
+        for geometry in geometries:
+            geometry.PointOnSurface.return_value.GetPoint_2D.return_value = (-79, 35)
+            geometry.Area.return_value = 1
+        
+        index.point_shares.return_value = {'NC': 1.}
+        self.assertIs(preread_followup.guess_state(geometries), index.find_abbr.return_value)
+        index.find_abbr.assert_called_once_with('NC')
+        self.assertEqual(index.point_shares.mock_calls[0][1], ([(-79, 35)] * 3, [1] * 3))
+        self.assertEqual(len(index.overlap_areas.mock_calls), 0)
+    
+    def test_guess_geometries_model_state_border(self):
+        ''' Districts split between states fall back to overlaps with a footprint
+        '''
+        # Halves of a box straddling the North Carolina and Virginia border
+        geometries = [
+            ogr.CreateGeometryFromWkt('POLYGON ((-79.1 36.55, -79 36.55, -79 36.7, -79.1 36.7, -79.1 36.55))'),
+            ogr.CreateGeometryFromWkt('POLYGON ((-79.1 36.4, -79 36.4, -79 36.55, -79.1 36.55, -79.1 36.4))'),
+        ]
+        
+        overlap_areas = stateindex.StateIndex.overlap_areas
+        
+        with unittest.mock.patch.object(stateindex.StateIndex, 'overlap_areas',
+            autospec=True, side_effect=overlap_areas) as mock_overlap_areas:
+            model = preread_followup.guess_geometries_model(geometries, len(geometries))
+        
+        self.assertEqual(len(mock_overlap_areas.mock_calls), 1, 'Should look for overlaps')
+        self.assertEqual(model.key_prefix[:8], 'data/VA/', 'Should pick state with most overlap')
+        self.assertEqual(model.house, data.House.localplan)
+    
+    def test_guess_geometries_model_outside_states(self):
+        ''' Districts outside U.S. states are Null Island or an error
+        '''
+        null_island = [
+            ogr.CreateGeometryFromWkt('POLYGON ((-.1 -.1, 0 -.1, 0 .1, -.1 .1, -.1 -.1))'),
+            ogr.CreateGeometryFromWkt('POLYGON ((0 -.1, .1 -.1, .1 .1, 0 .1, 0 -.1))'),
+        ]
+        
+        model = preread_followup.guess_geometries_model(null_island, len(null_island))
+        self.assertEqual(model.key_prefix[:8], 'data/XX/')
+        
+        # Near Frankfurt, Germany
+        germany = [
+            ogr.CreateGeometryFromWkt('POLYGON ((8.5 50, 8.6 50, 8.6 50.1, 8.5 50.1, 8.5 50))'),
+            ogr.CreateGeometryFromWkt('POLYGON ((8.6 50, 8.7 50, 8.7 50.1, 8.6 50.1, 8.6 50))'),
+        ]
+        
+        with self.assertRaises(RuntimeError) as error:
+            preread_followup.guess_geometries_model(germany, len(germany))
+        
+        self.assertEqual(str(error.exception), 'PlanScore only works for U.S. states')
     
     def test_guess_geometry_model_missing_geometries(self):
         ''' Test that guess_geometry_model() guesses the correct U.S. state and house.
@@ -224,6 +283,18 @@ class TestPrereadFollowup (unittest.TestCase):
         null_plan3_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan-blockassignments.csv')
         self.assertEqual(len(preread_followup.get_block_assignments(null_plan3_path)), 10)
     
+    def test_summarize_block_assignments(self):
+        ''' Test that summarize_block_assignments() counts states and districts
+        '''
+        null_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan-blockassignments.zip')
+        summary1 = preread_followup.summarize_block_assignments(null_plan_path)
+        self.assertEqual(summary1.state_counts, {'00': 10})
+        self.assertEqual(sorted(summary1.district_ids), ['01', '02'])
+
+        md_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'maryland-blocks2010.csv')
+        summary2 = preread_followup.summarize_block_assignments(md_plan_path)
+        self.assertEqual(summary2.state_counts, {'24': 9})
+    
     @unittest.mock.patch('sys.stdout')
     def test_count_district_geometries(self, stdout):
         '''
@@ -363,24 +434,28 @@ class TestPrereadFollowup (unittest.TestCase):
         self.assertEqual(str(error.exception), 'Could not open file to guess U.S. state')
     
     @unittest.mock.patch('planscore.observe.put_upload_index')
-    @unittest.mock.patch('planscore.preread_followup.count_district_geometries')
-    @unittest.mock.patch('planscore.preread_followup.guess_geometry_model')
-    def test_commence_geometry_upload_parsing_good_ogr_file(self, guess_geometry_model, count_district_geometries, put_upload_index):
+    @unittest.mock.patch('planscore.preread_followup.put_upload_geometries')
+    @unittest.mock.patch('planscore.preread_followup.put_geojson_geometries')
+    @unittest.mock.patch('planscore.preread_followup.guess_geometries_model')
+    @unittest.mock.patch('planscore.preread_followup.inspect_geometry_upload')
+    def test_commence_geometry_upload_parsing_good_ogr_file(self, inspect_geometry_upload, guess_geometries_model, put_geojson_geometries, put_upload_geometries, put_upload_index):
         ''' A valid district plan file is scored and the results posted to S3
         '''
         id = 'ID'
         nullplan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.geojson')
         upload_key = data.UPLOAD_PREFIX.format(id=id) + 'null-plan.geojson'
-        guess_geometry_model.return_value = data.Model(data.State.XX, None, 2, True, ['2020'], 'data/XX/006-tilesdir')
+        guess_geometries_model.return_value = data.Model(data.State.XX, None, 2, True, ['2020'], 'data/XX/006-tilesdir')
         
-        count_district_geometries.return_value = 2
+        geometries = [unittest.mock.Mock(), unittest.mock.Mock()]
+        inspect_geometry_upload.return_value = preread_followup.UploadInspection(geometries, 2)
 
         s3, lam, bucket = unittest.mock.Mock(), unittest.mock.Mock(), 'fake-bucket-name'
         s3.get_object.return_value = {'Body': None}
 
         upload = data.Upload(id, upload_key)
         info = preread_followup.commence_geometry_upload_parsing(s3, bucket, upload, nullplan_path)
-        guess_geometry_model.assert_called_once_with(nullplan_path)
+        inspect_geometry_upload.assert_called_once_with(nullplan_path)
+        guess_geometries_model.assert_called_once_with(geometries, 2)
 
         self.assertEqual(info.id, upload.id)
     
@@ -390,21 +465,25 @@ class TestPrereadFollowup (unittest.TestCase):
         self.assertEqual(put_upload_index.mock_calls[0][1][1].message,
             'Found 2 districts in the "data/XX/006-tilesdir" None plan with 2 seats.')
         
-        count_district_geometries.assert_called_once_with(nullplan_path)
+        self.assertIs(put_geojson_geometries.mock_calls[0][1][3], geometries)
+        self.assertIs(put_upload_geometries.mock_calls[0][1][3], geometries)
+        self.assertEqual(put_upload_geometries.mock_calls[0][1][2].id, upload.id)
     
     @unittest.mock.patch('planscore.observe.put_upload_index')
-    @unittest.mock.patch('planscore.preread_followup.put_geojson_file')
-    @unittest.mock.patch('planscore.preread_followup.count_district_geometries')
-    @unittest.mock.patch('planscore.preread_followup.guess_geometry_model')
-    def test_commence_geometry_upload_parsing_zipped_ogr_file(self, guess_geometry_model, count_district_geometries, put_geojson_file, put_upload_index):
+    @unittest.mock.patch('planscore.preread_followup.put_upload_geometries')
+    @unittest.mock.patch('planscore.preread_followup.put_geojson_geometries')
+    @unittest.mock.patch('planscore.preread_followup.guess_geometries_model')
+    @unittest.mock.patch('planscore.preread_followup.inspect_geometry_upload')
+    def test_commence_geometry_upload_parsing_zipped_ogr_file(self, inspect_geometry_upload, guess_geometries_model, put_geojson_geometries, put_upload_geometries, put_upload_index):
         ''' A valid district plan zipfile is scored and the results posted to S3
         '''
         id = 'ID'
         nullplan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.shp.zip')
         upload_key = data.UPLOAD_PREFIX.format(id=id) + 'null-plan.shp.zip'
-        guess_geometry_model.return_value = data.Model(data.State.XX, None, 2, True, ['2020'], 'data/XX/006-tilesdir')
+        guess_geometries_model.return_value = data.Model(data.State.XX, None, 2, True, ['2020'], 'data/XX/006-tilesdir')
         
-        count_district_geometries.return_value = 2
+        geometries = [unittest.mock.Mock(), unittest.mock.Mock()]
+        inspect_geometry_upload.return_value = preread_followup.UploadInspection(geometries, 2)
 
         s3, lam, bucket = unittest.mock.Mock(), unittest.mock.Mock(), 'fake-bucket-name'
         s3.get_object.return_value = {'Body': None}
@@ -412,21 +491,49 @@ class TestPrereadFollowup (unittest.TestCase):
         upload = data.Upload(id, upload_key)
         nullplan_datasource = '/vsizip/{}/null-plan.shp'.format(os.path.abspath(nullplan_path))
         info = preread_followup.commence_geometry_upload_parsing(s3, bucket, upload, nullplan_datasource)
-        guess_geometry_model.assert_called_once_with(nullplan_datasource)
+        inspect_geometry_upload.assert_called_once_with(nullplan_datasource)
 
         self.assertEqual(info.id, upload.id)
     
-        self.assertEqual(put_geojson_file.mock_calls[0][1][:2], (s3, bucket))
-        self.assertEqual(put_geojson_file.mock_calls[0][1][2].id, upload.id)
-        self.assertIs(put_geojson_file.mock_calls[0][1][3], nullplan_datasource)
+        self.assertEqual(put_geojson_geometries.mock_calls[0][1][:2], (s3, bucket))
+        self.assertEqual(put_geojson_geometries.mock_calls[0][1][2].id, upload.id)
+        self.assertIs(put_geojson_geometries.mock_calls[0][1][3], geometries)
 
         self.assertEqual(len(put_upload_index.mock_calls), 1)
         self.assertEqual(put_upload_index.mock_calls[0][1][1].id, upload.id)
         self.assertEqual(len(put_upload_index.mock_calls[0][1][1].districts), 2)
         self.assertEqual(put_upload_index.mock_calls[0][1][1].message,
             'Found 2 districts in the "data/XX/006-tilesdir" None plan with 2 seats.')
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_inspect_geometry_upload(self, stdout):
+        ''' Upload is opened once for ordered geometries and feature count
+        '''
+        null_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.gpkg')
+        inspection = preread_followup.inspect_geometry_upload(null_plan_path)
+        self.assertEqual(len(inspection.geometries), 2)
+        self.assertEqual(inspection.feature_count, 2)
+        
+        model = preread_followup.guess_geometries_model(inspection.geometries, inspection.feature_count)
+        self.assertEqual(model.key_prefix[:8], 'data/XX/')
+
+        mixed_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'PA-DRA-points-included.geojson')
+        inspection = preread_followup.inspect_geometry_upload(mixed_plan_path)
+        self.assertEqual(len(inspection.geometries), 50)
+    
+    def test_put_upload_geometries(self):
+        ''' Ordered geometries are saved in one bundle for postread_calculate
+        '''
+        geometries = [unittest.mock.Mock(), unittest.mock.Mock()]
+        geometries[0].ExportToWkb.return_value = b'one'
+        geometries[1].ExportToWkb.return_value = b'two'
+        
+        s3, upload = unittest.mock.Mock(), data.Upload('ID', 'uploads/ID/upload/file.geojson')
+        preread_followup.put_upload_geometries(s3, 'bucket-name', upload, geometries)
         
-        count_district_geometries.assert_called_once_with(nullplan_datasource)
+        s3.put_object.assert_called_once_with(Bucket='bucket-name',
+            Key='uploads/ID/geometries.wkb', Body=observe.pack_geometry_bundle([b'one', b'two']),
+            ACL='bucket-owner-full-control', ContentType='application/octet-stream')
     
     @unittest.mock.patch('planscore.observe.put_upload_index')
     @unittest.mock.patch('planscore.preread_followup.put_geojson_file')
@@ -1,5 +1,5 @@
 import unittest, unittest.mock, io, os, contextlib, json, gzip, itertools, statistics, random
-from .. import score, data
+from .. import score, data, timing
 import botocore.exceptions
 from osgeo import ogr, gdal
 import numpy
@@ -155,6 +155,32 @@ class TestScore (unittest.TestCase):
         self.assertAlmostEqual(score.percentrank_rel(score.COLUMN_EG, data.House.ushouse, .01), 0.4892857)
         self.assertAlmostEqual(score.percentrank_rel(score.COLUMN_EG, data.House.ushouse, -.01), 0.6357143)
         
+    def test_load_bias_distributions(self):
+        ''' Historical bias values are loaded once and sorted by chamber
+        '''
+        distributions1 = score.load_bias_distributions(data.House.ushouse)
+        distributions2 = score.load_bias_distributions(data.House.ushouse)
+        self.assertIs(distributions1, distributions2)
+        
+        for column in (score.COLUMN_EG, score.COLUMN_D2, score.COLUMN_PB, score.COLUMN_MMD):
+            values, abs_values = distributions1[column]
+            self.assertEqual(len(values), len(abs_values))
+            self.assertTrue((values[:-1] <= values[1:]).all())
+            self.assertTrue((abs_values[:-1] <= abs_values[1:]).all())
+            self.assertTrue((abs_values >= 0).all())
+
+    def test_percentrank_all(self):
+        ''' Absolute and relative percent ranks are calculated together
+        '''
+        ranks1 = score.percentrank_all(data.House.ushouse, {score.COLUMN_EG: .19, score.COLUMN_MMD: -.12})
+        self.assertAlmostEqual(ranks1[score.COLUMN_EG][0], 0.9875)
+        self.assertEqual(ranks1[score.COLUMN_EG][1], score.percentrank_rel(score.COLUMN_EG, data.House.ushouse, .19))
+        self.assertAlmostEqual(ranks1[score.COLUMN_MMD][0], 1.)
+        self.assertEqual(ranks1[score.COLUMN_MMD][1], score.percentrank_rel(score.COLUMN_MMD, data.House.ushouse, -.12))
+        
+        ranks2 = score.percentrank_all(data.House.localplan, {score.COLUMN_EG: .19})
+        self.assertEqual(ranks2, {score.COLUMN_EG: (None, None)})
+
     def test_calculate_EG_fair(self):
         ''' Efficiency gap can be correctly calculated for a fair election
         '''
@@ -432,14 +458,49 @@ class TestScore (unittest.TestCase):
         self.assertEqual(output.summary['SLDL Efficiency Gap +1 Rep'], calculate_EG.return_value.__round__.return_value)
         self.assertEqual(calculate_EG.mock_calls[2][1], ([2, 3, 5, 6], [6, 5, 3, 2], -.01))
 
+    def test_load_simulations(self):
+        ''' Simulated vote totals are read into a single array
+        '''
+        districts = [
+            dict(totals={'DEM000': 6, 'REP000': 2, 'O:DEM001': 5, 'D:REP001': 4, 'Other': 1}),
+            dict(totals={'DEM000': 3, 'R:DEM002': 1}),
+            dict(totals={}),
+            ]
+        
+        simulations = score.load_simulations(districts)
+        self.assertEqual(simulations.votes.shape, (3, 3, 2, 4))
+        self.assertEqual(numpy.count_nonzero(~numpy.isnan(simulations.votes)), 6)
+
+        DEM, REP = score.SIM_PARTIES.index('DEM'), score.SIM_PARTIES.index('REP')
+        N, O, D, R = [score.SIM_CONDITIONS.index(c) for c in ('', 'O', 'D', 'R')]
+        
+        self.assertEqual(simulations.votes[0,0,DEM,N], 6)
+        self.assertEqual(simulations.votes[0,0,REP,N], 2)
+        self.assertEqual(simulations.votes[0,1,DEM,O], 5)
+        self.assertEqual(simulations.votes[0,1,REP,D], 4)
+        self.assertEqual(simulations.votes[1,0,DEM,N], 3)
+        self.assertEqual(simulations.votes[1,2,DEM,R], 1)
+        self.assertTrue(numpy.isnan(simulations.votes[1,0,REP,N]))
+        self.assertTrue(numpy.isnan(simulations.votes[2]).all())
+
+        self.assertEqual(simulations.fields[''], {'DEM000', 'REP000'})
+        self.assertEqual(simulations.fields['O'], {'O:DEM001'})
+        self.assertEqual(simulations.fields['D'], {'D:REP001'})
+        self.assertEqual(simulations.fields['R'], {'R:DEM002'})
+
+        stripped = score.strip_simulations(districts, simulations.fields[''])
+        self.assertEqual(stripped[0]['totals'], {'O:DEM001': 5, 'D:REP001': 4, 'Other': 1})
+        self.assertEqual(stripped[1]['totals'], {'R:DEM002': 1})
+        self.assertIn('DEM000', districts[0]['totals'], 'Should leave input districts alone')
+
     @unittest.mock.patch('planscore.score.percentrank_rel')
     @unittest.mock.patch('planscore.score.percentrank_abs')
-    @unittest.mock.patch('planscore.score.calculate_D2_diff')
-    @unittest.mock.patch('planscore.score.calculate_D2')
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
-    def test_calculate_gap_fewsims(self, calculate_EG, calculate_PB, calculate_MMD, calculate_D2, calculate_D2_diff, percentrank_abs, percentrank_rel):
+    @unittest.mock.patch('planscore.metrics.calculate_D2_diffs')
+    @unittest.mock.patch('planscore.metrics.calculate_D2s')
+    @unittest.mock.patch('planscore.metrics.calculate_MMDs')
+    @unittest.mock.patch('planscore.metrics.calculate_PBs')
+    @unittest.mock.patch('planscore.metrics.calculate_EGs')
+    def test_calculate_gap_fewsims(self, calculate_EGs, calculate_PBs, calculate_MMDs, calculate_D2s, calculate_D2_diffs, percentrank_abs, percentrank_rel):
         ''' Efficiency gap can be correctly calculated using a few input sims.
         
             Use "DEM000"-style vote properties from 2018 and 2019 PlanScore models.
@@ -454,30 +515,33 @@ class TestScore (unittest.TestCase):
         
         percentrank_rel.return_value = 0
         percentrank_abs.return_value = 0
-        calculate_D2.return_value = 0
-        calculate_D2_diff.return_value = 0
-        calculate_MMD.return_value = 0
-        calculate_PB.return_value = 0
-        calculate_EG.return_value = 0
+        calculate_D2s.return_value = numpy.zeros(2)
+        calculate_D2_diffs.return_value = numpy.zeros(2)
+        calculate_MMDs.return_value = numpy.zeros(2)
+        calculate_PBs.return_value = numpy.zeros(2)
+        calculate_EGs.return_value = numpy.zeros(2)
         output = score.calculate_everything(input)
-        self.assertEqual(output.summary['Mean-Median'], calculate_MMD.return_value)
+        self.assertEqual(output.summary['Mean-Median'], 0)
         self.assertEqual(output.summary['Mean-Median SD'], 0)
-        self.assertEqual(output.summary['Partisan Bias'], calculate_PB.return_value)
+        self.assertEqual(output.summary['Partisan Bias'], 0)
         self.assertEqual(output.summary['Partisan Bias SD'], 0)
-        self.assertEqual(output.summary['Declination'], calculate_D2.return_value)
+        self.assertEqual(output.summary['Declination'], 0)
         self.assertEqual(output.summary['Declination SD'], 0)
-        self.assertEqual(output.summary['Efficiency Gap'], calculate_EG.return_value)
+        self.assertEqual(output.summary['Efficiency Gap'], 0)
         self.assertEqual(output.summary['Efficiency Gap SD'], 0)
         self.assertIn('Efficiency Gap +1 Dem', output.summary)
         self.assertIn('Efficiency Gap +1 Dem SD', output.summary)
         self.assertIn('Efficiency Gap +1 Rep', output.summary)
         self.assertIn('Efficiency Gap +1 Rep SD', output.summary)
-        self.assertEqual(calculate_EG.mock_calls[0][1], ([2, 3, 5, 6], [6, 5, 3, 2], 0))
-        self.assertEqual(calculate_EG.mock_calls[1][1], ([2, 3, 5, 6], [6, 5, 3, 2], .01))
-        self.assertEqual(calculate_EG.mock_calls[2][1], ([2, 3, 5, 6], [6, 5, 3, 2], -.01))
-        self.assertEqual(calculate_EG.mock_calls[11][1], ([1, 5, 5, 5], [7, 3, 3, 3], 0))
-        self.assertEqual(calculate_EG.mock_calls[12][1], ([1, 5, 5, 5], [7, 3, 3, 3], .01))
-        self.assertEqual(calculate_EG.mock_calls[13][1], ([1, 5, 5, 5], [7, 3, 3, 3], -.01))
+        self.assertEqual(len(calculate_EGs.mock_calls), 11)
+        self.assertEqual(calculate_EGs.mock_calls[0][1][0].tolist(), [[2, 1], [3, 5], [5, 5], [6, 5]])
+        self.assertEqual(calculate_EGs.mock_calls[0][1][1].tolist(), [[6, 7], [5, 3], [3, 3], [2, 3]])
+        self.assertEqual(calculate_EGs.mock_calls[0][1][2], 0)
+        self.assertEqual(calculate_EGs.mock_calls[1][1][2], .01)
+        self.assertEqual(calculate_EGs.mock_calls[2][1][2], -.01)
+        self.assertEqual(calculate_MMDs.mock_calls[0][1][0].tolist(), [[2, 1], [3, 5], [5, 5], [6, 5]])
+        self.assertEqual(calculate_PBs.mock_calls[0][1][0].tolist(), [[2, 1], [3, 5], [5, 5], [6, 5]])
+        self.assertEqual(calculate_D2s.mock_calls[0][1][0].tolist(), [[2, 1], [3, 5], [5, 5], [6, 5]])
         
         for field in ('REP000', 'DEM000', 'REP001', 'DEM001'):
             for district in output.districts:
@@ -494,12 +558,12 @@ class TestScore (unittest.TestCase):
 
     @unittest.mock.patch('planscore.score.percentrank_rel')
     @unittest.mock.patch('planscore.score.percentrank_abs')
-    @unittest.mock.patch('planscore.score.calculate_D2_diff')
-    @unittest.mock.patch('planscore.score.calculate_D2')
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
-    def test_calculate_gap_manysims(self, calculate_EG, calculate_PB, calculate_MMD, calculate_D2, calculate_D2_diff, percentrank_abs, percentrank_rel):
+    @unittest.mock.patch('planscore.metrics.calculate_D2_diffs')
+    @unittest.mock.patch('planscore.metrics.calculate_D2s')
+    @unittest.mock.patch('planscore.metrics.calculate_MMDs')
+    @unittest.mock.patch('planscore.metrics.calculate_PBs')
+    @unittest.mock.patch('planscore.metrics.calculate_EGs')
+    def test_calculate_gap_manysims(self, calculate_EGs, calculate_PBs, calculate_MMDs, calculate_D2s, calculate_D2_diffs, percentrank_abs, percentrank_rel):
         ''' Efficiency gap can be correctly calculated using many input sims.
         
             Use "DEM000"-style vote properties from 2018 and 2019 PlanScore models.
@@ -531,41 +595,41 @@ class TestScore (unittest.TestCase):
         
         percentrank_rel.return_value = 0
         percentrank_abs.return_value = 0
-        calculate_D2.return_value = 0
-        calculate_D2_diff.return_value = 0
-        calculate_MMD.return_value = 0
-        calculate_PB.return_value = 0
-        calculate_EG.return_value = 0
+        calculate_D2s.return_value = numpy.zeros(SIMS)
+        calculate_D2_diffs.return_value = numpy.zeros(SIMS)
+        calculate_MMDs.return_value = numpy.zeros(SIMS)
+        calculate_PBs.return_value = numpy.zeros(SIMS)
+        calculate_EGs.return_value = numpy.zeros(SIMS)
         output = score.calculate_everything(input)
         
-        self.assertEqual(output.summary['Mean-Median'], calculate_MMD.return_value)
+        self.assertEqual(output.summary['Mean-Median'], 0)
         self.assertEqual(output.summary['Mean-Median SD'], 0)
-        self.assertEqual(output.summary['Partisan Bias'], calculate_PB.return_value)
+        self.assertEqual(output.summary['Partisan Bias'], 0)
         self.assertEqual(output.summary['Partisan Bias SD'], 0)
-        self.assertEqual(output.summary['Declination'], calculate_D2.return_value)
+        self.assertEqual(output.summary['Declination'], 0)
         self.assertEqual(output.summary['Declination SD'], 0)
-        self.assertEqual(output.summary['Efficiency Gap'], calculate_EG.return_value)
+        self.assertEqual(output.summary['Efficiency Gap'], 0)
         self.assertEqual(output.summary['Efficiency Gap SD'], 0)
         self.assertIn('Efficiency Gap +1 Dem', output.summary)
         self.assertIn('Efficiency Gap +1 Dem SD', output.summary)
         self.assertIn('Efficiency Gap +1 Rep', output.summary)
         self.assertIn('Efficiency Gap +1 Rep SD', output.summary)
 
-        self.assertEqual(len(calculate_EG.mock_calls), 11 * SIMS, 'Should see EGs for all sims')
+        self.assertEqual(len(calculate_EGs.mock_calls), 11, 'Should see EGs for all swings')
+        self.assertEqual(calculate_EGs.mock_calls[0][1][0].shape, (2, SIMS), 'Should see EGs for all sims')
+        self.assertEqual(calculate_EGs.mock_calls[0][1][2], 0.0)
+        self.assertEqual(calculate_EGs.mock_calls[1][1][2], .01)
+        self.assertEqual(calculate_EGs.mock_calls[2][1][2], -.01)
         in_ranges = []
         
-        for offset in range(0, 11 * SIMS, 11):
-            (d1R, d2R), (d1D, d2D) = calculate_EG.mock_calls[offset+0][1][:2]
+        for sim in range(SIMS):
+            (d1R, d2R), (d1D, d2D) = [votes[:,sim].tolist() for votes in calculate_EGs.mock_calls[0][1][:2]]
             
             in_ranges.append(int(V1 * (1 - D1 - MoE1) < d1R < V1 * (1 - D1 + MoE1)))
             in_ranges.append(int(V1 * (    D1 - MoE1) < d1D < V1 * (    D1 + MoE1)))
             in_ranges.append(int(V2 * (1 - D2 - MoE2) < d2R < V2 * (1 - D2 + MoE2)))
             in_ranges.append(int(V2 * (    D2 - MoE2) < d2D < V2 * (    D2 + MoE2)))
         
-            self.assertEqual(calculate_EG.mock_calls[offset+0][1], ([d1R, d2R], [d1D, d2D], 0.0))
-            self.assertEqual(calculate_EG.mock_calls[offset+1][1], ([d1R, d2R], [d1D, d2D], .01))
-            self.assertEqual(calculate_EG.mock_calls[offset+2][1], ([d1R, d2R], [d1D, d2D], -.01))
-        
         self.assertTrue(sum(in_ranges)/len(in_ranges) > .9,
             'District totals should fall within margin of error most of the time')
         
@@ -579,12 +643,12 @@ class TestScore (unittest.TestCase):
 
     @unittest.mock.patch('planscore.score.percentrank_rel')
     @unittest.mock.patch('planscore.score.percentrank_abs')
-    @unittest.mock.patch('planscore.score.calculate_D2_diff')
-    @unittest.mock.patch('planscore.score.calculate_D2')
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
-    def test_calculate_gap_opensims(self, calculate_EG, calculate_PB, calculate_MMD, calculate_D2, calculate_D2_diff, percentrank_abs, percentrank_rel):
+    @unittest.mock.patch('planscore.metrics.calculate_D2_diffs')
+    @unittest.mock.patch('planscore.metrics.calculate_D2s')
+    @unittest.mock.patch('planscore.metrics.calculate_MMDs')
+    @unittest.mock.patch('planscore.metrics.calculate_PBs')
+    @unittest.mock.patch('planscore.metrics.calculate_EGs')
+    def test_calculate_gap_opensims(self, calculate_EGs, calculate_PBs, calculate_MMDs, calculate_D2s, calculate_D2_diffs, percentrank_abs, percentrank_rel):
         ''' Efficiency gap can be correctly calculated using many open-seat sims.
         
             Use "O:DEM000"-style vote properties from PlanScore models starting 2020.
@@ -626,31 +690,35 @@ class TestScore (unittest.TestCase):
         
         percentrank_rel.return_value = 0
         percentrank_abs.return_value = 0
-        calculate_D2.return_value = 0
-        calculate_D2_diff.return_value = 0
-        calculate_MMD.return_value = 0
-        calculate_PB.return_value = 0
-        calculate_EG.return_value = 0
+        calculate_D2s.return_value = numpy.zeros(SIMS)
+        calculate_D2_diffs.return_value = numpy.zeros(SIMS)
+        calculate_MMDs.return_value = numpy.zeros(SIMS)
+        calculate_PBs.return_value = numpy.zeros(SIMS)
+        calculate_EGs.return_value = numpy.zeros(SIMS)
         output = score.calculate_everything(input)
         
-        self.assertEqual(output.summary['Mean-Median'], calculate_MMD.return_value)
+        self.assertEqual(output.summary['Mean-Median'], 0)
         self.assertEqual(output.summary['Mean-Median SD'], 0)
-        self.assertEqual(output.summary['Partisan Bias'], calculate_PB.return_value)
+        self.assertEqual(output.summary['Partisan Bias'], 0)
         self.assertEqual(output.summary['Partisan Bias SD'], 0)
-        self.assertEqual(output.summary['Declination'], calculate_D2.return_value)
+        self.assertEqual(output.summary['Declination'], 0)
         self.assertEqual(output.summary['Declination SD'], 0)
-        self.assertEqual(output.summary['Efficiency Gap'], calculate_EG.return_value)
+        self.assertEqual(output.summary['Efficiency Gap'], 0)
         self.assertEqual(output.summary['Efficiency Gap SD'], 0)
         self.assertIn('Efficiency Gap +1 Dem', output.summary)
         self.assertIn('Efficiency Gap +1 Dem SD', output.summary)
         self.assertIn('Efficiency Gap +1 Rep', output.summary)
         self.assertIn('Efficiency Gap +1 Rep SD', output.summary)
 
-        self.assertEqual(len(calculate_EG.mock_calls), 11 * SIMS, 'Should see EGs for all sims')
+        self.assertEqual(len(calculate_EGs.mock_calls), 11, 'Should see EGs for all swings')
+        self.assertEqual(calculate_EGs.mock_calls[0][1][0].shape, (3, SIMS), 'Should see EGs for all sims')
+        self.assertEqual(calculate_EGs.mock_calls[0][1][2], 0.0)
+        self.assertEqual(calculate_EGs.mock_calls[1][1][2], .01)
+        self.assertEqual(calculate_EGs.mock_calls[2][1][2], -.01)
         in_ranges = []
         
-        for offset in range(0, 11 * SIMS, 11):
-            (d1R, d2R, d3R), (d1D, d2D, d3D) = calculate_EG.mock_calls[offset+0][1][:2]
+        for sim in range(SIMS):
+            (d1R, d2R, d3R), (d1D, d2D, d3D) = [votes[:,sim].tolist() for votes in calculate_EGs.mock_calls[0][1][:2]]
             
             in_ranges.append(int(V1 * (1 - D1 - MoE1) < d1R < V1 * (1 - D1 + MoE1)))
             in_ranges.append(int(V1 * (    D1 - MoE1) < d1D < V1 * (    D1 + MoE1)))
@@ -659,10 +727,6 @@ class TestScore (unittest.TestCase):
             in_ranges.append(int(V3 * (1 - D3 - MoE3) < d3R < V3 * (1 - D3 + MoE3)))
             in_ranges.append(int(V3 * (    D3 - MoE3) < d3D < V3 * (    D3 + MoE3)))
         
-            self.assertEqual(calculate_EG.mock_calls[offset+0][1], ([d1R, d2R, d3R], [d1D, d2D, d3D], 0.0))
-            self.assertEqual(calculate_EG.mock_calls[offset+1][1], ([d1R, d2R, d3R], [d1D, d2D, d3D], .01))
-            self.assertEqual(calculate_EG.mock_calls[offset+2][1], ([d1R, d2R, d3R], [d1D, d2D, d3D], -.01))
-        
         self.assertTrue(sum(in_ranges)/len(in_ranges) > .9,
             'District totals should fall within margin of error most of the time')
         
@@ -676,12 +740,12 @@ class TestScore (unittest.TestCase):
 
     @unittest.mock.patch('planscore.score.percentrank_rel')
     @unittest.mock.patch('planscore.score.percentrank_abs')
-    @unittest.mock.patch('planscore.score.calculate_D2_diff')
-    @unittest.mock.patch('planscore.score.calculate_D2')
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
-    def test_calculate_gap_incumbentsims(self, calculate_EG, calculate_PB, calculate_MMD, calculate_D2, calculate_D2_diff, percentrank_abs, percentrank_rel):
+    @unittest.mock.patch('planscore.metrics.calculate_D2_diffs')
+    @unittest.mock.patch('planscore.metrics.calculate_D2s')
+    @unittest.mock.patch('planscore.metrics.calculate_MMDs')
+    @unittest.mock.patch('planscore.metrics.calculate_PBs')
+    @unittest.mock.patch('planscore.metrics.calculate_EGs')
+    def test_calculate_gap_incumbentsims(self, calculate_EGs, calculate_PBs, calculate_MMDs, calculate_D2s, calculate_D2_diffs, percentrank_abs, percentrank_rel):
         ''' Efficiency gap can be correctly calculated using mixed incumbency sims.
         
             Use "O:DEM000"-style vote properties from PlanScore models starting 2020.
@@ -753,31 +817,35 @@ class TestScore (unittest.TestCase):
         
         percentrank_rel.return_value = 0
         percentrank_abs.return_value = 0
-        calculate_D2.return_value = 0
-        calculate_D2_diff.return_value = 0
-        calculate_MMD.return_value = 0
-        calculate_PB.return_value = 0
-        calculate_EG.return_value = 0
+        calculate_D2s.return_value = numpy.zeros(SIMS)
+        calculate_D2_diffs.return_value = numpy.zeros(SIMS)
+        calculate_MMDs.return_value = numpy.zeros(SIMS)
+        calculate_PBs.return_value = numpy.zeros(SIMS)
+        calculate_EGs.return_value = numpy.zeros(SIMS)
         output = score.calculate_everything(input)
         
-        self.assertEqual(output.summary['Mean-Median'], calculate_MMD.return_value)
+        self.assertEqual(output.summary['Mean-Median'], 0)
         self.assertEqual(output.summary['Mean-Median SD'], 0)
-        self.assertEqual(output.summary['Partisan Bias'], calculate_PB.return_value)
+        self.assertEqual(output.summary['Partisan Bias'], 0)
         self.assertEqual(output.summary['Partisan Bias SD'], 0)
-        self.assertEqual(output.summary['Declination'], calculate_D2.return_value)
+        self.assertEqual(output.summary['Declination'], 0)
         self.assertEqual(output.summary['Declination SD'], 0)
-        self.assertEqual(output.summary['Efficiency Gap'], calculate_EG.return_value)
+        self.assertEqual(output.summary['Efficiency Gap'], 0)
         self.assertEqual(output.summary['Efficiency Gap SD'], 0)
         self.assertIn('Efficiency Gap +1 Dem', output.summary)
         self.assertIn('Efficiency Gap +1 Dem SD', output.summary)
         self.assertIn('Efficiency Gap +1 Rep', output.summary)
         self.assertIn('Efficiency Gap +1 Rep SD', output.summary)
 
-        self.assertEqual(len(calculate_EG.mock_calls), 11 * SIMS, 'Should see EGs for all sims')
+        self.assertEqual(len(calculate_EGs.mock_calls), 11, 'Should see EGs for all swings')
+        self.assertEqual(calculate_EGs.mock_calls[0][1][0].shape, (3, SIMS), 'Should see EGs for all sims')
+        self.assertEqual(calculate_EGs.mock_calls[0][1][2], 0.0)
+        self.assertEqual(calculate_EGs.mock_calls[1][1][2], .01)
+        self.assertEqual(calculate_EGs.mock_calls[2][1][2], -.01)
         in_ranges = []
         
-        for offset in range(0, 11 * SIMS, 11):
-            (d1R, d2R, d3R), (d1D, d2D, d3D) = calculate_EG.mock_calls[offset+0][1][:2]
+        for sim in range(SIMS):
+            (d1R, d2R, d3R), (d1D, d2D, d3D) = [votes[:,sim].tolist() for votes in calculate_EGs.mock_calls[0][1][:2]]
             
             in_ranges.append(int(V1 * (1 - (D1+SWING) - MoE1) < d1R < V1 * (1 - (D1+SWING) + MoE1)))
             in_ranges.append(int(V1 * (    (D1+SWING) - MoE1) < d1D < V1 * (    (D1+SWING) + MoE1)))
@@ -786,10 +854,6 @@ class TestScore (unittest.TestCase):
             in_ranges.append(int(V3 * (1 - D3 - MoE3) < d3R < V3 * (1 - D3 + MoE3)))
             in_ranges.append(int(V3 * (    D3 - MoE3) < d3D < V3 * (    D3 + MoE3)))
         
-            self.assertEqual(calculate_EG.mock_calls[offset+0][1], ([d1R, d2R, d3R], [d1D, d2D, d3D], 0.0))
-            self.assertEqual(calculate_EG.mock_calls[offset+1][1], ([d1R, d2R, d3R], [d1D, d2D, d3D], .01))
-            self.assertEqual(calculate_EG.mock_calls[offset+2][1], ([d1R, d2R, d3R], [d1D, d2D, d3D], -.01))
-        
         self.assertTrue(sum(in_ranges)/len(in_ranges) > .9,
             'District totals should fall within margin of error most of the time')
         
@@ -803,12 +867,12 @@ class TestScore (unittest.TestCase):
 
     @unittest.mock.patch('planscore.score.percentrank_rel')
     @unittest.mock.patch('planscore.score.percentrank_abs')
-    @unittest.mock.patch('planscore.score.calculate_D2_diff')
-    @unittest.mock.patch('planscore.score.calculate_D2')
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
-    def test_calculate_gap_blanks(self, calculate_EG, calculate_PB, calculate_MMD, calculate_D2, calculate_D2_diff, percentrank_abs, percentrank_rel):
+    @unittest.mock.patch('planscore.metrics.calculate_D2_diffs')
+    @unittest.mock.patch('planscore.metrics.calculate_D2s')
+    @unittest.mock.patch('planscore.metrics.calculate_MMDs')
+    @unittest.mock.patch('planscore.metrics.calculate_PBs')
+    @unittest.mock.patch('planscore.metrics.calculate_EGs')
+    def test_calculate_gap_blanks(self, calculate_EGs, calculate_PBs, calculate_MMDs, calculate_D2s, calculate_D2_diffs, percentrank_abs, percentrank_rel):
         ''' Efficiency gap can be correctly calculated using input sims with blank districts.
         
             Use "DEM000"-style vote properties from 2018 and 2019 PlanScore models.
@@ -824,30 +888,30 @@ class TestScore (unittest.TestCase):
         
         percentrank_rel.return_value = 0
         percentrank_abs.return_value = 0
-        calculate_D2.return_value = 0
-        calculate_D2_diff.return_value = 0
-        calculate_MMD.return_value = 0
-        calculate_PB.return_value = 0
-        calculate_EG.return_value = 0
+        calculate_D2s.return_value = numpy.zeros(2)
+        calculate_D2_diffs.return_value = numpy.zeros(2)
+        calculate_MMDs.return_value = numpy.zeros(2)
+        calculate_PBs.return_value = numpy.zeros(2)
+        calculate_EGs.return_value = numpy.zeros(2)
         output = score.calculate_everything(input)
-        self.assertEqual(output.summary['Mean-Median'], calculate_MMD.return_value)
+        self.assertEqual(output.summary['Mean-Median'], 0)
         self.assertEqual(output.summary['Mean-Median SD'], 0)
-        self.assertEqual(output.summary['Partisan Bias'], calculate_PB.return_value)
+        self.assertEqual(output.summary['Partisan Bias'], 0)
         self.assertEqual(output.summary['Partisan Bias SD'], 0)
-        self.assertEqual(output.summary['Declination'], calculate_D2.return_value)
+        self.assertEqual(output.summary['Declination'], 0)
         self.assertEqual(output.summary['Declination SD'], 0)
-        self.assertEqual(output.summary['Efficiency Gap'], calculate_EG.return_value)
+        self.assertEqual(output.summary['Efficiency Gap'], 0)
         self.assertEqual(output.summary['Efficiency Gap SD'], 0)
         self.assertIn('Efficiency Gap +1 Dem', output.summary)
         self.assertIn('Efficiency Gap +1 Dem SD', output.summary)
         self.assertIn('Efficiency Gap +1 Rep', output.summary)
         self.assertIn('Efficiency Gap +1 Rep SD', output.summary)
-        self.assertEqual(calculate_EG.mock_calls[0][1], ([2, 3, 5, 6, 0], [6, 5, 3, 2, 0], 0))
-        self.assertEqual(calculate_EG.mock_calls[1][1], ([2, 3, 5, 6, 0], [6, 5, 3, 2, 0], .01))
-        self.assertEqual(calculate_EG.mock_calls[2][1], ([2, 3, 5, 6, 0], [6, 5, 3, 2, 0], -.01))
-        self.assertEqual(calculate_EG.mock_calls[11][1], ([1, 5, 5, 5, 0], [7, 3, 3, 3, 0], 0))
-        self.assertEqual(calculate_EG.mock_calls[12][1], ([1, 5, 5, 5, 0], [7, 3, 3, 3, 0], .01))
-        self.assertEqual(calculate_EG.mock_calls[13][1], ([1, 5, 5, 5, 0], [7, 3, 3, 3, 0], -.01))
+        self.assertEqual(len(calculate_EGs.mock_calls), 11)
+        self.assertEqual(calculate_EGs.mock_calls[0][1][0].tolist(), [[2, 1], [3, 5], [5, 5], [6, 5], [0, 0]])
+        self.assertEqual(calculate_EGs.mock_calls[0][1][1].tolist(), [[6, 7], [5, 3], [3, 3], [2, 3], [0, 0]])
+        self.assertEqual(calculate_EGs.mock_calls[0][1][2], 0)
+        self.assertEqual(calculate_EGs.mock_calls[1][1][2], .01)
+        self.assertEqual(calculate_EGs.mock_calls[2][1][2], -.01)
         
         for field in ('REP000', 'DEM000', 'REP001', 'DEM001'):
             for district in output.districts:
@@ -864,14 +928,14 @@ class TestScore (unittest.TestCase):
 
     @unittest.mock.patch('planscore.score.percentrank_rel')
     @unittest.mock.patch('planscore.score.percentrank_abs')
-    @unittest.mock.patch('planscore.score.calculate_D2_diff')
-    @unittest.mock.patch('planscore.score.calculate_D2')
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
+    @unittest.mock.patch('planscore.metrics.calculate_D2_diffs')
+    @unittest.mock.patch('planscore.metrics.calculate_D2s')
+    @unittest.mock.patch('planscore.metrics.calculate_MMDs')
+    @unittest.mock.patch('planscore.metrics.calculate_PBs')
+    @unittest.mock.patch('planscore.metrics.calculate_EGs')
     @unittest.mock.patch('planscore.matrix.model_votes')
     @unittest.mock.patch('planscore.matrix.filter_district_data')
-    def test_calculate_gap_unified(self, filter_district_data, model_votes, calculate_EG, calculate_PB, calculate_MMD, calculate_D2, calculate_D2_diff, percentrank_abs, percentrank_rel):
+    def test_calculate_gap_unified(self, filter_district_data, model_votes, calculate_EGs, calculate_PBs, calculate_MMDs, calculate_D2s, calculate_D2_diffs, percentrank_abs, percentrank_rel):
         ''' Efficiency gap can be correctly calculated from presidential vote only
         '''
         input = data.Upload(id=None, key=None,
@@ -886,11 +950,11 @@ class TestScore (unittest.TestCase):
         
         percentrank_rel.return_value = 0
         percentrank_abs.return_value = 0
-        calculate_D2.return_value = 0
-        calculate_D2_diff.return_value = 0
-        calculate_MMD.return_value = 0
-        calculate_PB.return_value = 0
-        calculate_EG.return_value = 0
+        calculate_D2s.return_value = numpy.zeros(3)
+        calculate_D2_diffs.return_value = numpy.zeros(3)
+        calculate_MMDs.return_value = numpy.zeros(3)
+        calculate_PBs.return_value = numpy.zeros(3)
+        calculate_EGs.return_value = numpy.zeros(3)
         model_votes.return_value = numpy.array([
             [[5.3, 2.7],
              [6.0, 2.0],
@@ -911,32 +975,35 @@ class TestScore (unittest.TestCase):
         output = score.calculate_everything(input)
         self.assertEqual(model_votes.mock_calls[0][1], ('2025A', data.State.XX, data.House.ushouse, filter_district_data.return_value))
         
-        self.assertEqual(output.summary['Mean-Median'], calculate_MMD.return_value)
+        self.assertEqual(output.summary['Mean-Median'], 0)
         self.assertEqual(output.summary['Mean-Median Positives'], 0.0)
-        self.assertEqual(calculate_MMD.mock_calls[0][1], ([2.7, 4.1, 5.2, 6.1], [5.3, 3.9, 2.8, 1.9]))
+        self.assertEqual(calculate_MMDs.mock_calls[0][1][0][:,0].tolist(), [2.7, 4.1, 5.2, 6.1])
+        self.assertEqual(calculate_MMDs.mock_calls[0][1][1][:,0].tolist(), [5.3, 3.9, 2.8, 1.9])
 
-        self.assertEqual(output.summary['Partisan Bias'], calculate_PB.return_value)
+        self.assertEqual(output.summary['Partisan Bias'], 0)
         self.assertEqual(output.summary['Partisan Bias Positives'], 0.0)
-        self.assertEqual(calculate_PB.mock_calls[0][1], ([2.7, 4.1, 5.2, 6.1], [5.3, 3.9, 2.8, 1.9]))
+        self.assertEqual(calculate_PBs.mock_calls[0][1][0][:,0].tolist(), [2.7, 4.1, 5.2, 6.1])
+        self.assertEqual(calculate_PBs.mock_calls[0][1][1][:,0].tolist(), [5.3, 3.9, 2.8, 1.9])
         
-        self.assertEqual(output.summary['Declination'], calculate_D2.return_value)
+        self.assertEqual(output.summary['Declination'], 0)
         self.assertEqual(output.summary['Declination Positives'], 0.0)
-        self.assertEqual(calculate_D2.mock_calls[0][1], ([2.7, 4.1, 5.2, 6.1], [5.3, 3.9, 2.8, 1.9]))
+        self.assertEqual(calculate_D2s.mock_calls[0][1][0][:,0].tolist(), [2.7, 4.1, 5.2, 6.1])
+        self.assertEqual(calculate_D2s.mock_calls[0][1][1][:,0].tolist(), [5.3, 3.9, 2.8, 1.9])
         
-        SIMS = model_votes.return_value.shape[1]
+        # One call covers all sims for each vote swing scenario
+        self.assertEqual(len(calculate_EGs.mock_calls), 11)
 
-        # First round of sims
-        self.assertEqual(output.summary['Efficiency Gap'], calculate_EG.return_value)
+        self.assertEqual(output.summary['Efficiency Gap'], 0)
         self.assertEqual(output.summary['Efficiency Gap Positives'], 0.0)
-        self.assertEqual(calculate_EG.mock_calls[SIMS*0][1], ([2.7, 4.1, 5.2, 6.1], [5.3, 3.9, 2.8, 1.9], 0.))
+        self.assertEqual(calculate_EGs.mock_calls[0][1][0][:,0].tolist(), [2.7, 4.1, 5.2, 6.1])
+        self.assertEqual(calculate_EGs.mock_calls[0][1][1][:,0].tolist(), [5.3, 3.9, 2.8, 1.9])
+        self.assertEqual(calculate_EGs.mock_calls[0][1][2], 0.)
 
-        # Second round of sims
-        self.assertEqual(output.summary['Efficiency Gap +1 Dem'], calculate_EG.return_value)
-        self.assertEqual(calculate_EG.mock_calls[SIMS*1][1], ([2.7, 4.1, 5.2, 6.1], [5.3, 3.9, 2.8, 1.9], .01))
+        self.assertEqual(output.summary['Efficiency Gap +1 Dem'], 0)
+        self.assertEqual(calculate_EGs.mock_calls[1][1][2], .01)
 
-        # Third round of sims
-        self.assertEqual(output.summary['Efficiency Gap +1 Rep'], calculate_EG.return_value)
-        self.assertEqual(calculate_EG.mock_calls[SIMS*2][1], ([2.7, 4.1, 5.2, 6.1], [5.3, 3.9, 2.8, 1.9], -.01))
+        self.assertEqual(output.summary['Efficiency Gap +1 Rep'], 0)
+        self.assertEqual(calculate_EGs.mock_calls[2][1][2], -.01)
 
         self.assertEqual(output.districts[0]['totals']['Republican Votes'], 2.27)
         self.assertEqual(output.districts[0]['totals']['Democratic Votes'], 5.73)
@@ -1085,13 +1152,13 @@ class TestScore (unittest.TestCase):
 
     @unittest.mock.patch('planscore.score.percentrank_rel')
     @unittest.mock.patch('planscore.score.percentrank_abs')
-    @unittest.mock.patch('planscore.score.calculate_D2_diff')
-    @unittest.mock.patch('planscore.score.calculate_D2')
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
+    @unittest.mock.patch('planscore.metrics.calculate_D2_diffs')
+    @unittest.mock.patch('planscore.metrics.calculate_D2s')
+    @unittest.mock.patch('planscore.metrics.calculate_MMDs')
+    @unittest.mock.patch('planscore.metrics.calculate_PBs')
+    @unittest.mock.patch('planscore.metrics.calculate_EGs')
     @unittest.mock.patch('planscore.matrix.model_votes')
-    def test_calculate_gap_with_zeros(self, model_votes, calculate_EG, calculate_PB, calculate_MMD, calculate_D2, calculate_D2_diff, percentrank_abs, percentrank_rel):
+    def test_calculate_gap_with_zeros(self, model_votes, calculate_EGs, calculate_PBs, calculate_MMDs, calculate_D2s, calculate_D2_diffs, percentrank_abs, percentrank_rel):
         ''' Efficiency gap can be correctly calculated from presidential vote only
         '''
         input = data.Upload(id=None, key=None,
@@ -1107,11 +1174,11 @@ class TestScore (unittest.TestCase):
         
         percentrank_rel.return_value = 0
         percentrank_abs.return_value = 0
-        calculate_D2.return_value = 0
-        calculate_D2_diff.return_value = 0
-        calculate_MMD.return_value = 0
-        calculate_PB.return_value = 0
-        calculate_EG.return_value = 0
+        calculate_D2s.return_value = numpy.zeros(3)
+        calculate_D2_diffs.return_value = numpy.zeros(3)
+        calculate_MMDs.return_value = numpy.zeros(3)
+        calculate_PBs.return_value = numpy.zeros(3)
+        calculate_EGs.return_value = numpy.zeros(3)
         model_votes.return_value = numpy.array([
             [[5.3, 2.7],
              [6.0, 2.0],
@@ -1151,37 +1218,23 @@ class TestScore (unittest.TestCase):
         self.assertEqual(model_votes.mock_calls[0][1][3][2], (3.0, 5.0, 'O'))
         self.assertEqual(model_votes.mock_calls[0][1][3][3], (2.0, 6.0, 'O'))
         
-        self.assertEqual(output.summary['Mean-Median'], calculate_MMD.return_value)
-        self.assertEqual(len(calculate_MMD.mock_calls[0][1][0]), 4, 'Should skip empty 5th district')
-        self.assertEqual(len(calculate_MMD.mock_calls[0][1][1]), 4, 'Should skip empty 5th district')
-
-        self.assertEqual(output.summary['Partisan Bias'], calculate_PB.return_value)
-        self.assertEqual(len(calculate_PB.mock_calls[0][1][0]), 4, 'Should skip empty 5th district')
-        self.assertEqual(len(calculate_PB.mock_calls[0][1][1]), 4, 'Should skip empty 5th district')
+        # Empty 5th district is passed along as NaN for the metrics to skip
+        for calculate in (calculate_MMDs, calculate_PBs, calculate_D2s, calculate_D2_diffs, calculate_EGs):
+            self.assertEqual(calculate.mock_calls[0][1][0].shape, (5, 3))
+            self.assertEqual(calculate.mock_calls[0][1][1].shape, (5, 3))
+            self.assertTrue(numpy.isnan(calculate.mock_calls[0][1][0][4]).all(), 'Should skip empty 5th district')
+            self.assertTrue(numpy.isnan(calculate.mock_calls[0][1][1][4]).all(), 'Should skip empty 5th district')
 
-        self.assertEqual(output.summary['Declination'], calculate_D2.return_value)
-        self.assertEqual(len(calculate_D2.mock_calls[0][1][0]), 4, 'Should skip empty 5th district')
-        self.assertEqual(len(calculate_D2.mock_calls[0][1][1]), 4, 'Should skip empty 5th district')
+        self.assertEqual(output.summary['Mean-Median'], 0)
+        self.assertEqual(output.summary['Partisan Bias'], 0)
+        self.assertEqual(output.summary['Declination'], 0)
         
-        SIMS = model_votes.return_value.shape[1]
-
-        # First round of sims
-        self.assertEqual(output.summary['Efficiency Gap'], calculate_EG.return_value)
-        self.assertEqual(len(calculate_EG.mock_calls[SIMS*0][1][0]), 4, 'Should skip empty 5th district')
-        self.assertEqual(len(calculate_EG.mock_calls[SIMS*0][1][1]), 4, 'Should skip empty 5th district')
-        self.assertEqual(calculate_EG.mock_calls[SIMS*0][1][2], 0)
-
-        # Second round of sims
-        self.assertEqual(output.summary['Efficiency Gap +1 Dem'], calculate_EG.return_value)
-        self.assertEqual(len(calculate_EG.mock_calls[SIMS*1][1][0]), 4, 'Should skip empty 5th district')
-        self.assertEqual(len(calculate_EG.mock_calls[SIMS*1][1][1]), 4, 'Should skip empty 5th district')
-        self.assertEqual(calculate_EG.mock_calls[SIMS*1][1][2], .01)
-
-        # Third round of sims
-        self.assertEqual(output.summary['Efficiency Gap +1 Rep'], calculate_EG.return_value)
-        self.assertEqual(len(calculate_EG.mock_calls[SIMS*2][1][0]), 4, 'Should skip empty 5th district')
-        self.assertEqual(len(calculate_EG.mock_calls[SIMS*2][1][1]), 4, 'Should skip empty 5th district')
-        self.assertEqual(calculate_EG.mock_calls[SIMS*2][1][2], -.01)
+        self.assertEqual(output.summary['Efficiency Gap'], 0)
+        self.assertEqual(calculate_EGs.mock_calls[0][1][2], 0)
+        self.assertEqual(output.summary['Efficiency Gap +1 Dem'], 0)
+        self.assertEqual(calculate_EGs.mock_calls[1][1][2], .01)
+        self.assertEqual(output.summary['Efficiency Gap +1 Rep'], 0)
+        self.assertEqual(calculate_EGs.mock_calls[2][1][2], -.01)
 
         self.assertIsNone(output.districts[-1]['totals']['Republican Votes'])
         self.assertIsNone(output.districts[-1]['totals']['Democratic Votes'])
@@ -1204,3 +1257,29 @@ class TestScore (unittest.TestCase):
         
         self.assertEqual(output.summary['Declination Absolute Percent Rank'], 1.)
         self.assertEqual(output.summary['Declination Relative Percent Rank'], 1.)
+
+    @unittest.mock.patch('planscore.score.calculate_fva_biases')
+    @unittest.mock.patch('planscore.score.calculate_district_biases')
+    @unittest.mock.patch('planscore.score.calculate_biases')
+    @unittest.mock.patch('planscore.score.calculate_open_biases')
+    @unittest.mock.patch('planscore.score.load_simulations')
+    @unittest.mock.patch('planscore.score.calculate_bias')
+    def test_calculate_everything_stages(self, calculate_bias, load_simulations,
+        calculate_open_biases, calculate_biases, calculate_district_biases, calculate_fva_biases):
+        ''' Timing stages for calculate_everything() don't overlap
+        '''
+        def fake_district_biases(upload, timer):
+            with timer.stage('simulation'):
+                return upload
+        
+        calculate_district_biases.side_effect = fake_district_biases
+        calculate_fva_biases.return_value = data.Upload(id=None, key=None, summary={'Efficiency Gap': .1})
+        timer = timing.Timer()
+        
+        output = score.calculate_everything(data.Upload(id=None, key=None), timer)
+        
+        self.assertEqual(output.summary, {'Efficiency Gap': .1})
+        self.assertEqual([stage.stage for stage in timer.stages], ['metrics', 'simulation', 'metrics'])
+        
+        for (stage1, stage2) in zip(timer.stages, timer.stages[1:]):
+            self.assertLessEqual(stage1.start_time + stage1.elapsed_time, stage2.start_time)
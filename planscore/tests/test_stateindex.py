@@ -0,0 +1,53 @@
+import unittest
+import shapely.geometry
+from .. import stateindex
+
+class TestStateIndex (unittest.TestCase):
+
+    def test_sample_indexes(self):
+        self.assertEqual(stateindex.sample_indexes(3), [0, 1, 2])
+        self.assertEqual(stateindex.sample_indexes(0), [])
+        self.assertEqual(stateindex.sample_indexes(101, 5), [0, 25, 50, 75, 100])
+        self.assertEqual(len(stateindex.sample_indexes(1000)), stateindex.SAMPLE_SIZE)
+
+    def test_load_state_index(self):
+        index = stateindex.load_state_index()
+        self.assertIs(stateindex.load_state_index(), index, 'Should load states once')
+        self.assertEqual(len(index.states), 52)
+        self.assertEqual(index.find_abbr('NC').name, 'North Carolina')
+        self.assertEqual(index.find_geoid('37').abbr, 'NC')
+        self.assertIsNone(index.find_abbr('XX'))
+        self.assertIsNone(index.find_geoid('00'))
+
+    def test_candidates(self):
+        index = stateindex.load_state_index()
+        abbrs = {state.abbr for state in index.candidates(-79.1, 35.9, -79, 36)}
+        self.assertIn('NC', abbrs)
+        self.assertNotIn('CA', abbrs)
+        self.assertEqual(index.candidates(-1, -1, 1, 1), [])
+
+    def test_locate(self):
+        index = stateindex.load_state_index()
+        located = index.locate([(-79.05, 35.91), (-122.27, 37.80), (0, 0)])
+        self.assertEqual([state and state.abbr for state in located], ['NC', 'CA', None])
+        self.assertEqual(index.locate([]), [])
+
+    def test_point_shares(self):
+        index = stateindex.load_state_index()
+
+        shares = index.point_shares([(-79.05, 35.91), (-122.27, 37.80), (0, 0)], [3, 1, 0])
+        self.assertEqual(shares, {'NC': .75, 'CA': .25})
+
+        shares = index.point_shares([(-79.05, 35.91), (0, 0)], [0, 0])
+        self.assertEqual(shares, {'NC': .5}, 'Should count points alike without weights')
+
+    def test_overlap_areas(self):
+        index = stateindex.load_state_index()
+
+        # Box straddling the North Carolina and Virginia border
+        overlaps = index.overlap_areas(shapely.geometry.box(-79.1, 36.4, -79, 36.7))
+        self.assertEqual(sorted(overlaps.keys()), ['NC', 'VA'])
+        self.assertAlmostEqual(overlaps['NC'] + overlaps['VA'], .03, places=3)
+        self.assertGreater(overlaps['VA'], overlaps['NC'])
+
+        self.assertEqual(index.overlap_areas(shapely.geometry.box(-1, -1, 1, 1)), {})
@@ -0,0 +1,28 @@
+import unittest, unittest.mock
+from .. import timing
+
+class TestTiming (unittest.TestCase):
+
+    @unittest.mock.patch('planscore.timing.peak_memory')
+    @unittest.mock.patch('time.time')
+    def test_timer(self, time, peak_memory):
+        time.side_effect = [1., 2., 3., 4., 5., 8.]
+        peak_memory.side_effect = [100., 150., 200.]
+        timer = timing.Timer()
+
+        with timer.stage('outer'):
+            with timer.stage('inner'):
+                pass
+
+        with self.assertRaises(ValueError):
+            with timer.stage('failed'):
+                raise ValueError()
+
+        self.assertEqual(timer.stages, [
+            timing.StageTiming('inner', 2., 1., 100.),
+            timing.StageTiming('outer', 1., 3., 150.),
+            timing.StageTiming('failed', 5., 3., 200.),
+        ], 'Should record nested and failed stages')
+
+    def test_peak_memory(self):
+        self.assertGreater(timing.peak_memory(), 1, 'Should see at least a megabyte')
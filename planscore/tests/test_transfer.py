@@ -0,0 +1,108 @@
+import unittest, unittest.mock, threading, io, gzip
+import botocore.exceptions
+from .. import transfer
+
+def client_error(code):
+    return botocore.exceptions.ClientError({'Error': {'Code': code}}, 'PutObject')
+
+class LocalS3:
+    ''' Thread-safe stand-in for an S3 client, failing or retrying some puts on request
+    '''
+    def __init__(self, failures=None, retries=None):
+        self.objects = {}
+        self.failures = dict(failures or {})
+        self.retries = dict(retries or {})
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        with self.lock:
+            if self.failures.get(Key):
+                code = self.failures[Key].pop(0)
+                raise client_error(code)
+
+            self.objects[(Bucket, Key)] = Body
+
+        if Key in self.retries:
+            return {'ETag': '"{}"'.format(Key), 'ResponseMetadata': {'RetryAttempts': self.retries[Key]}}
+
+        return {'ETag': '"{}"'.format(Key)}
+
+class TestTransfer (unittest.TestCase):
+
+    def test_body_size(self):
+        self.assertEqual(transfer.body_size(b'hello'), 5)
+        self.assertEqual(transfer.body_size('héllo'), 6)
+
+    def test_client_config(self):
+        self.assertEqual(transfer.CLIENT_CONFIG.max_pool_connections, transfer.MAX_WORKERS)
+        self.assertEqual(transfer.CLIENT_CONFIG.retries['mode'], 'standard', 'Should retry transient errors')
+
+    def test_list_keys(self):
+        s3 = unittest.mock.Mock()
+        s3.list_objects.side_effect = [
+            {'Contents': [{'Key': 'prefix/0'}, {'Key': 'prefix/1'}], 'IsTruncated': True},
+            {'Contents': [{'Key': 'prefix/2'}], 'IsTruncated': False},
+        ]
+
+        keys = transfer.list_keys(s3, 'bucket', 'prefix/')
+
+        self.assertEqual(keys, ['prefix/0', 'prefix/1', 'prefix/2'])
+        self.assertEqual(s3.list_objects.mock_calls, [
+            unittest.mock.call(Bucket='bucket', Prefix='prefix/'),
+            unittest.mock.call(Bucket='bucket', Prefix='prefix/', Marker='prefix/1'),
+        ])
+
+    def test_iter_objects(self):
+        s3 = unittest.mock.Mock()
+        s3.get_object.side_effect = lambda Bucket, Key: {
+            'Body': io.BytesIO(gzip.compress(Key.encode('utf8'))), 'ContentEncoding': 'gzip'
+        } if Key.endswith('.gz') else {'Body': io.BytesIO(Key.encode('utf8'))}
+
+        keys = ['key{}'.format(i) for i in range(50)] + ['key.gz']
+        bodies = dict(transfer.iter_objects(s3, 'bucket', keys, max_workers=4))
+
+        self.assertEqual(bodies, {key: key.encode('utf8') for key in keys})
+
+    def test_object_writer(self):
+        s3 = LocalS3()
+
+        with transfer.ObjectWriter(s3, max_workers=4) as writer:
+            futures = [
+                writer.put_object(Bucket='bucket', Key='key{}'.format(i), Body='x' * i)
+                for i in range(100)
+            ]
+
+        self.assertEqual(len(s3.objects), 100)
+        self.assertEqual(s3.objects[('bucket', 'key7')], 'xxxxxxx')
+        self.assertEqual(futures[3].result(), {'ETag': '"key3"'})
+
+        stats = writer.stats()
+        self.assertEqual(stats.count, 100)
+        self.assertEqual(stats.bytes, sum(range(100)))
+        self.assertEqual(stats.retries, 0)
+
+    def test_object_writer_retries(self):
+        s3 = LocalS3(retries={'key1': 2, 'key2': 1})
+        writer = transfer.ObjectWriter(s3, max_workers=2)
+
+        for i in range(3):
+            writer.put_object(Bucket='bucket', Key='key{}'.format(i), Body=b'data')
+
+        stats = writer.close()
+
+        self.assertEqual(len(s3.objects), 3)
+        self.assertEqual(stats.count, 3)
+        self.assertEqual(stats.bytes, 12)
+        self.assertEqual(stats.retries, 3, 'Should count retries made by the client')
+
+    def test_object_writer_error(self):
+        s3 = LocalS3({'key1': ['AccessDenied', 'AccessDenied']})
+        writer = transfer.ObjectWriter(s3)
+        writer.put_object(Bucket='bucket', Key='key0', Body=b'data')
+        writer.put_object(Bucket='bucket', Key='key1', Body=b'data')
+
+        with self.assertRaises(botocore.exceptions.ClientError):
+            writer.close()
+
+        self.assertEqual(len(s3.failures['key1']), 1, 'Should not retry errors from the client')
+        self.assertIn(('bucket', 'key0'), s3.objects)
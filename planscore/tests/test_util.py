@@ -254,6 +254,69 @@ class TestUtil (unittest.TestCase):
             self.assertEqual(len(rows13), 9)
             self.assertEqual(rows13[0], ('390017701001000', '14'))
     
+    def test_iter_baf_chunks(self):
+        ''' Test that iter_baf_chunks() streams consistent columnar chunks
+        '''
+        stream = io.StringIO('GEOID20,DISTRICT\n'
+            '000000000000001,2\n000000000000002,1\n000000000000003,ZZ\n'
+            '000000000000004,2\n000000000000005,3\n\n000000000000006,1\n')
+        chunks = list(util.iter_baf_chunks(stream, chunk_size=3))
+        
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(chunks[0].block_ids.tolist(), [b'000000000000001', b'000000000000002'])
+        self.assertEqual(chunks[1].block_ids.tolist(), [b'000000000000004', b'000000000000005'])
+        self.assertEqual(chunks[2].block_ids.tolist(), [b'000000000000006'])
+        self.assertIs(chunks[0].labels, chunks[2].labels, 'Should share one growing labels list')
+        self.assertEqual(chunks[2].labels, ['2', '1', '3'], 'Should list labels in order of appearance')
+        self.assertEqual([chunks[0].labels[code] for code in chunks[0].codes], ['2', '1'])
+        self.assertEqual([chunks[1].labels[code] for code in chunks[1].codes], ['2', '3'])
+        self.assertEqual([chunks[2].labels[code] for code in chunks[2].codes], ['1'])
+    
+    def test_iter_baf_chunks_non_ascii(self):
+        ''' Test that iter_baf_chunks() replaces non-ASCII block ID characters
+        '''
+        stream = io.StringIO('GEOID20,DISTRICT\n000000000000001,1\n00000000000000\u00e9,2\n')
+        (chunk, ) = util.iter_baf_chunks(stream)
+        
+        self.assertEqual(chunk.block_ids.tolist(), [b'000000000000001', b'00000000000000?'])
+        self.assertEqual(chunk.labels, ['1', '2'])
+    
+    def test_read_baf(self):
+        ''' Test that read_baf() reads whole files with and without headers
+        '''
+        with open(os.path.join(os.path.dirname(__file__), 'data', 'ohio-1195_001.csv')) as file:
+            assignments = util.read_baf(file)
+        
+        self.assertEqual(len(assignments.block_ids), 9)
+        self.assertEqual(assignments.block_ids[0], b'390017701001000')
+        self.assertEqual(assignments.labels[assignments.codes[0]], '14')
+        
+        assignments = util.read_baf(io.StringIO('0000000001|7\n0000000002|8\n'))
+        self.assertEqual(assignments.block_ids.tolist(), [b'0000000001', b'0000000002'])
+        self.assertEqual(assignments.labels, ['7', '8'])
+        
+        assignments = util.read_baf(io.StringIO('BLOCKID,DISTRICT\n'))
+        self.assertEqual(len(assignments.block_ids), 0)
+        self.assertEqual(assignments.labels, [])
+        
+        with self.assertRaises(ValueError):
+            util.read_baf(io.StringIO('BLOCKID,DISTRICT,EXTRA\n0000000001,1,1\n'))
+    
+    def test_open_baf_file(self):
+        ''' Test that open_baf_file() finds text inside zip files
+        '''
+        path1 = os.path.join(os.path.dirname(__file__), 'data', 'null-plan-blockassignments.zip')
+        path2 = os.path.join(os.path.dirname(__file__), 'data', 'null-plan-blockassignments.txt')
+        path3 = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.geojson')
+        
+        with util.open_baf_file(path1) as file1, util.open_baf_file(path2) as file2:
+            self.assertEqual(len(util.baf_stream_to_pairs(file1)), 10)
+            self.assertEqual(len(util.baf_stream_to_pairs(file2)), 10)
+        
+        with self.assertRaises(ValueError):
+            with util.open_baf_file(path3) as file3:
+                pass
+    
     @unittest.mock.patch('planscore.util.is_polygonal_feature')
     @unittest.mock.patch('sys.stdout')
     def test_ordered_districts(self, stdout, is_polygonal_feature):
@@ -0,0 +1,32 @@
+''' Wall time and peak memory for named stages of scoring one upload.
+'''
+import time, resource, contextlib, collections
+
+StageTiming = collections.namedtuple('StageTiming', ('stage', 'start_time', 'elapsed_time', 'peak_memory'))
+
+def peak_memory():
+    ''' Return peak resident memory of this process so far in megabytes
+    '''
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class Timer:
+    ''' Recorder for a sequence of StageTiming tuples.
+
+        Stage names may repeat, e.g. for work done in several passes, and
+        stages may nest. A stage is recorded when it finishes, so an inner
+        stage appears before the stage around it.
+    '''
+    def __init__(self):
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        ''' Record elapsed time and peak memory for the enclosed block
+        '''
+        start_time = time.time()
+
+        try:
+            yield
+        finally:
+            self.stages.append(StageTiming(name, start_time, time.time() - start_time, peak_memory()))
@@ -0,0 +1,150 @@
+''' Concurrent S3 reads and writes over a bounded thread pool.
+
+Boto3 clients are safe to share between threads, so one client's connection
+pool serves every worker. Create clients with CLIENT_CONFIG to make that pool
+large enough for MAX_WORKERS threads and to retry transient errors, which
+botocore does with backoff for every request so callers here don't retry.
+'''
+import gzip, time, threading, collections, concurrent.futures
+import botocore.config
+
+MAX_WORKERS = 16
+MAX_ATTEMPTS = 4
+
+CLIENT_CONFIG = botocore.config.Config(max_pool_connections=MAX_WORKERS,
+    retries={'mode': 'standard', 'max_attempts': MAX_ATTEMPTS})
+
+PutStats = collections.namedtuple('PutStats',
+    ('count', 'bytes', 'retries', 'mean_latency', 'max_latency', 'elapsed_time'))
+
+def body_size(body):
+    ''' Return size in bytes of a put_object() body string or bytes
+    '''
+    return len(body.encode('utf8') if isinstance(body, str) else body)
+
+def read_body(object):
+    ''' Return bytes of a get_object() response body, decompressing gzip
+    '''
+    body = object['Body'].read()
+
+    if object.get('ContentEncoding') == 'gzip':
+        return gzip.decompress(body)
+
+    return body
+
+def list_keys(s3, bucket, prefix):
+    ''' Return every key under a prefix, following truncated listings
+    '''
+    keys, marker = [], None
+
+    while True:
+        kwargs = dict(Bucket=bucket, Prefix=prefix)
+
+        if marker is not None:
+            kwargs.update(Marker=marker)
+
+        response = s3.list_objects(**kwargs)
+        keys.extend(object['Key'] for object in response.get('Contents', []))
+
+        if not response.get('IsTruncated') or not keys:
+            return keys
+
+        marker = keys[-1]
+
+def iter_objects(s3, bucket, keys, max_workers=MAX_WORKERS):
+    ''' Generate (key, body bytes) tuples as concurrent downloads complete
+
+        Callers can work on each body while remaining downloads are in flight.
+    '''
+    def get_body(key):
+        return read_body(s3.get_object(Bucket=bucket, Key=key))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(get_body, key): key for key in keys}
+
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+class ObjectWriter:
+    ''' Put S3 objects concurrently, counting retries made by the S3 client.
+
+        Call close() or use as a context manager to wait for every put to
+        finish, raising the first error seen, if any.
+
+            with transfer.ObjectWriter(s3) as writer:
+                writer.put_object(Bucket=bucket, Key=key, Body=body)
+    '''
+    def __init__(self, s3, max_workers=MAX_WORKERS):
+        self.s3 = s3
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+        self.latencies = []
+        self.bytes, self.retries = 0, 0
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.executor.shutdown(wait=True)
+
+    def put_object(self, **kwargs):
+        ''' Queue one s3.put_object() call and return a Future for its response
+        '''
+        future = self.executor.submit(self._put_object, kwargs)
+        self.futures.append(future)
+
+        return future
+
+    def _put_object(self, kwargs):
+        start_time = time.time()
+        response = self.s3.put_object(**kwargs)
+
+        with self.lock:
+            self.latencies.append(time.time() - start_time)
+            self.bytes += body_size(kwargs.get('Body', b''))
+            self.retries += response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+
+        return response
+
+    def wait(self):
+        ''' Wait for queued puts, raise the first error, and return PutStats
+        '''
+        for future in concurrent.futures.as_completed(self.futures):
+            future.result()
+
+        stats = self.stats()
+        print('ObjectWriter:', stats)
+
+        return stats
+
+    def close(self):
+        ''' Wait for queued puts, shut down the thread pool, and return PutStats
+        '''
+        try:
+            return self.wait()
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def stats(self):
+        ''' Return PutStats for puts finished so far
+        '''
+        with self.lock:
+            latencies = list(self.latencies)
+
+            return PutStats(
+                len(latencies),
+                self.bytes,
+                self.retries,
+                (sum(latencies) / len(latencies)) if latencies else None,
+                max(latencies) if latencies else None,
+                time.time() - self.start_time,
+            )
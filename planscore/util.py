@@ -1,10 +1,17 @@
-import urllib.parse, tempfile, shutil, os, contextlib, logging, zipfile, itertools, functools, enum, csv, re, time, json
+import urllib.parse, tempfile, shutil, os, io, contextlib, logging, zipfile, itertools, functools, enum, csv, re, time, json, collections
+import numpy
 from . import constants
 import osgeo.ogr
 
 EMPTY_GEOMETRY = osgeo.ogr.Geometry(osgeo.ogr.wkbGeometryCollection)
 POLYGONAL_TYPES = {osgeo.ogr.wkbPolygon, osgeo.ogr.wkbMultiPolygon}
 
+# Rows per chunk from iter_baf_chunks()
+BAF_CHUNK_SIZE = 65536
+
+# Fixed-width block ID bytes, with integer codes into a list of district labels
+BlockAssignments = collections.namedtuple('BlockAssignments', ('block_ids', 'codes', 'labels'))
+
 class UploadType (enum.Enum):
     OGR_DATASOURCE = 1
     BLOCK_ASSIGNMENT = 2
@@ -112,8 +119,35 @@ def event_query_args(event):
     '''
     return event.get('queryStringParameters') or {}
 
-def baf_stream_to_pairs(stream):
+@contextlib.contextmanager
+def open_baf_file(path):
+    ''' Open a block assignment file as text, looking inside a zip file if needed
     '''
+    _, ext = os.path.splitext(path.lower())
+    
+    if ext == '.zip':
+        with open(path, 'rb') as file:
+            zf = zipfile.ZipFile(file)
+
+            # Sort names so "real"-looking paths come first: not dot-names, not in '__MACOSX'
+            namelist = sorted(zf.namelist(), reverse=False,
+                key=lambda n: (os.path.basename(n).startswith('.'), n.startswith('__MACOSX')))
+
+            for name in namelist:
+                if os.path.splitext(name.lower())[1] in ('.txt', '.csv'):
+                    with io.TextIOWrapper(zf.open(name)) as stream:
+                        yield stream
+                    return
+
+    elif ext in ('.csv', '.txt'):
+        with open(path, 'r') as file:
+            yield file
+            return
+    
+    raise ValueError(f'No block assignment file found in {path}')
+
+def baf_stream_to_rows(stream):
+    ''' Return a csv.reader over data rows and block and district column indexes
     '''
     head, tail = next(stream), stream
     delimiter = '|' if '|' in head else ','
@@ -124,31 +158,85 @@ def baf_stream_to_pairs(stream):
     else:
         # No header row, make a fake one
         lines = itertools.chain([f'BLOCKID{delimiter}DISTRICT', head], tail)
-    rows = csv.DictReader(lines, delimiter=delimiter)
-    
-    if len(rows.fieldnames) != 2:
-        raise ValuError(f'Bad column count in {stream}')
-
-    if 'GEOID10' in rows.fieldnames:
-        block_column = 'GEOID10'
-        district_column = rows.fieldnames[(rows.fieldnames.index(block_column) + 1) % 2]
-    elif 'GEOID20' in rows.fieldnames:
-        block_column = 'GEOID20'
-        district_column = rows.fieldnames[(rows.fieldnames.index(block_column) + 1) % 2]
-    elif 'BLOCKID' in rows.fieldnames:
-        block_column = 'BLOCKID'
-        district_column = rows.fieldnames[(rows.fieldnames.index(block_column) + 1) % 2]
-    elif 'DISTRICT' in rows.fieldnames:
-        district_column = 'DISTRICT'
-        block_column = rows.fieldnames[(rows.fieldnames.index(district_column) + 1) % 2]
+    rows = csv.reader(lines, delimiter=delimiter)
+    fieldnames = next(rows)
+    
+    if len(fieldnames) != 2:
+        raise ValueError(f'Bad column count in {stream}')
+
+    if 'GEOID10' in fieldnames:
+        block_column = fieldnames.index('GEOID10')
+        district_column = (block_column + 1) % 2
+    elif 'GEOID20' in fieldnames:
+        block_column = fieldnames.index('GEOID20')
+        district_column = (block_column + 1) % 2
+    elif 'BLOCKID' in fieldnames:
+        block_column = fieldnames.index('BLOCKID')
+        district_column = (block_column + 1) % 2
+    elif 'DISTRICT' in fieldnames:
+        district_column = fieldnames.index('DISTRICT')
+        block_column = (district_column + 1) % 2
     else:
-        block_column, district_column = rows.fieldnames
+        block_column, district_column = 0, 1
+    
+    return rows, block_column, district_column
+
+def iter_baf_chunks(stream, chunk_size=BAF_CHUNK_SIZE):
+    ''' Generate BlockAssignments chunks from a block assignment file stream.
+    
+        District codes are consistent across chunks, and the labels list is
+        shared and grows as new districts appear, so the last chunk has all.
+    '''
+    rows, block_column, district_column = baf_stream_to_rows(stream)
+    labels, label_codes = [], {}
+    
+    while True:
+        chunk = [row for row in itertools.islice(rows, chunk_size) if len(row) >= 2]
+        
+        if not chunk:
+            return
+        
+        # Exclude "ZZ" district, used by Census for all-water non-districts
+        chunk = [row for row in chunk if row[district_column] != 'ZZ']
+        
+        if not chunk:
+            continue
+        
+        codes = numpy.array([
+            label_codes.setdefault(row[district_column], len(label_codes))
+            for row in chunk
+        ], dtype=numpy.int32)
+        
+        labels.extend(list(label_codes)[len(labels):])
+        
+        # Block IDs are ASCII GEOIDs, so anything else becomes "?" and matches no block
+        block_ids = numpy.array([row[block_column].encode('ascii', 'replace') for row in chunk], dtype=bytes)
+        
+        yield BlockAssignments(block_ids, codes, labels)
+
+def read_baf(stream):
+    ''' Return all BlockAssignments from a block assignment file stream
+    '''
+    chunks = list(iter_baf_chunks(stream))
+    
+    if not chunks:
+        return BlockAssignments(numpy.array([], dtype=bytes), numpy.array([], dtype=numpy.int32), [])
+    
+    return BlockAssignments(
+        numpy.concatenate([chunk.block_ids for chunk in chunks]),
+        numpy.concatenate([chunk.codes for chunk in chunks]),
+        chunks[-1].labels,
+    )
+
+def baf_stream_to_pairs(stream):
+    ''' Return a list of (block ID, district) string pairs
+    '''
+    assignments = read_baf(stream)
     
-    # Exclude "ZZ" district, used by Census for all-water non-districts
-    return [
-        (row[block_column], row[district_column])
-        for row in rows if row[district_column] != 'ZZ'
-    ]
+    return list(zip(
+        assignments.block_ids.astype(str).tolist(),
+        [assignments.labels[code] for code in assignments.codes.tolist()],
+    ))
 
 def ordered_districts(layer):
     ''' Return field name and list of layer features ordered by guessed district numbers.
@@ -10,7 +10,7 @@ setup(
         ],
     test_suite = 'planscore.tests',
     package_data = {
-        'planscore': ['geodata/*.*', 'model/*.csv.gz'],
+        'planscore': ['geodata/*.*', 'model/*.csv.gz', 'model/*.npz'],
         'planscore.website': ['templates/*.html', 'static/*.*'],
         'planscore.tests': [
             'data/*.*',
@@ -38,6 +38,7 @@ setup(
         ],
     extras_require = {
         'large': [
+            'pyarrow == 17.0.0',
             'Shapely == 1.7.1',
             ],
         'compiled': [
@@ -71,6 +72,9 @@ setup(
         },
     entry_points = dict(
         console_scripts = [
+            'planscore-benchmark = planscore.benchmark:main',
+            'planscore-graph-convert = planscore.blockgraph:main',
+            'planscore-matrix-convert = planscore.matrix:convert_main',
             'planscore-matrix-debug = planscore.matrix:main',
             'planscore-polygonize = planscore.polygonize:main',
             'planscore-prepare-state = planscore.prepare_state:main',